@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup
+import fbchat
+from fbchat import tokens, utils
+from fbchat.deltas import Deduplicator
+from fbchat.event_hook import EventHook
+from fbchat.journal import PullJournal, readJournal
+from fbchat.metrics import Metrics
+from fbchat.profiler import ListenProfiler
+from fbchat.models import ThreadType
+from fbchat.standin import StandInServer
+
+"""
+
+Benchmarks for fbchat
+~~~~~~~~~~~~~~~~~~~~~
+
+These run offline, without a Facebook account.
+Run all of them with `python benchmarks.py`, or pass the names of the benchmarks to run in the commandline
+
+Pages saved from Facebook (e.g. the home page) can be used by `bench_tokens`, by setting
+`FBCHAT_BENCH_PAGES` to a list of their paths, separated like in `PATH`.
+Likewise, `bench_replay` replays the journal of `PullJournal` in `FBCHAT_BENCH_JOURNAL`, if it's set
+
+The end-to-end benchmarks (`bench_send`, `bench_listen` and `bench_client_memory`) use a `StandInServer`
+instead of Facebook. Its latency (in seconds) and error rate (between 0 and 1) are set by `FBCHAT_BENCH_LATENCY`
+and `FBCHAT_BENCH_ERROR_RATE`. It runs in the same process as the clients, so the rates are lower bounds
+
+The script exits with status 1 if a benchmark guarding against a regression (e.g. `bench_import`) failed
+
+"""
+
+
+def report(name, seconds, number, unit='ms'):
+    scale = {'ms': 1e3, 'us': 1e6}[unit]
+    print('{:<50} {:>12.3f} {}'.format(name, seconds / number * scale, unit))
+
+
+def make_pull_payload(messages=5000):
+    """Returns a pull response with `messages` messages, looking like the ones sent by Facebook"""
+    ms = [{
+        'type': 'delta',
+        'delta': {
+            'class': 'NewMessage',
+            'body': 'Message number {} ❤ with some text in it'.format(i),
+            'messageMetadata': {
+                'messageId': 'mid.{}'.format(i),
+                'actorFbId': '100000000000001',
+                'timestamp': '1490000000000',
+                'threadKey': {'otherUserFbId': '100000000000002'},
+            },
+        },
+    } for i in range(messages)]
+    return ('for (;;); ' + json.dumps({'t': 'msg', 'seq': messages, 'ms': ms})).encode('utf-8')
+
+
+#: A session restored by the benchmarks needing a client, without any request
+SNAPSHOT = {
+    'cookies': {'c_user': '100000000000001'},
+    'fb_dtsg': 'AQH3u6Y_a-Ng:AQHsD9BtR0Fm',
+    'fb_h': 'AfdC8EwWbMXi2e7M',
+    'ttstamp': '2',
+    'revision': 3000001,
+    'client_id': '1a2b3c4d',
+    'seq': '0',
+}
+
+
+def make_client():
+    """Returns a client restored from `SNAPSHOT`, with its logs silenced"""
+    client = fbchat.Client(None, None, debug=False, info_log=False, snapshot=SNAPSHOT)
+    fbchat.log.setLevel(logging.WARNING)
+    return client
+
+
+def bench_get_json(number=20):
+    """Decoding of a large response body"""
+    content = make_pull_payload()
+    print('Decoding a {:.1f} MB response'.format(len(content) / 1e6))
+
+    def old():
+        text = content.decode('utf-8')
+        return json.loads(text[text.index('{'):])
+
+    report('str + json.loads', timeit.timeit(old, number=number), number)
+    report('get_json(bytes) ({})'.format(utils._json_loads.__module__), timeit.timeit(lambda: utils.get_json(content), number=number), number)
+
+
+def make_home_page(size=500000):
+    """Returns a page of about `size` bytes, with the tokens and the markup of the home page of Facebook"""
+    filler = ''.join(
+        '<div class="_5pcr"><a href="/profile.php?id={0}" data-hovercard="/ajax/hovercard/user.php?id={0}">'
+        '<span>Friend {0}</span></a><form><input type="hidden" name="ref_{0}" value="{0}"/></form></div>'
+        '<script>require("ServerJS").handle({{"define":[["SiteData",[],{{"revision":3000{0},"push_phase":"C3"}}]]}});</script>\n'.format(i)
+        for i in range(size // 300)
+    )
+    return (
+        '<!DOCTYPE html><html><head><title>Facebook</title>'
+        '<script>{"revision":3000001,"tier":"","push_phase":"C3"}</script></head><body>'
+        '<form action="/logout.php" method="post"><input type="hidden" name="fb_dtsg" value="AQH3u6Y_a-Ng:AQHsD9BtR0Fm" autocomplete="off" />'
+        '<input type="hidden" autocomplete="off" name="h" value="AfdC8EwWbMXi2e7M"/></form>'
+        + filler + '</body></html>'
+    )
+
+
+def bench_tokens(number=10):
+    """Extraction of the session tokens from the home page, as done when logging in"""
+    paths = [path for path in os.environ.get('FBCHAT_BENCH_PAGES', '').split(os.pathsep) if path]
+    if paths:
+        pages = []
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                pages.append(f.read())
+    else:
+        pages = [make_home_page()]
+    print('Extracting from {} page(s), of {:.1f} KB on average'.format(len(pages), sum(map(len, pages)) / len(pages) / 1e3))
+
+    def soup():
+        for page in pages:
+            soup = BeautifulSoup(page, 'lxml')
+            soup.find('input', {'name': 'fb_dtsg'})['value']
+            soup.find('input', {'name': 'h'})['value']
+            int(page.split('"revision":', 1)[1].split(',', 1)[0])
+
+    def extractor():
+        for page in pages:
+            tokens.findInput(page, 'fb_dtsg')
+            tokens.findInput(page, 'h')
+            tokens.findRevision(page)
+
+    report('BeautifulSoup', timeit.timeit(soup, number=number), number * len(pages))
+    report('tokens.findInput', timeit.timeit(extractor, number=number), number * len(pages))
+
+
+def bench_parse_message(number=20):
+    """Dispatching of the messages of a pull response to the events of the client"""
+    client = make_client()
+    content = utils.get_json(make_pull_payload())
+    received = []
+    client.onMessage += lambda mid, author_id, message, thread_id, thread_type, ts, metadata: received.append(mid)
+    print('Parsing {} messages'.format(len(content['ms'])))
+
+    def parse():
+        # The same messages are parsed again and again, which mustn't be seen as duplicates
+        client.deduplicator = Deduplicator()
+        client._parseMessage(content)
+
+    report('_parseMessage', timeit.timeit(parse, number=number), number)
+    if client.parse_failures or client.duplicates or len(received) != number * len(content['ms']):
+        print('Regression: messages were lost, {}'.format(client.parse_failures))
+        return False
+
+
+def bench_logging(number=20, clients=3):
+    """Cost of the logs of `_parseMessage`, disabled and enabled. Fails if each client adds a log handler"""
+    content = utils.get_json(make_pull_payload())
+    logger = logging.getLogger('client')
+    clients = [make_client() for i in range(clients)]
+    handlers = logger.handlers
+    logger.handlers = [logging.StreamHandler(open(os.devnull, 'w'))]
+    try:
+        for level in [logging.WARNING, logging.INFO, logging.DEBUG]:
+            logger.setLevel(level)
+
+            def parse():
+                clients[0].deduplicator = Deduplicator()
+                clients[0]._parseMessage(content)
+
+            report('_parseMessage, {}'.format(logging.getLevelName(level)), timeit.timeit(parse, number=number), number)
+    finally:
+        logger.handlers[0].stream.close()
+        logger.handlers = handlers
+        logger.setLevel(logging.WARNING)
+
+    if len(handlers) > 1:
+        print('Regression: {} clients added {} log handlers'.format(len(clients), len(handlers)))
+        return False
+
+
+def bench_metrics(number=20, requests=100000):
+    """Overhead of `Metrics`, when parsing the messages of a pull response, and per request"""
+    content = utils.get_json(make_pull_payload())
+    for metrics in [None, Metrics()]:
+        client = make_client()
+        client.metrics = metrics
+
+        def parse():
+            client.deduplicator = Deduplicator()
+            client._parseMessage(content)
+
+        report('_parseMessage, metrics={}'.format(type(metrics).__name__), timeit.timeit(parse, number=number), number)
+
+    metrics = Metrics()
+    seconds = timeit.timeit(lambda: metrics.observeRequest('https://www.facebook.com/messaging/send/?a=1', 200, 0.1, 2000, 300), number=requests)
+    report('Metrics.observeRequest', seconds, requests, 'us')
+
+
+def bench_replay(responses=50, messages=200):
+    """Recording pull responses in a journal, and replaying them through the event hooks"""
+    journal = os.environ.get('FBCHAT_BENCH_JOURNAL')
+    with tempfile.TemporaryDirectory() as directory:
+        if journal is None:
+            journal = PullJournal(directory)
+            content = make_pull_payload(messages)
+            seconds = timeit.timeit(lambda: journal.write(content), number=responses)
+            journal.close()
+            report('PullJournal.write ({:.0f} KB)'.format(len(content) / 1e3), seconds, responses)
+
+        records = list(readJournal(getattr(journal, 'directory', journal)))
+        count = sum(len(utils.get_json(content).get('ms', [])) for timestamp, content in records)
+        client = make_client()
+        # The synthetic journal has the same messages in every response
+        client.deduplicator = None
+        seconds = timeit.timeit(lambda: client.replay(journal), number=1)
+        report('replay, per response', seconds, len(records))
+        print('{:<50} {:>12.0f} messages/s'.format('replay', count / seconds))
+
+
+def bench_event_hook(number=100000):
+    """Cost of calling an event hook, by number of handlers, with and without checking the arguments of the calls"""
+    kwargs = dict(mid='mid.1', author_id='1', message='Hi', thread_id='2', thread_type=None, ts=0, metadata=None)
+    for handlers in [0, 1, 10, 100]:
+        hook = EventHook(mid=str, author_id=str, message=str, thread_id=str, thread_type=object, ts=int, metadata=dict)
+        for i in range(handlers):
+            hook += lambda mid, author_id, message, thread_id, thread_type, ts, metadata: None
+        for check_calls in [True, False]:
+            hook.check_calls = check_calls
+            n = max(1, number // max(1, handlers))
+            report('{} handlers, check_calls={}'.format(handlers, check_calls), timeit.timeit(lambda: hook(**kwargs), number=n), n, 'us')
+
+
+def bench_subscriptions(number=20000, threads=1000):
+    """Cost of an event with one handler per thread, filtering the events itself or subscribed to its thread"""
+    kwargs = dict(mid='mid.1', author_id='1', message='Hi', thread_id='500', thread_type=None, ts=0, metadata=None)
+    calls = []
+
+    def make_handler(thread_id):
+        def handler(mid, author_id, message, thread_id, thread_type, ts, metadata):
+            calls.append(thread_id)
+        return handler
+
+    def make_filtering_handler(wanted):
+        def handler(mid, author_id, message, thread_id, thread_type, ts, metadata):
+            if thread_id == wanted:
+                calls.append(thread_id)
+        return handler
+
+    filtering = EventHook(mid=str, author_id=str, message=str, thread_id=str, thread_type=object, ts=int, metadata=dict)
+    subscribed = EventHook(mid=str, author_id=str, message=str, thread_id=str, thread_type=object, ts=int, metadata=dict)
+    for i in range(threads):
+        filtering += make_filtering_handler(str(i))
+        subscribed.subscribe(make_handler(str(i)), thread_id=str(i))
+
+    n = max(1, number // threads)
+    report('{} handlers filtering'.format(threads), timeit.timeit(lambda: filtering(**kwargs), number=n), n, 'us')
+    report('{} subscriptions'.format(threads), timeit.timeit(lambda: subscribed(**kwargs), number=number), number, 'us')
+    if calls != ['500'] * (n + number):
+        print('Regression: the handlers were called {} times, instead of {}'.format(len(calls), n + number))
+        return False
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def make_standin(**kwargs):
+    """Returns a `StandInServer` configured by `FBCHAT_BENCH_LATENCY` and `FBCHAT_BENCH_ERROR_RATE`, to use with `with`"""
+    latency = float(os.environ.get('FBCHAT_BENCH_LATENCY', 0.005))
+    error_rate = float(os.environ.get('FBCHAT_BENCH_ERROR_RATE', 0))
+    print('Against a stand-in server, with a latency of {:.0f} ms and an error rate of {:.1%}'.format(latency * 1e3, error_rate))
+    return StandInServer(latency=latency, error_rate=error_rate, seed=0, **kwargs)
+
+
+def login(email, client_class=fbchat.Client):
+    """Returns a client logged in to the stand-in server, with its logs silenced"""
+    client = client_class(email, 'password', debug=False, info_log=False)
+    fbchat.log.setLevel(logging.WARNING)
+    return client
+
+
+def bench_send(messages=500, concurrency=8):
+    """Sending messages, one at a time and concurrently, with `Client` and `AsyncClient`"""
+    failed = 0
+    with make_standin() as server:
+        client = login('sender@example.com')
+
+        def send(i):
+            start = time.perf_counter()
+            sent = client.sendMessage('Message {}'.format(i), '100000000000002', ThreadType.USER)
+            return time.perf_counter() - start, sent
+
+        for workers in [1, concurrency]:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(send, range(messages)))
+            seconds = time.perf_counter() - start
+            latencies = [latency for latency, sent in results]
+            failed += sum(not sent for latency, sent in results)
+            name = 'Client, {} at once'.format(workers)
+            print('{:<50} {:>12.0f} sends/s'.format(name, messages / seconds))
+            print('{:<50} {:>12.3f} ms'.format(name + ', p50 latency', percentile(latencies, 50) * 1e3))
+            print('{:<50} {:>12.3f} ms'.format(name + ', p99 latency', percentile(latencies, 99) * 1e3))
+
+        try:
+            import asyncio
+            from fbchat.async_client import AsyncClient
+        except ImportError:
+            print('AsyncClient skipped, aiohttp is not installed')
+        else:
+            async def run():
+                client = login('async.sender@example.com', AsyncClient)
+                semaphore = asyncio.Semaphore(concurrency)
+                latencies = []
+
+                async def send(i):
+                    async with semaphore:
+                        start = time.perf_counter()
+                        try:
+                            await client.sendMessage('Message {}'.format(i), '100000000000002', ThreadType.USER)
+                        except Exception:
+                            return False
+                        latencies.append(time.perf_counter() - start)
+                        return True
+
+                start = time.perf_counter()
+                results = await asyncio.gather(*[send(i) for i in range(messages)])
+                seconds = time.perf_counter() - start
+                await client.close()
+                name = 'AsyncClient, {} at once'.format(concurrency)
+                print('{:<50} {:>12.0f} sends/s'.format(name, messages / seconds))
+                print('{:<50} {:>12.3f} ms'.format(name + ', p50 latency', percentile(latencies, 50) * 1e3))
+                print('{:<50} {:>12.3f} ms'.format(name + ', p99 latency', percentile(latencies, 99) * 1e3))
+                return results.count(False)
+
+            failed += asyncio.new_event_loop().run_until_complete(run())
+
+    if failed and not server.error_rate:
+        print('Regression: {} messages failed to be sent'.format(failed))
+        return False
+
+
+def bench_listen(seconds=3, message_rate=100000):
+    """Events handled per second by a listening `Client`, without and with a `ListenProfiler` showing where the time goes"""
+    failed = False
+    with make_standin(message_rate=message_rate) as server:
+        for profiler in [None, ListenProfiler()]:
+            client = login('listener@example.com')
+            client.setProfiler(profiler)
+            received = []
+            client.onMessage += lambda mid, author_id, message, thread_id, thread_type, ts, metadata: received.append(mid)
+            listener = threading.Thread(target=client.listen)
+            start = time.perf_counter()
+            listener.start()
+            time.sleep(seconds)
+            client.listening = False
+            listener.join()
+            elapsed = time.perf_counter() - start
+
+            print('{:<50} {:>12.0f} events/s'.format('Client.listen, profiler={}'.format(type(profiler).__name__), len(received) / elapsed))
+            if client.parse_failures or client.duplicates:
+                print('Regression: {} messages failed to be parsed, {} were seen as duplicates'.format(client.parse_failures, client.duplicates))
+                failed = True
+
+    print(profiler.report())
+    if failed:
+        return False
+
+
+def bench_client_memory(clients=50):
+    """Memory allocated by each logged in `Client`"""
+    with make_standin() as server:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        logged_in = [login('user{}@example.com'.format(i)) for i in range(clients)]
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('{:<50} {:>12.1f} KB'.format('Client, after logging in', (after - before) / len(logged_in) / 1e3))
+
+
+#: Modules which `import fbchat` must not import, since they're only needed once a client is used
+LAZY_MODULES = ['requests', 'bs4', 'lxml', 'aiohttp', 'asyncio', 'mimetypes', 'inspect', 'fbchat.client']
+
+
+def bench_import(number=10):
+    """Time taken by `import fbchat` in a new interpreter. Fails if it imports any of `LAZY_MODULES`"""
+    def run(code):
+        return float(subprocess.check_output([sys.executable, '-c', (
+            'import sys, time\n'
+            'start = time.perf_counter()\n'
+            '{}\n'
+            'print(time.perf_counter() - start)\n'
+        ).format(code)], env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))))
+
+    for name, code in [
+        ('import fbchat', 'import fbchat'),
+        ('import fbchat; fbchat.Client', 'import fbchat; fbchat.Client'),
+    ]:
+        # The fastest run is the one least disturbed by the rest of the system
+        report(name, min(run(code) for i in range(number)), 1)
+
+    imported = subprocess.check_output([sys.executable, '-c', (
+        'import sys, fbchat\n'
+        'print(" ".join(m for m in {!r} if m in sys.modules))'
+    ).format(LAZY_MODULES)], env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))).decode().split()
+    if imported:
+        print('Regression: `import fbchat` imports {}'.format(', '.join(imported)))
+        return False
+
+
+BENCHMARKS = [
+    bench_get_json,
+    bench_parse_message,
+    bench_logging,
+    bench_metrics,
+    bench_replay,
+    bench_event_hook,
+    bench_subscriptions,
+    bench_tokens,
+    bench_send,
+    bench_listen,
+    bench_client_memory,
+    bench_import,
+]
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    failed = False
+    for benchmark in BENCHMARKS:
+        if not names or benchmark.__name__ in names:
+            print('\n{}: {}'.format(benchmark.__name__, benchmark.__doc__))
+            # A benchmark returns False when it found a regression
+            if benchmark() is False:
+                failed = True
+    sys.exit(1 if failed else 0)
@@ -10,8 +10,9 @@
     :license: BSD, see LICENSE for more details.
 """
 
-
-from .client import *
+import sys
+from . import models, utils
+from .models import *
 
 
 __copyright__ = 'Copyright 2015 by Taehoon Kim'
@@ -23,4 +24,76 @@ __source__ = 'https://github.com/carpedm20/fbchat/'
 
 __all__ = [
     'Client',
+    'AsyncClient',
+    'OutboundScheduler',
+    'UploadCache',
+    'ClientPool',
+    'EventExecutor',
+    'AsyncEventExecutor',
+    'PullJournal',
+    'StandInServer',
+    'Metrics',
+    'ListenProfiler',
 ]
+
+# Where the names exported by the package are defined. The modules are only imported the first time one of
+# their names is used, so that e.g. `from fbchat.models import ThreadType` doesn't need to import `requests`
+_lazy_names = {
+    'Client': 'client',
+    'AsyncClient': 'async_client',
+    'OutboundScheduler': 'scheduler',
+    'Priority': 'scheduler',
+    'UploadCache': 'cache',
+    'ClientPool': 'pool',
+    'EventExecutor': 'executor',
+    'AsyncEventExecutor': 'executor',
+    'Overflow': 'executor',
+    'PullJournal': 'journal',
+    'StandInServer': 'standin',
+    'Metrics': 'metrics',
+    'ListenProfiler': 'profiler',
+    'RetryPolicy': 'retry',
+    'CircuitBreaker': 'retry',
+    'CircuitOpenError': 'retry',
+}
+# `from .client import *` used to export these too
+_lazy_names.update(dict.fromkeys([
+    'LoginURL', 'SearchURL', 'SendURL', 'ThreadsURL', 'ThreadSyncURL', 'MessagesURL', 'ReadStatusURL', 'DeliveredURL',
+    'MarkSeenURL', 'BaseURL', 'MobileURL', 'StickyURL', 'PingURL', 'UploadURL', 'UserInfoURL', 'ConnectURL',
+    'RemoveUserURL', 'LogoutURL', 'AllUsersURL', 'SaveDeviceURL', 'CheckpointURL', 'facebookEncoding', 'log',
+], 'client'))
+_lazy_names['EventHook'] = 'event_hook'
+_lazy_names.update(dict.fromkeys([
+    'GENDERS', 'USER_AGENTS', 'now', 'strip_to_json', 'get_json', 'digit_to_char', 'str_base', 'generateMessageID',
+    'getSignatureID', 'generateOfflineThreadingID',
+], 'utils'))
+
+
+def __getattr__(name):
+    from importlib import import_module
+    from importlib.util import find_spec
+    if name in _lazy_names:
+        value = getattr(import_module('.' + _lazy_names[name], __name__), name)
+    elif not name.startswith('_') and find_spec('.' + name, __name__) is not None:
+        # A submodule, which all used to be imported by `import fbchat`
+        value = import_module('.' + name, __name__)
+    else:
+        # Without importing anything, so that e.g. `hasattr(fbchat, name)` stays cheap
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+if sys.version_info < (3, 7):
+    # Module level `__getattr__` (PEP 562) isn't supported, so import everything now
+    from .client import *
+    from .async_client import AsyncClient
+    from .scheduler import OutboundScheduler, Priority
+    from .cache import UploadCache
+    from .pool import ClientPool
+    from .executor import EventExecutor, AsyncEventExecutor, Overflow
+    from .journal import PullJournal
+    from .standin import StandInServer
+    from .metrics import Metrics
+    from .profiler import ListenProfiler
+    from .retry import RetryPolicy, CircuitBreaker, CircuitOpenError
@@ -0,0 +1,509 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.async_client
+    ~~~~~~~~~~~~~~~~~~~
+
+    An asyncio version of the Facebook Chat (Messenger) client
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import asyncio
+import io
+import os
+import time
+from http.cookies import SimpleCookie
+from .client import *
+# The URLs are read from `fbchat.client` when they're used, so pointing them elsewhere (e.g. with a
+# `StandInServer`) applies to both clients, whichever was imported first
+from . import client
+from .retry import CircuitOpenError
+from .executor import AsyncEventExecutor
+from .journal import readJournal
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class _Response(object):
+    """The parts of an `aiohttp` response used by fbchat, named like in `requests`.
+    Unlike the `aiohttp` response, it can still be used after the connection has been released.
+    """
+
+    def __init__(self, r, content):
+        self.ok = r.ok
+        self.status_code = r.status
+        self.url = str(r.url)
+        self.headers = r.headers
+        self.content = content
+        self._reason = r.reason
+        self._request_info = r.request_info
+        self._history = r.history
+
+    @property
+    def text(self):
+        return self.content.decode(facebookEncoding, 'replace')
+
+    def raise_for_status(self):
+        """Raises an `aiohttp.ClientResponseError` if the status is an error, like the `aiohttp` response"""
+        if not self.ok:
+            raise aiohttp.ClientResponseError(self._request_info, self._history, status=self.status_code,
+                                              message=self._reason, headers=self.headers)
+
+    def __repr__(self):
+        return '<Response [%d]>' % self.status_code
+
+
+class _KeptOpen(io.RawIOBase):
+    """Reads a file object for `aiohttp`, which closes the files it has sent, while they must stay open to be sent again"""
+
+    def __init__(self, f):
+        self._f = f
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def readinto(self, b):
+        data = self._f.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def fileno(self):
+        # Used by `aiohttp` to find the size of the file
+        return self._f.fileno()
+
+
+class AsyncClient(Client):
+    """A client for the Facebook Chat (Messenger), which sends its requests with `aiohttp`,
+    so that a single event loop can drive many concurrent requests.
+
+    Logging in happens synchronously when the client is created, exactly as with `Client`.
+    After that, the network methods listed below are coroutines, and must be awaited
+    (the methods not listed still block, using the synchronous session):
+      sendMessage, sendMessages, broadcastMessage, sendEmoji, sendRemoteImage, sendLocalImage,
+      sendRemoteImages, sendLocalImages,
+      addUsersToChat, changeThreadTitle,
+      getThreadInfo, getThreadList, getUserInfo, markAsRead, ping,
+      startListening, doOneListen, listen
+    The payload generation and response parsing are shared with `Client`.
+    Call `close` when you're done with the client.
+    """
+
+    def __init__(self, email, password, connector=None, **kwargs):
+        """See `Client` for the other parameters
+
+        :param connector: An `aiohttp` connector to share its connections with other clients, or a function
+                          returning one, called when it's first needed (see `ClientPool`). It isn't closed by `close`
+        """
+        if aiohttp is None:
+            raise Exception("AsyncClient requires aiohttp. Install it with `pip install fbchat[async]`")
+
+        self.connector = connector
+        self._asyncSession = None
+        self._jar_generation = None
+        super(AsyncClient, self).__init__(email, password, **kwargs)
+
+    def _getCookies(self):
+        """Returns the cookies of the synchronous session, in a form `aiohttp` understands"""
+        cookies = SimpleCookie()
+        for cookie in self._session.cookies:
+            cookies[cookie.name] = cookie.value
+            cookies[cookie.name]['domain'] = cookie.domain
+            cookies[cookie.name]['path'] = cookie.path
+        return cookies
+
+    def _getAsyncSession(self):
+        """Returns the `aiohttp` session, creating it from the cookies of the synchronous session if needed"""
+        if self._asyncSession is None or self._asyncSession.closed:
+            connector = self.connector() if callable(self.connector) else self.connector
+            self._asyncSession = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(), connector=connector, connector_owner=connector is None)
+            self._jar_generation = None
+        if self._jar_generation != self._session_generation:
+            # The tokens, and so the cookies, were fetched again with the synchronous session, e.g. by `startRefreshing`
+            self._jar_generation = self._session_generation
+            self._asyncSession.cookie_jar.update_cookies(self._getCookies())
+        return self._asyncSession
+
+    async def close(self):
+        """Stops refreshing the session tokens and pinging, and closes the underlying `aiohttp` session"""
+        self._stopPinging()
+        if self._refresher is not None:
+            await asyncio.get_event_loop().run_in_executor(None, self.stopRefreshing)
+        if self._asyncSession is not None:
+            await self._asyncSession.close()
+            self._asyncSession = None
+
+    async def _request(self, method, url, headers=None, timeout=30, **kwargs):
+        """Sends a request, and reads the whole response before releasing the connection
+
+        :return: a `_Response`
+        """
+        session = self._getAsyncSession()
+        metrics = self.metrics
+        if metrics is None:
+            async with session.request(method, url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as r:
+                return _Response(r, await r.read())
+
+        start = time.perf_counter()
+        try:
+            async with session.request(method, url, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as r:
+                response = _Response(r, await r.read())
+                sent = int(r.request_info.headers.get('Content-Length') or 0)
+        except Exception as e:
+            metrics.observeRequest(url, type(e).__name__, time.perf_counter() - start)
+            raise
+        metrics.observeRequest(url, response.status_code, time.perf_counter() - start, sent, len(response.content))
+        return response
+
+    async def _aretry(self, method, url, retry_timeouts=False, **kwargs):
+        """See `Client._retry`"""
+        if self.retry_policy is None:
+            return await self._request(method, url, **kwargs)
+        if retry_timeouts:
+            exceptions = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+        else:
+            exceptions = (aiohttp.ClientConnectionError,)
+        return await self.retry_policy.acall(url.split('?')[0], lambda: self._request(method, url, **kwargs), exceptions)
+
+    async def _asessionRetry(self, request):
+        """See `Client._sessionRetry`. The session is revalidated in an executor, with the synchronous session"""
+        generation = self._session_generation
+        r = await request()
+        if self._isSessionExpired(r):
+            log.info('Session expired, revalidating it')
+            if await asyncio.get_event_loop().run_in_executor(None, self._revalidateSession, generation):
+                r = await request()
+        return r
+
+    async def _aget(self, url, query=None, timeout=30, retry_timeouts=True):
+        def request():
+            # Unlike `requests`, `aiohttp` only accepts strings and numbers as query values
+            params = {k: str(v) for k, v in self._generatePayload(query).items() if v is not None}
+            return self._aretry('GET', url, retry_timeouts, headers=self._header, params=params, timeout=timeout)
+        return await self._asessionRetry(request)
+
+    async def _acquire(self, thread_id=None, priority=Priority.INTERACTIVE):
+        """Waits for the scheduler without blocking the event loop"""
+        if self.scheduler is None:
+            return
+        aacquire = getattr(self.scheduler, 'aacquire', None)
+        if aacquire is not None:
+            await aacquire(thread_id, priority)
+        else:
+            await asyncio.get_event_loop().run_in_executor(None, self.scheduler.acquire, thread_id, priority)
+
+    async def _apost(self, url, query=None, timeout=30, thread_id=None, priority=Priority.INTERACTIVE):
+        await self._acquire(thread_id, priority)
+        return await self._asessionRetry(lambda: self._aretry('POST', url, headers=self._header, data=self._generatePayload(query), timeout=timeout))
+
+    async def _apostFile(self, url, files=None, timeout=30, priority=Priority.INTERACTIVE):
+        """See `Client._postFile`. `aiohttp` streams file objects (reading them in an executor) and responses
+        being downloaded by itself. Like with `Client`, files which can't be rewound can't be retried
+        """
+        await self._acquire(None, priority)
+        fields = {k: str(v) for k, v in self._generatePayload(None).items()}
+        parts = []
+        rewindable = True
+        for name, f in files.items():
+            filename, content, mimetype = f[:3]
+            start = None
+            if not isinstance(content, (bytes, str)):
+                if getattr(content, 'seekable', lambda: False)():
+                    start = content.tell()
+                else:
+                    rewindable = False
+            parts.append((name, os.path.basename(filename), content, mimetype, start))
+
+        def request():
+            # A form can only be sent once, so each attempt gets its own, with the files read from their start again
+            data = aiohttp.FormData(fields)
+            for name, filename, content, mimetype, start in parts:
+                if start is not None:
+                    content.seek(start)
+                    content = _KeptOpen(content)
+                data.add_field(name, content, filename=filename, content_type=mimetype)
+            return self._request('POST', url, data=data, timeout=timeout)
+
+        if self.retry_policy is None or not rewindable:
+            return await request()
+        return await self.retry_policy.acall(url.split('?')[0], request, (aiohttp.ClientConnectionError,))
+
+    """
+    SEND METHODS
+    """
+
+    async def _sendData(self, data, priority=Priority.INTERACTIVE):
+        """See `Client._sendData`"""
+        thread_id = data.get('other_user_fbid') or data.get('thread_fbid')
+        r = await self._apost(client.SendURL, data, thread_id=thread_id, priority=priority)
+
+        if not r.ok:
+            raise FBchatException('Error when sending message: Got {} response'.format(r.status_code))
+
+        message_ids = self._parseSendResponse(r.content)
+        log.debug("Sending %s with data %s", r, Truncated(data))
+        return message_ids
+
+    async def _send(self, thread_id=None, message=None, thread_type=None, emoji_size=None, image_id=None, add_user_ids=None, new_title=None):
+        """See `Client._send`"""
+
+        data = self._getSendData(thread_id, message, thread_type, emoji_size, image_id, add_user_ids, new_title)
+        try:
+            return await self._sendData(data)
+        except FBchatException as e:
+            log.warning("%s", e)
+            return False
+
+    async def _sendMany(self, base_data, batch, max_concurrency):
+        """See `Client._sendMany`"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def send(item):
+            async with semaphore:
+                try:
+                    message, thread_id, thread_type = item
+                    return await self._sendData(self._getMessageSendData(base_data, message, thread_id, thread_type), Priority.BULK)
+                except Exception as e:
+                    log.warning("%s", e)
+                    return e
+
+        return await asyncio.gather(*[send(item) for item in batch])
+
+    async def broadcastMessage(self, message: str, thread_ids: list, thread_type: ThreadType = ThreadType.USER, max_concurrency=8):
+        """See `Client.broadcastMessage`"""
+        thread_ids = list(thread_ids)
+        results = await self.sendMessages([(message, thread_id, thread_type) for thread_id in thread_ids], max_concurrency)
+        return dict(zip(thread_ids, results))
+
+    async def sendRemoteImage(self, image_url: str, message: str = None, thread_id: str = None, thread_type: ThreadType = None):
+        """See `Client.sendRemoteImage`"""
+        image_id = await self._uploadRemoteImage(image_url)
+        return await self._send(thread_id, message, thread_type, None, image_id, None, None)
+
+    async def sendLocalImage(self, image_path: str, message: str = None, thread_id: str = None, thread_type: ThreadType = None):
+        """See `Client.sendLocalImage`"""
+        image_id = await self._uploadLocalImage(image_path)
+        return await self._send(thread_id, message, thread_type, None, image_id, None, None)
+
+    async def sendRemoteImages(self, image_urls: list, message: str = None, thread_id: str = None, thread_type: ThreadType = None, max_concurrency=4):
+        """See `Client.sendRemoteImages`"""
+        image_ids = await self._uploadImages(self._uploadRemoteImage, image_urls, max_concurrency)
+        return await self._send(thread_id, message, thread_type, None, image_ids, None, None)
+
+    async def sendLocalImages(self, image_paths: list, message: str = None, thread_id: str = None, thread_type: ThreadType = None, max_concurrency=4):
+        """See `Client.sendLocalImages`"""
+        image_ids = await self._uploadImages(self._uploadLocalImage, image_paths, max_concurrency)
+        return await self._send(thread_id, message, thread_type, None, image_ids, None, None)
+
+    """
+    END SEND METHODS
+    """
+
+    async def _uploadImage(self, image):
+        """See `Client._uploadImage`"""
+        r = await self._apostFile(client.UploadURL, image)
+        return self._parseUploadResponse(r.content)
+
+    async def _uploadImages(self, upload, sources, max_concurrency):
+        """See `Client._uploadImages`"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _upload(source):
+            async with semaphore:
+                return await upload(source)
+
+        return await asyncio.gather(*[_upload(source) for source in sources])
+
+    async def _uploadCachedImage(self, name, f, mimetype):
+        """See `Client._uploadCachedImage`. The file is hashed in an executor, to not block the event loop"""
+        digest = await asyncio.get_event_loop().run_in_executor(None, hashFile, f)
+        image_id = self.upload_cache.get(digest)
+        if image_id is None:
+            image_id = await self._uploadImage({'file': (name, f, mimetype)})
+            self.upload_cache.set(digest, image_id)
+        return image_id
+
+    async def _uploadRemoteImage(self, image_url):
+        """See `Client._uploadRemoteImage`"""
+        mimetype = guess_mimetype(image_url)
+        cached = self.upload_cache.getURL(image_url) if self.upload_cache is not None else None
+        headers = {'If-None-Match': cached[1]} if cached else None
+
+        async with self._getAsyncSession().get(image_url, headers=headers) as r:
+            if cached and r.status == 304:
+                return cached[0]
+            r.raise_for_status()
+            if self.upload_cache is None:
+                return await self._uploadImage({'file': (image_url, r.content, mimetype)})
+
+            with SpooledTemporaryFile(max_size=1024*1024) as f:
+                async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                    f.write(chunk)
+                f.seek(0)
+                image_id = await self._uploadCachedImage(image_url, f, mimetype)
+            if r.headers.get('ETag'):
+                self.upload_cache.setURL(image_url, image_id, r.headers['ETag'])
+            return image_id
+
+    async def _uploadLocalImage(self, image_path):
+        """See `Client._uploadLocalImage`. The file is opened in an executor, and read in one by `aiohttp`"""
+        mimetype = guess_mimetype(image_path)
+        f = await asyncio.get_event_loop().run_in_executor(None, open, image_path, 'rb')
+        with f:
+            if self.upload_cache is not None:
+                return await self._uploadCachedImage(image_path, f, mimetype)
+            return await self._uploadImage({'file': (image_path, f, mimetype)})
+
+    async def getThreadInfo(self, userID, last_n=20, start=None, is_user=True):
+        """See `Client.getThreadInfo`"""
+        data = self._getThreadInfoData(userID, last_n, start, is_user)
+        r = await self._apost(client.MessagesURL, query=data)
+        if not r.ok or len(r.content) == 0:
+            return None
+
+        return self._parseThreadInfo(get_json(r.content))
+
+    async def getThreadList(self, start, length=20):
+        """See `Client.getThreadList`"""
+        data = self._getThreadListData(start, length)
+        r = await self._apost(client.ThreadsURL, data)
+        if not r.ok or len(r.content) == 0:
+            return None
+
+        return self._parseThreadList(get_json(r.content))
+
+    async def markAsRead(self, userID):
+        r = await self._apost(client.ReadStatusURL, self._getMarkAsReadData(userID))
+        return r.ok
+
+    async def ping(self, sticky):
+        r = await self._aget(client.PingURL, self._getPingData(sticky))
+        return r.ok
+
+    async def _getSticky(self):
+        r = await self._aget(client.StickyURL, self._getStickyData())
+        r.raise_for_status()
+        return self._parseSticky(get_json(r.content))
+
+    async def _pullMessage(self, sticky, pool):
+        cycle = self._cycle if self.profiler is not None else None
+        if cycle is not None:
+            start = time.perf_counter()
+        r = await self._aget(client.StickyURL, self._getPullData(sticky, pool), retry_timeouts=False)
+        # Once the retries are exhausted, it's still an error response, which the listener must back off from
+        r.raise_for_status()
+        if cycle is not None:
+            pulled = time.perf_counter()
+            cycle['pull'] = pulled - start
+        if self.journal is not None:
+            self.journal.write(r.content)
+        if self.metrics is not None:
+            self.metrics.observePull()
+        j = get_json(r.content)
+        if cycle is not None:
+            cycle['decode'] = time.perf_counter() - pulled
+        return self._parsePull(j)
+
+    async def replay(self, journal, speed=None):
+        """See `Client.replay`"""
+        replayed = 0
+        previous = None
+        for timestamp, content in readJournal(getattr(journal, 'directory', journal)):
+            if speed is not None and previous is not None and timestamp > previous:
+                await asyncio.sleep((timestamp - previous) / speed)
+            previous = timestamp
+            # Only dispatched: the sticky parameters and `seq` of the recording aren't the ones of the live connection
+            self._parseMessage(get_json(content))
+            replayed += 1
+        return replayed
+
+    async def startListening(self):
+        """Start listening from an external event loop."""
+        self.listening = True
+        self.sticky, self.pool = await self._getSticky()
+
+    async def doOneListen(self, markAlive=True):
+        """Does one cycle of the listening loop.
+        This method is only useful if you want to control fbchat from an
+        external event loop."""
+        profiler = self.profiler
+        if profiler is not None:
+            self._cycle = cycle = {}
+            start = time.perf_counter()
+        try:
+            if markAlive: self._startPinging()
+            content = await self._pullMessage(self.sticky, self.pool)
+            self._listen_failures = 0
+            if content:
+                if profiler is not None:
+                    parsing = time.perf_counter()
+                self._parseMessage(content)
+                if profiler is not None:
+                    cycle['parse'] = time.perf_counter() - parsing
+                self._acknowledge(content)
+            if isinstance(self.event_executor, AsyncEventExecutor):
+                # Backpressure: don't fetch more events until there's room for them
+                if profiler is not None:
+                    draining = time.perf_counter()
+                await self.event_executor.drain()
+                if profiler is not None:
+                    cycle['drain'] = time.perf_counter() - draining
+            if profiler is not None:
+                cycle['cycle'] = time.perf_counter() - start
+                profiler.observeCycle(cycle)
+        except asyncio.TimeoutError:
+            pass
+        except (aiohttp.ClientError, CircuitOpenError) as e:
+            await asyncio.sleep(self._getListenBackoff(e))
+
+    def _startPinging(self):
+        """See `Client._startPinging`. The pings are sent by a task of the running event loop"""
+        if self._pinger is None or self._pinger.done():
+            self._pinger = asyncio.ensure_future(self._pingLoop())
+
+    def _stopPinging(self):
+        if self._pinger is not None:
+            self._pinger.cancel()
+            self._pinger = None
+
+    async def _pingLoop(self):
+        while True:
+            if self.sticky is not None:
+                try:
+                    start = time.perf_counter()
+                    await self.ping(self.sticky)
+                    if self.profiler is not None:
+                        self.profiler.observePhase('ping', time.perf_counter() - start)
+                except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+                    log.debug("Ping failed: %s", e)
+            await asyncio.sleep(self.ping_interval)
+
+    async def listen(self, markAlive=True):
+        await self.startListening()
+        self.onListening()
+
+        while self.listening:
+            await self.doOneListen(markAlive)
+
+        self.stopListening()
+
+    async def getUserInfo(self, *user_ids):
+        """See `Client.getUserInfo`"""
+        data = self._getUserInfoData(user_ids)
+        r = await self._apost(client.UserInfoURL, data)
+        return self._parseUserInfo(get_json(r.content))
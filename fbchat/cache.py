@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.cache
+    ~~~~~~~~~~~~
+
+    Caching of uploaded images, to avoid uploading the same image again
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from time import time
+from .multipart import CHUNK_SIZE
+
+
+def hashFile(f):
+    """Returns the SHA-256 hex digest of what's left to read in the file object `f`, and goes back to where it was"""
+    start = f.tell()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    f.seek(start)
+    return digest.hexdigest()
+
+
+class UploadCache(object):
+    """An LRU cache mapping the contents of uploaded images to the image_ids Facebook gave them,
+    so that sending the same image again doesn't need another upload.
+
+    Images downloaded from a URL are also cached by their URL, along with their ETag, so that
+    a conditional request is enough to know that the image hasn't changed.
+
+    It's thread-safe, and can be shared between clients of the same account.
+    """
+
+    def __init__(self, max_size=1024, ttl=24*60*60, path=None):
+        """
+        :param max_size: Maximum number of images to remember
+        :param ttl: Number of seconds after which an image_id is considered stale, or `None` to keep them forever
+        :param path: A JSON file to keep the cache in, so it survives restarts. If `None`, the cache is only kept in memory
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for key, entry in json.load(f):
+                    self._entries[key] = entry
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires'] is not None and entry['expires'] < time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def _set(self, key, image_id, etag=None):
+        with self._lock:
+            self._entries[key] = {
+                'image_id': image_id,
+                'etag': etag,
+                'expires': time() + self.ttl if self.ttl is not None else None,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            if self.path is not None:
+                self._save()
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, digest):
+        """Returns the image_id of the image with the SHA-256 hex digest `digest`, or `None` if it isn't cached"""
+        entry = self._get('sha256:' + digest)
+        return entry and entry['image_id']
+
+    def set(self, digest, image_id):
+        self._set('sha256:' + digest, image_id)
+
+    def getURL(self, url):
+        """Returns a tuple of the image_id and the ETag of the image last downloaded from `url`, or `None` if it isn't cached"""
+        entry = self._get('url:' + url)
+        return entry and (entry['image_id'], entry['etag'])
+
+    def setURL(self, url, image_id, etag):
+        self._set('url:' + url, image_id, etag)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.path is not None:
+                self._save()
+
+    def __len__(self):
+        return len(self._entries)
@@ -11,18 +11,27 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import re
 import requests
 import logging
-from uuid import uuid1
-import warnings
+import uuid
 from random import choice
 from datetime import datetime
-from bs4 import BeautifulSoup as bs
-from mimetypes import guess_type
 from .utils import *
 from .models import *
 import time
+import threading
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
 from .event_hook import EventHook
+from .scheduler import Priority
+from .retry import RetryPolicy, CircuitOpenError
+from .multipart import MultipartStream, CHUNK_SIZE
+from .cache import hashFile
+from .tokens import findInput, findInputs, findRevision
+from .journal import readJournal
+from .deltas import DELTA_HANDLERS, Deduplicator, findHandler, getMessageId
+from tempfile import SpooledTemporaryFile
 
 
 # Python 3 does not have raw_input, whereas Python 2 has and it's more secure
@@ -55,9 +64,25 @@ SaveDeviceURL="https://m.facebook.com/login/save-device/cancel/"
 CheckpointURL="https://m.facebook.com/login/checkpoint/"
 facebookEncoding = 'UTF-8'
 
+# Errors 1357001 (logged out) and 1357004 (outdated fb_dtsg), see `Client._isSessionExpired`
+_session_expired_re = re.compile(br'"error":\s*1357')
+
 # Log settings
 log = logging.getLogger("client")
-log.setLevel(logging.DEBUG)
+# The console handler shared by all the clients, see `_showLogs`
+_handler = None
+
+
+def _showLogs(level):
+    """Prints the logs of `level` and above on the console, with a single handler shared by all the clients.
+    The level of the logger is only ever lowered, so a client doesn't hide the logs another one asked for
+    """
+    global _handler
+    if _handler is None:
+        _handler = logging.StreamHandler()
+        log.addHandler(_handler)
+    if log.level == logging.NOTSET or level < log.level:
+        log.setLevel(level)
 
 
 class Client(object):
@@ -65,9 +90,16 @@ class Client(object):
 
     See http://github.com/carpedm20/fbchat for complete
     documentation for the API.
+
+    The client is thread-safe: messages can be sent from many threads at once
+    (e.g. from a `concurrent.futures.ThreadPoolExecutor`), while `listen` runs in another thread.
+    `__req` numbers are taken from a lock-free counter, the default payload is only ever
+    replaced as a whole, and logging in/out is serialized by a lock.
+    Set `max_connections` to at least the number of threads sending concurrently,
+    so that connections get reused instead of discarded.
     """
 
-    def __init__(self, email, password, debug=True, info_log=True, user_agent=None, max_retries=5, session_cookies=None):
+    def __init__(self, email, password, debug=True, info_log=True, user_agent=None, max_retries=5, session_cookies=None, max_connections=10, scheduler=None, retry_policy=None, upload_cache=None, snapshot=None, adapter=None, refresh_interval=None, ping_interval=60, event_executor=None, journal=None, metrics=None, profiler=None):
         """A client for the Facebook Chat (Messenger).
 
         :param email: Facebook `email` or `id` or `phone number`
@@ -77,11 +109,52 @@ class Client(object):
         :param user_agent: Custom user agent to use when sending requests. If `None`, user agent will be chosen from a premade list (see utils.py)
         :param max_retries: Maximum number of times to retry login
         :param session_cookies: Cookie dict from a previous session (Will default to login if these are invalid)
+        :param max_connections: Maximum number of connections to keep open per host
+        :param scheduler: An `OutboundScheduler` (or an object with the same `acquire` method) that outgoing posts must go through
+        :param retry_policy: The `RetryPolicy` used for requests. If `None`, a default one is used. Set `self.retry_policy` to `None` to disable retrying
+        :param upload_cache: An `UploadCache`, to avoid uploading the same images again
+        :param snapshot: A snapshot from `getSnapshot`, restored without any request. It's revalidated when Facebook rejects a request
+        :param adapter: A `requests` `HTTPAdapter`, to share its connections with other clients (see `ClientPool`). `max_connections` is then ignored
+        :param refresh_interval: If set, the session tokens are refreshed in a background thread when they're older than this many seconds,
+                                 see `startRefreshing`
+        :param ping_interval: Number of seconds between two presence pings while listening. They're sent in the background,
+                              so they don't delay the long-polls
+        :param event_executor: An `EventExecutor` (an `AsyncEventExecutor` for `AsyncClient`) to run the event handlers in,
+                               so that slow handlers don't delay the listener. See `setEventExecutor`
+        :param journal: A `PullJournal` to record the responses of the pull api in, see `replay`
+        :param metrics: A `Metrics` to record the requests and the messages received in, which can be shared with other clients.
+                        If `None`, nothing is measured
+        :param profiler: A `ListenProfiler` to record the phases of the listener and the duration of the event handlers in,
+                         see `setProfiler`
         """
 
         self.sticky, self.pool = (None, None)
-        self._session = requests.session()
-        self.req_counter = 1
+        self._lock = threading.RLock()
+        # Held while the session is fetched again (tokens, login), so only one thread does it at a time.
+        # Unlike `_lock`, it's held during requests, so the listener and the senders never wait for it
+        self._refresh_lock = threading.RLock()
+        self.max_connections = max_connections
+        self.adapter = adapter
+        self._session = self._newSession()
+        self._req_counter = count(1)
+        self.scheduler = scheduler
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._listen_failures = 0
+        self.upload_cache = upload_cache
+        self.email = email
+        self.password = password
+        # Incremented every time the session tokens change, see `_revalidateSession`
+        self._session_generation = 0
+        self._tokens_time = None
+        self.refresh_interval = refresh_interval
+        self._refresher = None
+        self.ping_interval = ping_interval
+        self.journal = journal
+        self.metrics = metrics
+        self.profiler = None
+        # The durations of the phases of the current cycle of the listener, while there's a profiler
+        self._cycle = None
+        self._pinger = None
         self.seq = "0"
         self.payloadDefault = {}
         self.client = 'mercury'
@@ -111,30 +184,46 @@ class Client(object):
 
         self.onUnknownMesssageType = EventHook(msg=dict)
 
-        # Setup event handlers
-        self.onLoggingIn += lambda email: log.info("Logging in %s..." % email)
-        self.onLoggedIn += lambda email: log.info("Login of %s successful." % email)
+        # How the messages received while listening are handled, see `registerDeltaHandler`
+        self._delta_handlers = dict(DELTA_HANDLERS)
+        #: Number of messages which couldn't be handled, by kind. See `fbchat.deltas.findHandler` for the kinds
+        self.parse_failures = {}
+        #: Skips the messages received twice, e.g. after reconnecting. Set it to `None` to handle all messages
+        self.deduplicator = Deduplicator()
+        #: Number of messages skipped by `deduplicator`
+        self.duplicates = 0
+
+        # Setup event handlers. The messages are only formatted if they're emitted
+        self.onLoggingIn += lambda email: log.info("Logging in %s...", email)
+        self.onLoggedIn += lambda email: log.info("Login of %s successful.", email)
         self.onListening += lambda: log.info("Listening...")
 
         self.onMessage += lambda mid, author_id, message, thread_id, thread_type, ts, metadata:\
-            log.info("Message from %s in %s (%s): %s" % (author_id, thread_id, thread_type.name, message))
+            log.info("Message from %s in %s (%s): %s", author_id, thread_id, thread_type.name, message)
 
         self.onColorChange += lambda mid, author_id, new_color, thread_id, thread_type, ts, metadata:\
-            log.info("Color change from %s in %s (%s): %s" % (author_id, thread_id, thread_type.name, new_color))
+            log.info("Color change from %s in %s (%s): %s", author_id, thread_id, thread_type.name, new_color)
         self.onEmojiChange += lambda mid, author_id, new_emoji, thread_id, thread_type, ts, metadata:\
-            log.info("Emoji change from %s in %s (%s): %s" % (author_id, thread_id, thread_type.name, new_emoji))
+            log.info("Emoji change from %s in %s (%s): %s", author_id, thread_id, thread_type.name, new_emoji)
         self.onTitleChange += lambda mid, author_id, new_title, thread_id, thread_type, ts, metadata:\
-            log.info("Title change from %s in %s (%s): %s" % (author_id, thread_id, thread_type.name, new_title))
+            log.info("Title change from %s in %s (%s): %s", author_id, thread_id, thread_type.name, new_title)
         self.onNicknameChange += lambda mid, author_id, new_title, changed_for, thread_id, thread_type, ts, metadata:\
-            log.info("Nickname change from %s in %s (%s) for %s: %s" % (author_id, thread_id, thread_type.name, changed_for, new_title))
+            log.info("Nickname change from %s in %s (%s) for %s: %s", author_id, thread_id, thread_type.name, changed_for, new_title)
 
         self.onPeopleAdded += lambda added_ids, author_id, thread_id:\
-            log.info("%s added: %s" % (author_id, [x for x in added_ids]))
+            log.info("%s added: %s", author_id, added_ids)
         self.onPersonRemoved += lambda removed_id, author_id, thread_id:\
-            log.info("%s removed: %s" % (author_id, removed_id))
+            log.info("%s removed: %s", author_id, removed_id)
 
         self.onUnknownMesssageType += lambda msg:\
-            log.info("Unknown message type received: %s" % msg)
+            log.info("Unknown message type received: %s", Truncated(msg))
+
+        for hook in vars(self).values():
+            if isinstance(hook, EventHook):
+                # The client always calls its hooks with the right arguments
+                hook.check_calls = False
+        self.setEventExecutor(event_executor)
+        self.setProfiler(profiler)
 
         if not user_agent:
             user_agent = choice(USER_AGENTS)
@@ -154,15 +243,24 @@ class Client(object):
             logging_level = logging.INFO
         else:
             logging_level = logging.WARNING
+        _showLogs(logging_level)
+
+        # A snapshot is trusted until a request fails, so restoring it doesn't need any request
+        if not snapshot or not self.setSnapshot(snapshot):
+            # If session cookies aren't set, not properly loaded or gives us an invalid session, then do the login
+            if not session_cookies or not self.setSession(session_cookies) or not self.isLoggedIn():
+                self.login(email, password, max_retries)
 
-        # Creates the console handler
-        handler = logging.StreamHandler()
-        handler.setLevel(logging_level)
-        log.addHandler(handler)
+        if refresh_interval is not None:
+            self.startRefreshing()
 
-        # If session cookies aren't set, not properly loaded or gives us an invalid session, then do the login
-        if not session_cookies or not self.setSession(session_cookies) or not self.isLoggedIn():
-            self.login(email, password, max_retries)
+    def _newSession(self):
+        """Creates a `requests` session, using `self.adapter` or a connection pool of `self.max_connections` per host"""
+        session = requests.session()
+        adapter = self.adapter or requests.adapters.HTTPAdapter(pool_maxsize=self.max_connections)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
 
     def _generatePayload(self, query):
         """Adds the following defaults to the payload:
@@ -171,78 +269,226 @@ class Client(object):
         payload = self.payloadDefault.copy()
         if query:
             payload.update(query)
-        payload['__req'] = str_base(self.req_counter, 36)
+        # `next` on an `itertools.count` is atomic, so no lock is needed here
+        payload['__req'] = str_base(next(self._req_counter), 36)
         payload['seq'] = self.seq
-        self.req_counter += 1
         return payload
 
-    def _get(self, url, query=None, timeout=30):
-        payload = self._generatePayload(query)
-        return self._session.get(url, headers=self._header, params=payload, timeout=timeout)
+    def _measured(self, send, url, **kwargs):
+        """Sends a request with `send`, and records it in `self.metrics`, if there's one"""
+        metrics = self.metrics
+        if metrics is None:
+            return send(url, **kwargs)
+        start = time.perf_counter()
+        try:
+            r = send(url, **kwargs)
+        except Exception as e:
+            metrics.observeRequest(url, type(e).__name__, time.perf_counter() - start)
+            raise
+        # Streamed bodies have no length, but they're only used for files
+        sent = int(r.request.headers.get('Content-Length') or 0)
+        metrics.observeRequest(url, r.status_code, time.perf_counter() - start, sent, len(r.content))
+        return r
 
-    def _post(self, url, query=None, timeout=30):
-        payload = self._generatePayload(query)
-        return self._session.post(url, headers=self._header, data=payload, timeout=timeout)
+    def _retry(self, send, url, retry_timeouts=False, **kwargs):
+        """Sends a request with `send`, retrying it on connection errors and server errors according to `self.retry_policy`
 
-    def _cleanGet(self, url, query=None, timeout=30):
-        return self._session.get(url, headers=self._header, params=query, timeout=timeout)
+        :param retry_timeouts: whether to retry it when it times out too. Only for requests which can safely be received twice
+        """
+        if self.retry_policy is None:
+            return self._measured(send, url, **kwargs)
+        if retry_timeouts:
+            exceptions = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        else:
+            exceptions = (requests.exceptions.ConnectionError,)
+        return self.retry_policy.call(url.split('?')[0], lambda: self._measured(send, url, **kwargs), exceptions)
 
-    def _cleanPost(self, url, query=None, timeout=30):
-        self.req_counter += 1
-        return self._session.post(url, headers=self._header, data=query, timeout=timeout)
+    def _isSessionExpired(self, r):
+        """Checks if Facebook rejected a request because we're logged out (1357001) or the fb_dtsg is outdated (1357004)"""
+        # The error is at the very start of the response, so there's no need to parse all of it
+        return _session_expired_re.search(r.content[:128]) is not None
 
-    def _postFile(self, url, files=None, timeout=30):
-        payload=self._generatePayload(None)
-        return self._session.post(url, data=payload, timeout=timeout, files=files)
+    def _revalidateSession(self, generation):
+        """Fetches new tokens, or logs in again if that's not enough, after the session was found to be expired
 
-    def _postLogin(self):
-        self.payloadDefault = {}
-        self.client_id = hex(int(random()*2147483648))[2:]
-        self.start_time = now()
-        self.uid = int(self._session.cookies['c_user'])
-        self.user_channel = "p_" + str(self.uid)
-        self.ttstamp = ''
-
-        r = self._get(BaseURL)
-        soup = bs(r.text, "lxml")
-        log.debug(r.text)
-        log.debug(r.url)
-        self.fb_dtsg = soup.find("input", {'name':'fb_dtsg'})['value']
-        self.fb_h = soup.find("input", {'name':'h'})['value']
-
-        for i in self.fb_dtsg:
-            self.ttstamp += str(ord(i))
-        self.ttstamp += '2'
-
-        # Set default payload
-        self.payloadDefault['__rev'] = int(r.text.split('"revision":',1)[1].split(",",1)[0])
-        self.payloadDefault['__user'] = self.uid
-        self.payloadDefault['__a'] = '1'
-        self.payloadDefault['ttstamp'] = self.ttstamp
-        self.payloadDefault['fb_dtsg'] = self.fb_dtsg
-
-        self.form = {
-            'channel' : self.user_channel,
-            'partition' : '-2',
-            'clientid' : self.client_id,
-            'viewer_uid' : self.uid,
-            'uid' : self.uid,
-            'state' : 'active',
-            'format' : 'json',
-            'idle' : 0,
-            'cap' : '8'
-        }
+        :param generation: the value of `self._session_generation` when the rejected request was sent.
+                           If it has changed since, another thread already revalidated the session
+        :return: whether the request should be sent again
+        """
+        with self._refresh_lock:
+            if generation != self._session_generation:
+                return True
+            try:
+                self._postLogin(keep_client_id=True)
+            except Exception as e:
+                log.debug('Could not refresh the session tokens: %s', e)
+                if not (self.email and self.password):
+                    return False
+                self.login(self.email, self.password)
+            return True
+
+    def startRefreshing(self, interval=None):
+        """Starts refreshing the session tokens in a background thread, whenever they're older than `interval` seconds,
+        so that requests don't have to wait for them to be fetched again after they expire.
+        The new tokens replace the old ones at once, so requests being sent keep working while they're fetched.
 
-        self.prev = now()
-        self.tmp_prev = now()
-        self.last_sync = now()
+        :param interval: the maximum age of the tokens, in seconds. Defaults to `self.refresh_interval`
+        """
+        if interval is not None:
+            self.refresh_interval = interval
+        if self.refresh_interval is None:
+            raise ValueError("The refresh interval must be set")
+        with self._lock:
+            if self._refresher is not None:
+                return
+            stop = threading.Event()
+            self._refresher = (threading.Thread(target=self._refreshLoop, args=(stop,), name='fbchat-refresher', daemon=True), stop)
+            self._refresher[0].start()
+
+    def stopRefreshing(self):
+        """Stops the thread started by `startRefreshing`"""
+        with self._lock:
+            if self._refresher is None:
+                return
+            thread, stop = self._refresher
+            self._refresher = None
+        stop.set()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def _refreshLoop(self, stop):
+        failures = 0
+        while True:
+            if failures:
+                delay = (self.retry_policy or RetryPolicy()).backoff(failures)
+            elif self._tokens_time is None:
+                delay = 0
+            else:
+                # The tokens might have been fetched again in the meantime, by `_revalidateSession`
+                delay = self._tokens_time + self.refresh_interval - time.monotonic()
+            if stop.wait(max(0, delay)):
+                return
+            if not failures and self._tokens_time is not None and time.monotonic() - self._tokens_time < self.refresh_interval:
+                continue
+
+            log.debug('Refreshing the session tokens')
+            try:
+                refreshed = self._revalidateSession(self._session_generation)
+            except Exception as e:
+                log.warning('Could not refresh the session tokens: %s', e)
+                refreshed = False
+            failures = 0 if refreshed else failures + 1
+
+    def _sessionRetry(self, request):
+        """Calls `request`, and calls it once more after revalidating the session if Facebook rejected it"""
+        generation = self._session_generation
+        r = request()
+        if self._isSessionExpired(r):
+            log.info('Session expired, revalidating it')
+            if self._revalidateSession(generation):
+                r = request()
+        return r
+
+    def _get(self, url, query=None, timeout=30, retry_timeouts=True):
+        return self._sessionRetry(lambda: self._retry(self._session.get, url, retry_timeouts, headers=self._header, params=self._generatePayload(query), timeout=timeout))
+
+    def _post(self, url, query=None, timeout=30, thread_id=None, priority=Priority.INTERACTIVE):
+        if self.scheduler is not None:
+            self.scheduler.acquire(thread_id, priority)
+        return self._sessionRetry(lambda: self._retry(self._session.post, url, headers=self._header, data=self._generatePayload(query), timeout=timeout))
+
+    def _cleanGet(self, url, query=None, timeout=30):
+        return self._measured(self._session.get, url, headers=self._header, params=query, timeout=timeout)
+
+    def _cleanPost(self, url, query=None, timeout=30):
+        next(self._req_counter)
+        return self._measured(self._session.post, url, headers=self._header, data=query, timeout=timeout)
+
+    def _postFile(self, url, files=None, timeout=30, priority=Priority.INTERACTIVE):
+        """Posts `files` as a streamed multipart body, see `MultipartStream` for their format.
+        Files which can't be rewound (e.g. a download in progress) can't be retried.
+        """
+        if self.scheduler is not None:
+            self.scheduler.acquire(None, priority)
+        body = MultipartStream(self._generatePayload(None), files)
+        headers = {'Content-Type': body.content_type}
+        if not body.rewindable:
+            return self._measured(self._session.post, url, headers=headers, data=body, timeout=timeout)
+
+        def send(url, **kwargs):
+            body.rewind()
+            return self._session.post(url, **kwargs)
+        return self._retry(send, url, headers=headers, data=body, timeout=timeout)
+
+    def _postLogin(self, keep_client_id=False):
+        """Fetches the session tokens from the home page, and sets them.
+        The current tokens keep being used by other threads until the new ones are set
+
+        :param keep_client_id: whether to keep the current client id, e.g. to not disturb the listener when refreshing the tokens
+        """
+        # No lock is held while the page is fetched and parsed, only `_setTokens` takes it to swap the tokens.
+        # Without the payload, since its tokens might be outdated
+        r = self._retry(self._session.get, BaseURL, True, headers=self._header, timeout=30)
+        # `r.text` decodes the page again every time it's used
+        text = r.text
+        log.debug('Fetched %s: %s', r.url, Truncated(text))
+        fb_dtsg = findInput(text, 'fb_dtsg')
+        fb_h = findInput(text, 'h')
+        revision = findRevision(text)
+        if fb_dtsg is None or fb_h is None or revision is None:
+            raise FBchatException('Could not find the session tokens in {}'.format(r.url))
+
+        ttstamp = ''
+        for i in fb_dtsg:
+            ttstamp += str(ord(i))
+        ttstamp += '2'
+
+        client_id = self.client_id if keep_client_id and self.payloadDefault else hex(int(random()*2147483648))[2:]
+        self._setTokens(client_id, fb_dtsg, fb_h, ttstamp, revision)
+
+    def _setTokens(self, client_id, fb_dtsg, fb_h, ttstamp, revision):
+        """Sets the tokens of a logged in session, fetched by `_postLogin` or restored by `setSnapshot`"""
+        with self._lock:
+            self.client_id = client_id
+            self.start_time = now()
+            self.uid = int(self._session.cookies['c_user'])
+            self.user_channel = "p_" + str(self.uid)
+            self.fb_dtsg = fb_dtsg
+            self.fb_h = fb_h
+            self.ttstamp = ttstamp
+
+            # Set default payload. It's replaced as a whole, so other threads never see a partial payload
+            self.payloadDefault = {
+                '__rev': revision,
+                '__user': self.uid,
+                '__a': '1',
+                'ttstamp': self.ttstamp,
+                'fb_dtsg': self.fb_dtsg,
+            }
+            self._session_generation += 1
+            self._tokens_time = time.monotonic()
+
+            self.form = {
+                'channel' : self.user_channel,
+                'partition' : '-2',
+                'clientid' : self.client_id,
+                'viewer_uid' : self.uid,
+                'uid' : self.uid,
+                'state' : 'active',
+                'format' : 'json',
+                'idle' : 0,
+                'cap' : '8'
+            }
+
+            self.prev = now()
+            self.tmp_prev = now()
+            self.last_sync = now()
 
     def _login(self):
         if not (self.email and self.password):
             raise Exception("Email and password not found.")
 
-        soup = bs(self._get(MobileURL).text, "lxml")
-        data = dict((elem['name'], elem['value']) for elem in soup.findAll("input") if elem.has_attr('value') and elem.has_attr('name'))
+        data = findInputs(self._get(MobileURL).text)
         data['email'] = self.email
         data['pass'] = self.password
         data['login'] = 'Log In'
@@ -264,13 +510,12 @@ class Client(object):
             return False
 
     def _2FA(self, r):
-        soup = bs(r.text, "lxml")
         data = dict()
 
         s = input('Please enter your 2FA code --> ')
         data['approvals_code'] = s
-        data['fb_dtsg'] = soup.find("input", {'name':'fb_dtsg'})['value']
-        data['nh'] = soup.find("input", {'name':'nh'})['value']
+        data['fb_dtsg'] = findInput(r.text, 'fb_dtsg')
+        data['nh'] = findInput(r.text, 'nh')
         data['submit[Submit Code]'] = 'Submit Code'
         data['codes_submitted'] = 0
         log.info('Submitting 2FA code.')
@@ -323,6 +568,33 @@ class Client(object):
         """Returns the session cookies"""
         return self._session.cookies.get_dict()
 
+    def getSnapshot(self):
+        """Returns a JSON serializable snapshot of the session, which `setSnapshot` can restore without any request"""
+        return {
+            'cookies': self.getSession(),
+            'fb_dtsg': self.fb_dtsg,
+            'fb_h': self.fb_h,
+            'ttstamp': self.ttstamp,
+            'revision': self.payloadDefault['__rev'],
+            'client_id': self.client_id,
+            'seq': self.seq,
+        }
+
+    def setSnapshot(self, snapshot):
+        """Restores a snapshot from `getSnapshot`, without checking that it's still valid.
+        If Facebook rejects a request because the session has expired, it's revalidated then.
+        :param snapshot: the snapshot to restore
+        Return false if the snapshot does not contain proper cookies
+        """
+        if 'c_user' not in snapshot.get('cookies', {}):
+            return False
+
+        with self._lock:
+            self._session.cookies = requests.cookies.merge_cookies(self._session.cookies, snapshot['cookies'])
+            self._setTokens(snapshot['client_id'], snapshot['fb_dtsg'], snapshot['fb_h'], snapshot['ttstamp'], snapshot['revision'])
+            self.seq = snapshot.get('seq', '0')
+        return True
+
     def setSession(self, session_cookies):
         """Loads session cookies
         :param session_cookies: dictionary containing session cookies
@@ -334,8 +606,10 @@ class Client(object):
             return False
 
         # Load cookies into current session
-        self._session.cookies = requests.cookies.merge_cookies(self._session.cookies, session_cookies)
-        self._postLogin()
+        with self._refresh_lock:
+            with self._lock:
+                self._session.cookies = requests.cookies.merge_cookies(self._session.cookies, session_cookies)
+            self._postLogin()
         return True
 
     def login(self, email, password, max_retries=5):
@@ -348,9 +622,11 @@ class Client(object):
         self.password = password
 
         for i in range(1, max_retries+1):
-            if not self._login():
-                log.warning("Attempt #{} failed{}".format(i, {True: ', retrying'}.get(i < 5, '')))
-                time.sleep(1)
+            with self._refresh_lock:
+                logged_in = self._login()
+            if not logged_in:
+                log.warning("Attempt #%d failed%s", i, ', retrying' if i < 5 else '')
+                time.sleep(self.retry_policy.backoff(i) if self.retry_policy is not None else 1)
                 continue
             else:
                 self.onLoggedIn(email=email)
@@ -364,13 +640,14 @@ class Client(object):
             'h': self.fb_h
         }
 
-        payload=self._generatePayload(data)
-        r = self._session.get(LogoutURL, headers=self._header, params=payload, timeout=timeout)
-        # reset value
-        self.payloadDefault={}
-        self._session = requests.session()
-        self.req_counter = 1
-        self.seq = "0"
+        self.stopRefreshing()
+        r = self._session.get(LogoutURL, headers=self._header, params=self._generatePayload(data), timeout=timeout)
+        with self._lock:
+            # reset value
+            self.payloadDefault={}
+            self._session = self._newSession()
+            self._req_counter = count(1)
+            self.seq = "0"
         return r
 
     def setDefaultThreadId(self, thread_id=str, thread_type=ThreadType):
@@ -390,9 +667,9 @@ class Client(object):
             'viewer': self.uid,
         }
         r = self._post(AllUsersURL, query=data)
-        if not r.ok or len(r.text) == 0:
+        if not r.ok or len(r.content) == 0:
             return None
-        j = get_json(r.text)
+        j = get_json(r.content)
         if not j['payload']:
             return None
         payload = j['payload']
@@ -420,11 +697,11 @@ class Client(object):
             'rsp' : "search",
             'context' : "search",
             'path' : "/home.php",
-            'request_id' : str(uuid1()),
+            'request_id' : str(uuid.uuid1()),
         }
 
         r = self._get(SearchURL, payload)
-        self.j = j = get_json(r.text)
+        self.j = j = get_json(r.content)
 
         users = []
         for entry in j['payload']['entries']:
@@ -436,33 +713,15 @@ class Client(object):
     SEND METHODS
     """
 
-    def _send(self, thread_id=None, message=None, thread_type=None, emoji_size=None, image_id=None, add_user_ids=None, new_title=None):
-        """Send a message with given thread id
-
-        :param thread_id: the user id or thread id that you want to send a message to
-        :param message: a text that you want to send
-        :param thread_type: determines if the recipient_id is for user or thread
-        :param emoji_size: size of the like sticker you want to send
-        :param image_id: id for the image to send, gotten from the UploadURL
-        :param add_user_ids: a list of user ids to add to a chat
-        :return: a list of message ids of the sent message(s)
+    def _getBaseSendData(self, emoji_size=None, image_id=None, add_user_ids=None, new_title=None):
+        """Returns the part of the data for `SendURL`, which doesn't depend on the recipient or the message text.
+        It can be reused for many messages, see `_getMessageSendData`
         """
 
-        if thread_id is None and self.is_def_thread_set:
-            thread_id = self.def_thread_id
-            thread_type = self.def_thread_type
-        elif thread_id is None and not self.is_def_thread_set:
-            raise ValueError('Default Thread ID is not set.')
-
-        messageAndOTID = generateOfflineThreadingID()
-        timestamp = now()
-        date = datetime.now()
         data = {
             'client': self.client,
             'author' : 'fbid:' + str(self.uid),
-            'timestamp' : timestamp,
             'timestamp_absolute' : 'Today',
-            'timestamp_relative' : str(date.hour) + ":" + str(date.minute).zfill(2),
             'timestamp_time_passed' : '0',
             'is_unread' : False,
             'is_cleared' : False,
@@ -478,20 +737,10 @@ class Client(object):
             'html_body' : False,
             'ui_push_phase' : 'V3',
             'status' : '0',
-            'offline_threading_id':messageAndOTID,
-            'message_id' : messageAndOTID,
-            'threading_id': generateMessageID(self.client_id),
             'ephemeral_ttl_mode:': '0',
             'manual_retry_cnt' : '0',
-            'signatureID' : getSignatureID()
         }
 
-        # Set recipient
-        if thread_type == ThreadType.USER:
-            data["other_user_fbid"] = thread_id
-        elif thread_type == ThreadType.GROUP:
-            data["thread_fbid"] = thread_id
-
         # Set title
         if new_title:
             data['action_type'] = 'ma-type:log-message'
@@ -509,47 +758,163 @@ class Client(object):
         # Sending a simple message
         if not add_user_ids and not new_title:
             data['action_type'] = 'ma-type:user-generated-message'
-            data['body'] = message or ''
             data['has_attachment'] = image_id is not None
-            data['specific_to_list[0]'] = 'fbid:' + str(thread_id)
             data['specific_to_list[1]'] = 'fbid:' + str(self.uid)
 
-        # Set image to send
+        # Set images to send
         if image_id:
-            data['image_ids[0]'] = image_id
+            image_ids = image_id if isinstance(image_id, (list, tuple)) else [image_id]
+            for i, _image_id in enumerate(image_ids):
+                data['image_ids[%d]' % i] = _image_id
 
         # Set emoji to send
         if emoji_size:
             data["sticker_id"] = emoji_size.value
 
-        r = self._post(SendURL, data)
-        
-        if not r.ok:
-            log.warning('Error when sending message: Got {} response'.format(r.status_code))
-            return False
+        return data
+
+    def _getMessageSendData(self, base_data, message=None, thread_id=None, thread_type=None):
+        """Returns a copy of `base_data` from `_getBaseSendData`, completed with the recipient,
+        the message text and the ids identifying this message
+        """
+
+        if thread_id is None and self.is_def_thread_set:
+            thread_id = self.def_thread_id
+            thread_type = self.def_thread_type
+        elif thread_id is None and not self.is_def_thread_set:
+            raise ValueError('Default Thread ID is not set.')
+
+        messageAndOTID = generateOfflineThreadingID()
+        date = datetime.now()
+        data = base_data.copy()
+        data['timestamp'] = now()
+        data['timestamp_relative'] = str(date.hour) + ":" + str(date.minute).zfill(2)
+        data['offline_threading_id'] = messageAndOTID
+        data['message_id'] = messageAndOTID
+        data['threading_id'] = generateMessageID(self.client_id)
+        data['signatureID'] = getSignatureID()
+
+        # Set recipient
+        if thread_type == ThreadType.USER:
+            data["other_user_fbid"] = thread_id
+        elif thread_type == ThreadType.GROUP:
+            data["thread_fbid"] = thread_id
+
+        # Sending a simple message
+        if data['action_type'] == 'ma-type:user-generated-message':
+            data['body'] = message or ''
+            data['specific_to_list[0]'] = 'fbid:' + str(thread_id)
+
+        return data
+
+    def _getSendData(self, thread_id=None, message=None, thread_type=None, emoji_size=None, image_id=None, add_user_ids=None, new_title=None):
+        """Returns the data needed to send a message to `SendURL`. See `_send` for the parameters."""
+        base_data = self._getBaseSendData(emoji_size, image_id, add_user_ids, new_title)
+        return self._getMessageSendData(base_data, message, thread_id, thread_type)
 
-        response_content = {}
-        if isinstance(r.content, str) is False:
-            response_content = r.content.decode(facebookEncoding)
-        j = get_json(response_content)
+    def _parseSendResponse(self, content):
+        """Parses the response from `SendURL`
+
+        :param content: the response body
+        :return: a list of message ids of the sent message(s)
+        :raises: FBchatException if sending failed
+        """
+        j = get_json(content)
         if 'error' in j:
             # 'errorDescription' is in the users own language!
-            log.warning('Error #{} when sending message: {}'.format(j['error'], j['errorDescription']))
-            return False
-        
-        message_ids = []
+            raise FBchatException('Error #{} when sending message: {}'.format(j['error'], j['errorDescription']))
+
         try:
-            message_ids += [action['message_id'] for action in j['payload']['actions'] if 'message_id' in action]
-            message_ids[0] # Try accessing element
-        except (KeyError, IndexError) as e:
-            log.warning('Error when sending message: No message ids could be found')
-            return False
+            message_ids = [action['message_id'] for action in j['payload']['actions'] if 'message_id' in action]
+        except (KeyError, TypeError):
+            raise FBchatException('Error when sending message: Unexpected response {}'.format(Truncated(j)))
+        if not message_ids:
+            raise FBchatException('Error when sending message: No message ids could be found')
 
         log.info('Message sent.')
-        log.debug("Sending {}".format(r))
-        log.debug("With data {}".format(data))
         return message_ids
 
+    def _sendData(self, data, priority=Priority.INTERACTIVE):
+        """Posts data from `_getSendData` to `SendURL`
+
+        :param priority: the lane of the scheduler to send the message in
+        :return: a list of message ids of the sent message(s)
+        :raises: FBchatException if sending failed
+        """
+        thread_id = data.get('other_user_fbid') or data.get('thread_fbid')
+        r = self._post(SendURL, data, thread_id=thread_id, priority=priority)
+
+        if not r.ok:
+            raise FBchatException('Error when sending message: Got {} response'.format(r.status_code))
+
+        message_ids = self._parseSendResponse(r.content)
+        log.debug("Sending %s with data %s", r, Truncated(data))
+        return message_ids
+
+    def _send(self, thread_id=None, message=None, thread_type=None, emoji_size=None, image_id=None, add_user_ids=None, new_title=None):
+        """Send a message with given thread id
+
+        :param thread_id: the user id or thread id that you want to send a message to
+        :param message: a text that you want to send
+        :param thread_type: determines if the recipient_id is for user or thread
+        :param emoji_size: size of the like sticker you want to send
+        :param image_id: id for the image to send, gotten from the UploadURL, or a list of ids to send many images
+        :param add_user_ids: a list of user ids to add to a chat
+        :return: a list of message ids of the sent message(s)
+        """
+
+        data = self._getSendData(thread_id, message, thread_type, emoji_size, image_id, add_user_ids, new_title)
+        try:
+            return self._sendData(data)
+        except FBchatException as e:
+            log.warning("%s", e)
+            return False
+
+    def _sendMany(self, base_data, batch, max_concurrency):
+        """Posts the messages of `batch` to `SendURL`, with at most `max_concurrency` requests at once.
+        A failing message, including one whose data can't be built, doesn't stop the others from being sent.
+
+        :param base_data: data from `_getBaseSendData`, shared by the messages
+        :param batch: an iterable of (message, thread_id, thread_type) tuples
+        :return: a list with, for each item in `batch`, either a list of message ids, or the raised exception
+        """
+        def send(item):
+            try:
+                message, thread_id, thread_type = item
+                return self._sendData(self._getMessageSendData(base_data, message, thread_id, thread_type), Priority.BULK)
+            except Exception as e:
+                log.warning("%s", e)
+                return e
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            return list(executor.map(send, batch))
+
+    def sendMessages(self, batch, max_concurrency=8):
+        """
+        Sends many messages concurrently, over the connection pool of the session.
+        Use a `max_connections` of at least `max_concurrency` when creating the client.
+        If the client has a scheduler, the messages are sent in its `Priority.BULK` lane.
+        :param batch: an iterable of (message, thread_id, thread_type) tuples
+        :param max_concurrency: maximum number of messages being sent at once
+        :return: a list with, for each message in `batch`, either a list of message ids of the sent message(s),
+                 or the exception that was raised when sending it
+        """
+        return self._sendMany(self._getBaseSendData(), batch, max_concurrency)
+
+    def broadcastMessage(self, message: str, thread_ids: list, thread_type: ThreadType = ThreadType.USER, max_concurrency=8):
+        """
+        Sends the same message to many threads concurrently. See `sendMessages`
+        :param message: message to send
+        :param thread_ids: list of user/group chat IDs
+        :param thread_type: specify whether the thread_ids are users or group chats
+        :param max_concurrency: maximum number of messages being sent at once
+        :return: a dict mapping each thread ID to either a list of message ids of the sent message(s),
+                 or the exception that was raised when sending it
+        """
+        thread_ids = list(thread_ids)
+        results = self.sendMessages([(message, thread_id, thread_type) for thread_id in thread_ids], max_concurrency)
+        return dict(zip(thread_ids, results))
+
     def sendMessage(self, message: str, thread_id: str = None, thread_type: ThreadType = None):
         """
         Sends a message to given (or default, if not) thread with an additional image.
@@ -579,24 +944,48 @@ class Client(object):
         :param thread_type: specify whether thread_id is user or group chat 
         :return: a list of message ids of the sent message(s)
         """
-        mimetype = guess_type(image_url)[0]
-        remote_image = requests.get(image_url).content
-        image_id = self._uploadImage({'file': (image_url, remote_image, mimetype)})
+        image_id = self._uploadRemoteImage(image_url)
+        return self._send(thread_id, message, thread_type, None, image_id, None, None)
+
+    def sendLocalImage(self, image_path: str, message: str = None, thread_id: str = None, thread_type: ThreadType = None):
+        """
+        Sends an image from given path to given (or default, if not) thread.
+        :param image_path: path of an image to upload and send
+        :param message: additional message
+        :param thread_id: user/group chat ID
+        :param thread_type: specify whether thread_id is user or group chat
+        :return: a list of message ids of the sent message(s)
+        """
+        image_id = self._uploadLocalImage(image_path)
         return self._send(thread_id, message, thread_type, None, image_id, None, None)
 
-    # Doesn't upload properly
-    # def sendLocalImage(self, image_path: str, message: str = None, thread_id: str = None, thread_type: ThreadType = None):
-    #     """
-    #     Sends an image from given URL to given (or default, if not) thread.
-    #     :param image_path: path of an image to upload and send
-    #     :param message: additional message
-    #     :param thread_id: user/group chat ID
-    #     :param thread_type: specify whether thread_id is user or group chat
-    #     :return: a list of message ids of the sent message(s)
-    #     """
-    #     mimetype = guess_type(image_path)[0]
-    #     image_id = self._uploadImage({'file': (image_path, open(image_path, 'rb'), mimetype)})
-    #     return self._send(thread_id, message, thread_type, None, image_id, None, None)
+    def sendRemoteImages(self, image_urls: list, message: str = None, thread_id: str = None, thread_type: ThreadType = None, max_concurrency=4):
+        """
+        Sends images from given URLs in a single message to given (or default, if not) thread.
+        The images are uploaded concurrently.
+        :param image_urls: URLs of the images to upload and send
+        :param message: additional message
+        :param thread_id: user/group chat ID
+        :param thread_type: specify whether thread_id is user or group chat
+        :param max_concurrency: maximum number of images being uploaded at once
+        :return: a list of message ids of the sent message(s)
+        """
+        image_ids = self._uploadImages(self._uploadRemoteImage, image_urls, max_concurrency)
+        return self._send(thread_id, message, thread_type, None, image_ids, None, None)
+
+    def sendLocalImages(self, image_paths: list, message: str = None, thread_id: str = None, thread_type: ThreadType = None, max_concurrency=4):
+        """
+        Sends images from given paths in a single message to given (or default, if not) thread.
+        The images are uploaded concurrently.
+        :param image_paths: paths of the images to upload and send
+        :param message: additional message
+        :param thread_id: user/group chat ID
+        :param thread_type: specify whether thread_id is user or group chat
+        :param max_concurrency: maximum number of images being uploaded at once
+        :return: a list of message ids of the sent message(s)
+        """
+        image_ids = self._uploadImages(self._uploadLocalImage, image_paths, max_concurrency)
+        return self._send(thread_id, message, thread_type, None, image_ids, None, None)
 
     def addUsersToChat(self, user_list: list, thread_id: str = None):
         """
@@ -649,15 +1038,63 @@ class Client(object):
     def _uploadImage(self, image):
         """Upload an image and get the image_id for sending in a message
 
-        :param image: a tuple of (file name, data, mime type) to upload to facebook
+        :param image: a dict mapping 'file' to a (file name, data, mime type) tuple to upload to facebook, see `MultipartStream`
         """
 
         r = self._postFile(UploadURL, image)
-        response_content = {}
-        if isinstance(r.content, str) is False:
-            response_content = r.content.decode(facebookEncoding)
-        # Strip the start and parse out the returned image_id
-        return json.loads(response_content[9:])['payload']['metadata'][0]['image_id']
+        return self._parseUploadResponse(r.content)
+
+    def _uploadImages(self, upload, sources, max_concurrency):
+        """Calls `upload` on each of `sources` concurrently, and returns the image_ids in the same order"""
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            return list(executor.map(upload, sources))
+
+    def _uploadCachedImage(self, name, f, mimetype):
+        """Uploads the file object `f`, unless an image with the same content is in `self.upload_cache`, and returns its image_id"""
+        digest = hashFile(f)
+        image_id = self.upload_cache.get(digest)
+        if image_id is None:
+            image_id = self._uploadImage({'file': (name, f, mimetype)})
+            self.upload_cache.set(digest, image_id)
+        return image_id
+
+    def _uploadRemoteImage(self, image_url):
+        """Streams an image from `image_url` to `UploadURL`, without loading it in memory, and returns its image_id"""
+        mimetype = guess_mimetype(image_url)
+        cached = self.upload_cache.getURL(image_url) if self.upload_cache is not None else None
+        headers = {'If-None-Match': cached[1]} if cached else None
+
+        with requests.get(image_url, stream=True, headers=headers) as r:
+            if cached and r.status_code == 304:
+                return cached[0]
+            r.raise_for_status()
+            r.raw.decode_content = True
+            if self.upload_cache is None:
+                # The Content-Length is the size of the encoded content, which isn't what's read from `r.raw`
+                size = None if 'Content-Encoding' in r.headers else r.headers.get('Content-Length')
+                return self._uploadImage({'file': (image_url, r.raw, mimetype, size and int(size))})
+
+            # The image must be hashed before it's uploaded, so keep it on disk if it's large
+            with SpooledTemporaryFile(max_size=1024*1024) as f:
+                for chunk in iter(lambda: r.raw.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+                f.seek(0)
+                image_id = self._uploadCachedImage(image_url, f, mimetype)
+            if r.headers.get('ETag'):
+                self.upload_cache.setURL(image_url, image_id, r.headers['ETag'])
+            return image_id
+
+    def _uploadLocalImage(self, image_path):
+        """Streams the image at `image_path` to `UploadURL`, without loading it in memory, and returns its image_id"""
+        mimetype = guess_mimetype(image_path)
+        with open(image_path, 'rb') as f:
+            if self.upload_cache is not None:
+                return self._uploadCachedImage(image_path, f, mimetype)
+            return self._uploadImage({'file': (image_path, f, mimetype)})
+
+    def _parseUploadResponse(self, content):
+        """Parses out the returned image_id from the response of `UploadURL`"""
+        return get_json(content)['payload']['metadata'][0]['image_id']
 
     def getThreadInfo(self, userID, last_n=20, start=None, is_user=True):
         """Get the info of one Thread
@@ -668,6 +1105,16 @@ class Client(object):
         :param is_user: (optional) determines if the userID is for user or thread
         """
 
+        data = self._getThreadInfoData(userID, last_n, start, is_user)
+        r = self._post(MessagesURL, query=data)
+        if not r.ok or len(r.content) == 0:
+            return None
+
+        return self._parseThreadInfo(get_json(r.content))
+
+    def _getThreadInfoData(self, userID, last_n=20, start=None, is_user=True):
+        """Returns the data needed to query `MessagesURL`. See `getThreadInfo` for the parameters."""
+
         assert last_n > 0, 'length must be positive integer, got %d' % last_n
         assert start is None, '`start` is deprecated, always 0 offset querry is returned'
         if is_user:
@@ -681,12 +1128,11 @@ class Client(object):
         data = {'messages[{}][{}][offset]'.format(key, userID): 0,
                 'messages[{}][{}][limit]'.format(key, userID): last_n - 1,
                 'messages[{}][{}][timestamp]'.format(key, userID): now()}
+        return data
 
-        r = self._post(MessagesURL, query=data)
-        if not r.ok or len(r.text) == 0:
-            return None
+    def _parseThreadInfo(self, j):
+        """Parses the messages from the response of `MessagesURL`"""
 
-        j = get_json(r.text)
         if not j['payload']:
             return None
 
@@ -702,27 +1148,34 @@ class Client(object):
         :param length: (optional) the length of a thread
         """
 
+        data = self._getThreadListData(start, length)
+        r = self._post(ThreadsURL, data)
+        if not r.ok or len(r.content) == 0:
+            return None
+
+        return self._parseThreadList(get_json(r.content))
+
+    def _getThreadListData(self, start, length=20):
+        """Returns the data needed to query `ThreadsURL`. See `getThreadList` for the parameters."""
+
         assert length < 21, '`length` is deprecated, max. last 20 threads are returned'
 
-        data = {
+        return {
             'client' : self.client,
             'inbox[offset]' : start,
             'inbox[limit]' : length,
         }
 
-        r = self._post(ThreadsURL, data)
-        if not r.ok or len(r.text) == 0:
-            return None
-
-        j = get_json(r.text)
+    def _parseThreadList(self, j):
+        """Parses the response of `ThreadsURL`, and adds the new threads to `self.threads`"""
 
         # Get names for people
         participants = {}
         try:
             for participant in j['payload']['participants']:
                 participants[participant["fbid"]] = participant["name"]
-        except Exception as e:
-            log.warning(str(j))
+        except Exception:
+            log.warning("Could not read the participants of %s", Truncated(j))
 
         # Prevent duplicates in self.threads
         threadIDs = [getattr(x, "thread_id") for x in self.threads]
@@ -746,10 +1199,10 @@ class Client(object):
         }
 
         r = self._post(ThreadSyncURL, form)
-        if not r.ok or len(r.text) == 0:
+        if not r.ok or len(r.content) == 0:
             return None
 
-        j = get_json(r.text)
+        j = get_json(r.content)
         result = {
             "message_counts": j['payload']['message_counts'],
             "unseen_threads": j['payload']['unseen_thread_ids']
@@ -766,15 +1219,16 @@ class Client(object):
         return r.ok
 
     def markAsRead(self, userID):
-        data = {
+        r = self._post(ReadStatusURL, self._getMarkAsReadData(userID))
+        return r.ok
+
+    def _getMarkAsReadData(self, userID):
+        return {
             "watermarkTimestamp": now(),
             "shouldSendReadReceipt": True,
             "ids[%s]" % userID: True
         }
 
-        r = self._post(ReadStatusURL, data)
-        return r.ok
-
     def markAsSeen(self):
         r = self._post(MarkSeenURL, {"seen_timestamp": 0})
         return r.ok
@@ -790,7 +1244,11 @@ class Client(object):
         return r.ok
 
     def ping(self, sticky):
-        data = {
+        r = self._get(PingURL, self._getPingData(sticky))
+        return r.ok
+
+    def _getPingData(self, sticky):
+        return {
             'channel': self.user_channel,
             'clientid': self.client_id,
             'partition': -2,
@@ -799,20 +1257,23 @@ class Client(object):
             'sticky': sticky,
             'viewer_uid': self.uid
         }
-        r = self._get(PingURL, data)
-        return r.ok
 
     def _getSticky(self):
         """Call pull api to get sticky and pool parameter, newer api needs these parameter to work."""
 
-        data = {
+        r = self._get(StickyURL, self._getStickyData())
+        r.raise_for_status()
+        return self._parseSticky(get_json(r.content))
+
+    def _getStickyData(self):
+        return {
             "msgs_recv": 0,
             "channel": self.user_channel,
             "clientid": self.client_id
         }
 
-        r = self._get(StickyURL, data)
-        j = get_json(r.text)
+    def _parseSticky(self, j):
+        """Returns the sticky and pool parameters from the response of `StickyURL`"""
 
         if 'lb_info' not in j:
             raise Exception('Get sticky pool error')
@@ -824,20 +1285,90 @@ class Client(object):
     def _pullMessage(self, sticky, pool):
         """Call pull api with seq value to get message data."""
 
-        data = {
+        cycle = self._cycle if self.profiler is not None else None
+        if cycle is not None:
+            start = time.perf_counter()
+        # The long-poll times out when there's nothing new, that's handled by the listener
+        r = self._get(StickyURL, self._getPullData(sticky, pool), retry_timeouts=False)
+        # Once the retries are exhausted, it's still an error response, which the listener must back off from
+        r.raise_for_status()
+        if cycle is not None:
+            pulled = time.perf_counter()
+            cycle['pull'] = pulled - start
+        if self.journal is not None:
+            self.journal.write(r.content)
+        if self.metrics is not None:
+            self.metrics.observePull()
+        j = get_json(r.content)
+        if cycle is not None:
+            cycle['decode'] = time.perf_counter() - pulled
+        return self._parsePull(j)
+
+    def _getPullData(self, sticky, pool):
+        return {
             "msgs_recv": 0,
             "sticky_token": sticky,
             "sticky_pool": pool,
             "clientid": self.client_id,
         }
 
-        r = self._get(StickyURL, data)
-        r.encoding = facebookEncoding
-        j = get_json(r.text)
+    def _parsePull(self, j):
+        """Updates the sticky parameters if they changed, from a response of the pull api, and returns it.
+        `self.seq` is only updated by `_acknowledge`, once the messages are handled
+        """
 
-        self.seq = j.get('seq', '0')
+        if 'lb_info' in j:
+            self.sticky, self.pool = self._parseSticky(j)
         return j
 
+    def _acknowledge(self, content):
+        """Moves `self.seq` past the messages of a response of the pull api, once they're handled.
+        The pull api is called with the last acknowledged `seq`, so after reconnecting, the listener resumes there
+        """
+
+        # Heartbeats don't always have a seq, which doesn't mean that it went back to 0
+        if content.get('seq') is not None:
+            self.seq = content['seq']
+
+    def setEventExecutor(self, executor):
+        """Runs the handlers of all the events of the client with `executor`, or in the listener if it's `None`.
+        Events of the same thread are handled in the order they were received.
+
+        :param executor: an `EventExecutor`, or an `AsyncEventExecutor` for `AsyncClient`
+        """
+        self.event_executor = executor
+        if executor is not None:
+            executor.profiler = self.profiler
+        for hook in vars(self).values():
+            if isinstance(hook, EventHook):
+                hook.executor = executor
+
+    def setProfiler(self, profiler):
+        """Records the phases of the cycles of the listener, the lag of the events and the duration of the event handlers
+        with `profiler`, or stops recording them if it's `None`
+
+        :param profiler: a `ListenProfiler`. It can be shared with other clients
+        """
+        self.profiler = profiler
+        if self.event_executor is not None:
+            self.event_executor.profiler = profiler
+        for hook in vars(self).values():
+            if isinstance(hook, EventHook):
+                hook.profiler = profiler
+
+    def registerDeltaHandler(self, mtype, key, handler):
+        """Handles the messages received while listening of type `mtype` with `handler`,
+        instead of the default handler (see `fbchat.deltas.DELTA_HANDLERS`) or `onUnknownMesssageType`
+
+        :param mtype: the type of the messages, e.g. 'delta'
+        :param key: for deltas, their `type` or their `class`. `None` for other messages
+        :param handler: a function called with the client and the message, or `None` to remove a handler
+        """
+        if handler is None:
+            self._delta_handlers.pop((mtype, key), None)
+        else:
+            self._delta_handlers[(mtype, key)] = handler
+
     def _parseMessage(self, content):
         """Get message and author name from content.
         May contains multiple messages in the content.
@@ -845,135 +1376,52 @@ class Client(object):
 
         if 'ms' not in content: return
 
-        log.debug("Received {}".format(content["ms"]))
+        log.debug("Received %d messages: %s", len(content["ms"]), Truncated(content["ms"]))
+        handlers = self._delta_handlers
+        deduplicator = self.deduplicator
+        metrics = self.metrics
+        profiler = self.profiler
+        # Counted for the whole response, and then added to `metrics` at once
+        events, failures, duplicates = {}, {}, 0
         for m in content["ms"]:
-            mtype = m.get("type")
+            if deduplicator is not None:
+                mid = getMessageId(m)
+                if mid is not None and deduplicator.seen(mid):
+                    duplicates += 1
+                    continue
+            key, handler = findHandler(handlers, m)
+            if metrics is not None:
+                events[key] = events.get(key, 0) + 1
+            if profiler is not None:
+                profiler.observeLag(m)
             try:
-                # Things that directly change chat
-                if mtype == "delta":
-
-                    def getThreadIdAndThreadType(msg_metadata):
-                        """Returns a tuple consisting of thread id and thread type"""
-                        id_thread = None
-                        type_thread = None
-                        if 'threadFbId' in msg_metadata['threadKey']:
-                            id_thread = str(msg_metadata['threadKey']['threadFbId'])
-                            type_thread = ThreadType.GROUP
-                        elif 'otherUserFbId' in msg_metadata['threadKey']:
-                            id_thread = str(msg_metadata['threadKey']['otherUserFbId'])
-                            type_thread = ThreadType.USER
-                        return id_thread, type_thread
-
-                    delta = m["delta"]
-                    delta_type = delta.get("type")
-                    metadata = delta.get("messageMetadata")
-
-                    if metadata is not None:
-                        mid = metadata["messageId"]
-                        author_id = str(metadata['actorFbId'])
-                        ts = int(metadata["timestamp"])
-
-                    # Added participants
-                    if 'addedParticipants' in delta:
-                        added_ids = [str(x['userFbId']) for x in delta['addedParticipants']]
-                        thread_id = str(metadata['threadKey']['threadFbId'])
-                        self.onPeopleAdded(mid=mid, added_ids=added_ids, author_id=author_id, thread_id=thread_id, ts=ts)
-                        continue
-
-                    # Left/removed participants
-                    elif 'leftParticipantFbId' in delta:
-                        removed_id = str(delta['leftParticipantFbId'])
-                        thread_id = str(metadata['threadKey']['threadFbId'])
-                        self.onPersonRemoved(mid=mid, removed_id=removed_id, author_id=author_id, thread_id=thread_id, ts=ts)
-                        continue
-
-                    # Color change
-                    elif delta_type == "change_thread_theme":
-                        new_color = delta["untypedData"]["theme_color"]
-                        thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onColorChange(mid=mid, author_id=author_id, new_color=new_color, thread_id=thread_id,
-                                           thread_type=thread_type, ts=ts, metadata=metadata)
-                        continue
-
-                    # Emoji change
-                    elif delta_type == "change_thread_icon":
-                        new_emoji = delta["untypedData"]["thread_icon"]
-                        thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onEmojiChange(mid=mid, author_id=author_id, new_emoji=new_emoji, thread_id=thread_id,
-                                           thread_type=thread_type, ts=ts, metadata=metadata)
-                        continue
-
-                    # Thread title change
-                    elif delta.get("class") == "ThreadName":
-                        new_title = delta["name"]
-                        thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onTitleChange(mid=mid, author_id=author_id, new_title=new_title, thread_id=thread_id,
-                                           thread_type=thread_type, ts=ts, metadata=metadata)
-                        continue
-
-                    # Nickname change
-                    elif delta_type == "change_thread_nickname":
-                        changed_for = str(delta["untypedData"]["participant_id"])
-                        new_title = delta["untypedData"]["nickname"]
-                        thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onNicknameChange(mid=mid, author_id=author_id, changed_for=changed_for, new_title=new_title,
-                                              thread_id=thread_id, thread_type=thread_type, ts=ts, metadata=metadata)
-                        continue
-
-
-                    # TODO properly implement these as they differ on different scenarios
-                    # Seen
-                    # elif delta.get("class") == "ReadReceipt":
-                    #     seen_by = delta["actorFbId"] or delta["threadKey"]["otherUserFbId"]
-                    #     thread_id = delta["threadKey"].get("threadFbId")
-                    #     self.onSeen(seen_by=seen_by, thread_id=thread_id, ts=ts)
-                    #
-                    # # Message delivered
-                    # elif delta.get("class") == 'DeliveryReceipt':
-                    #     time_delivered = delta['deliveredWatermarkTimestampMs']
-                    #     self.onDelivered()
-
-                    # New message
-                    elif delta.get("class") == "NewMessage":
-                        message = delta.get('body', '')
-                        thread_id, thread_type = getThreadIdAndThreadType(metadata)
-                        self.onMessage(mid=mid, author_id=author_id, message=message,
-                                       thread_id=thread_id, thread_type=thread_type, ts=ts, metadata=m)
-                        continue
-
-                # Inbox
-                if mtype == "inbox":
-                    self.onInbox(unseen=m["unseen"], unread=m["unread"], recent_unread=m["recent_unread"])
-
-                # Typing
-                # elif mtype == "typ":
-                #     author_id = str(m.get("from"))
-                #     typing_status = TypingStatus(m.get("st"))
-                #     self.onTyping(author_id=author_id, typing_status=typing_status)
-
-                # Seen
-                # elif mtype == "m_read_receipt":
-                #
-                #     self.onSeen(m.get('realtime_viewer_fbid'), m.get('reader'), m.get('time'))
-
-                # elif mtype in ['jewel_requests_add']:
-                #         from_id = m['from']
-                #         self.on_friend_request(from_id)
-
-                # Happens on every login
-                elif mtype == "qprimer":
-                    pass
-
-                # Is sent before any other message
-                elif mtype == "deltaflow":
-                    pass
-
-                # Unknown message type
-                else:
-                    self.onUnknownMesssageType(msg=m)
-
+                handler(self, m)
             except Exception as e:
-                log.debug(str(e))
+                failures[key] = failures.get(key, 0) + 1
+                self.parse_failures[key] = self.parse_failures.get(key, 0) + 1
+                log.debug("Could not handle a message of kind %s: %r", key, e)
+        self.duplicates += duplicates
+        if metrics is not None:
+            metrics.observeEvents(events, failures, duplicates)
+
+    def replay(self, journal, speed=None):
+        """Feeds the responses recorded in a journal to the event hooks, as if they were being received.
+        The state of the connection (`sticky`, `pool` and `seq`) is left untouched, so it can be done while listening
+
+        :param journal: a `PullJournal`, its directory, or one of its segments
+        :param speed: `None` to replay as fast as possible, or the speed relative to the original pace, e.g. 1 for the original pace
+        :return: the number of responses replayed
+        """
+        replayed = 0
+        previous = None
+        for timestamp, content in readJournal(getattr(journal, 'directory', journal)):
+            if speed is not None and previous is not None and timestamp > previous:
+                time.sleep((timestamp - previous) / speed)
+            previous = timestamp
+            # Only dispatched: the sticky parameters and `seq` of the recording aren't the ones of the live connection
+            self._parseMessage(get_json(content))
+            replayed += 1
+        return replayed
 
     def startListening(self):
         """Start listening from an external event loop."""
@@ -984,21 +1432,83 @@ class Client(object):
         """Does one cycle of the listening loop.
         This method is only useful if you want to control fbchat from an
         external event loop."""
+        profiler = self.profiler
+        if profiler is not None:
+            self._cycle = cycle = {}
+            start = time.perf_counter()
         try:
-            if markAlive: self.ping(self.sticky)
-            try:
-                content = self._pullMessage(self.sticky, self.pool)
-                if content: self._parseMessage(content)
-            except requests.exceptions.RequestException as e:
-                pass
+            # Pinging happens in the background, so the long-poll is sent again right away
+            if markAlive: self._startPinging()
+            content = self._pullMessage(self.sticky, self.pool)
+            self._listen_failures = 0
+            if content:
+                if profiler is not None:
+                    parsing = time.perf_counter()
+                self._parseMessage(content)
+                if profiler is not None:
+                    cycle['parse'] = time.perf_counter() - parsing
+                self._acknowledge(content)
+            if profiler is not None:
+                # Only the cycles which succeeded, the others mostly wait before trying again
+                cycle['cycle'] = time.perf_counter() - start
+                profiler.observeCycle(cycle)
         except KeyboardInterrupt:
             self.listening = False
         except requests.exceptions.Timeout:
             pass
+        except (requests.exceptions.RequestException, CircuitOpenError) as e:
+            time.sleep(self._getListenBackoff(e))
+
+    def _startPinging(self):
+        """Starts sending presence pings every `self.ping_interval` seconds in a background thread, until `stopListening`"""
+        # Called on every cycle of the listener, which mustn't wait for the lock once the pinger runs
+        if self._pinger is not None:
+            return
+        with self._lock:
+            if self._pinger is not None:
+                return
+            stop = threading.Event()
+            self._pinger = (threading.Thread(target=self._pingLoop, args=(stop,), name='fbchat-pinger', daemon=True), stop)
+            self._pinger[0].start()
+
+    def _stopPinging(self):
+        with self._lock:
+            if self._pinger is None:
+                return
+            thread, stop = self._pinger
+            self._pinger = None
+        # Not waiting for the thread, a ping in progress is harmless
+        stop.set()
+
+    def _pingLoop(self, stop):
+        while True:
+            sticky = self.sticky
+            if sticky is not None:
+                try:
+                    start = time.perf_counter()
+                    self.ping(sticky)
+                    if self.profiler is not None:
+                        self.profiler.observePhase('ping', time.perf_counter() - start)
+                except (requests.exceptions.RequestException, CircuitOpenError) as e:
+                    log.debug("Ping failed: %s", e)
+            if stop.wait(self.ping_interval):
+                return
+
+    def _getListenBackoff(self, e):
+        """Returns how long to wait after a failed listening cycle, so the loop doesn't spin during outages"""
+        if isinstance(e, CircuitOpenError):
+            delay = e.retry_after
+        else:
+            policy = self.retry_policy or RetryPolicy()
+            delay = policy.backoff(self._listen_failures)
+            self._listen_failures += 1
+        log.debug("Listening failed (%s), waiting %.1f seconds", e, delay)
+        return delay
 
     def stopListening(self):
         """Cleans up the variables from start_listening."""
         self.listening = False
+        self._stopPinging()
         self.sticky, self.pool = (None, None)
 
     def listen(self, markAlive=True):
@@ -1016,19 +1526,25 @@ class Client(object):
         :param user_ids: one or more user id(s) to query
         """
 
+        data = self._getUserInfoData(user_ids)
+        r = self._post(UserInfoURL, data)
+        return self._parseUserInfo(get_json(r.content))
+
+    def _getUserInfoData(self, user_ids):
         def fbidStrip(_fbid):
             # Stripping of `fbid:` from author_id
             if type(_fbid) == int:
                 return _fbid
 
-            if type(_fbid) in [str, unicode] and 'fbid:' in _fbid:
-                return int(_fbid[5:])
+            # Event handlers get the ids as strings, with or without the prefix
+            if type(_fbid) == str:
+                return int(_fbid[5:]) if _fbid.startswith('fbid:') else int(_fbid)
 
         user_ids = [fbidStrip(uid) for uid in user_ids]
 
-        data = {"ids[{}]".format(i):uid for i,uid in enumerate(user_ids)}
-        r = self._post(UserInfoURL, data)
-        info = get_json(r.text)
+        return {"ids[{}]".format(i):uid for i,uid in enumerate(user_ids)}
+
+    def _parseUserInfo(self, info):
         full_data= [details for profile,details in info['payload']['profiles'].items()]
         if len(full_data)==1:
             full_data=full_data[0]
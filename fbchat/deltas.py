@@ -0,0 +1,171 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.deltas
+    ~~~~~~~~~~~~~
+
+    Dispatching of the messages received while listening to the events of the client
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+from collections import OrderedDict
+from time import monotonic
+from .models import ThreadType
+
+
+def getThreadIdAndThreadType(msg_metadata):
+    """Returns a tuple consisting of thread id and thread type"""
+    thread_key = msg_metadata['threadKey']
+    if 'threadFbId' in thread_key:
+        return str(thread_key['threadFbId']), ThreadType.GROUP
+    if 'otherUserFbId' in thread_key:
+        return str(thread_key['otherUserFbId']), ThreadType.USER
+    return None, None
+
+
+def getMessageId(m):
+    """Returns the message id of a delta, or `None` if it doesn't have one"""
+    if m.get('type') != 'delta':
+        return None
+    metadata = (m.get('delta') or {}).get('messageMetadata')
+    return metadata.get('messageId') if metadata else None
+
+
+class Deduplicator(object):
+    """Remembers the ids of the last messages received, so the ones received again (e.g. after reconnecting) can be skipped.
+    An id is remembered for `window` seconds, and at most `max_size` ids are remembered.
+    """
+
+    def __init__(self, max_size=10000, window=3600):
+        self.max_size = max_size
+        self.window = window
+        self._seen = OrderedDict()
+
+    def seen(self, mid):
+        """Returns whether `mid` was already seen, and remembers it"""
+        now = monotonic()
+        seen = self._seen
+        while seen:
+            oldest, time = next(iter(seen.items()))
+            if time > now - self.window and len(seen) < self.max_size:
+                break
+            seen.popitem(last=False)
+        if mid in seen:
+            return True
+        seen[mid] = now
+        return False
+
+    def __len__(self):
+        return len(self._seen)
+
+
+def _metadata(delta):
+    """Returns the message id, author id and timestamp of a delta, along with its metadata"""
+    metadata = delta['messageMetadata']
+    return metadata['messageId'], str(metadata['actorFbId']), int(metadata['timestamp']), metadata
+
+
+def _onPeopleAdded(client, m):
+    delta = m['delta']
+    mid, author_id, ts, metadata = _metadata(delta)
+    added_ids = [str(x['userFbId']) for x in delta['addedParticipants']]
+    client.onPeopleAdded(added_ids=added_ids, author_id=author_id, thread_id=str(metadata['threadKey']['threadFbId']))
+
+
+def _onPersonRemoved(client, m):
+    delta = m['delta']
+    mid, author_id, ts, metadata = _metadata(delta)
+    removed_id = str(delta['leftParticipantFbId'])
+    client.onPersonRemoved(removed_id=removed_id, author_id=author_id, thread_id=str(metadata['threadKey']['threadFbId']))
+
+
+def _onColorChange(client, m):
+    delta = m['delta']
+    mid, author_id, ts, metadata = _metadata(delta)
+    thread_id, thread_type = getThreadIdAndThreadType(metadata)
+    client.onColorChange(mid=mid, author_id=author_id, new_color=delta['untypedData']['theme_color'], thread_id=thread_id,
+                         thread_type=thread_type, ts=ts, metadata=metadata)
+
+
+def _onEmojiChange(client, m):
+    delta = m['delta']
+    mid, author_id, ts, metadata = _metadata(delta)
+    thread_id, thread_type = getThreadIdAndThreadType(metadata)
+    client.onEmojiChange(mid=mid, author_id=author_id, new_emoji=delta['untypedData']['thread_icon'], thread_id=thread_id,
+                         thread_type=thread_type, ts=ts, metadata=metadata)
+
+
+def _onTitleChange(client, m):
+    delta = m['delta']
+    mid, author_id, ts, metadata = _metadata(delta)
+    thread_id, thread_type = getThreadIdAndThreadType(metadata)
+    client.onTitleChange(mid=mid, author_id=author_id, new_title=delta['name'], thread_id=thread_id,
+                         thread_type=thread_type, ts=ts, metadata=metadata)
+
+
+def _onNicknameChange(client, m):
+    delta = m['delta']
+    mid, author_id, ts, metadata = _metadata(delta)
+    thread_id, thread_type = getThreadIdAndThreadType(metadata)
+    data = delta['untypedData']
+    client.onNicknameChange(mid=mid, author_id=author_id, changed_for=str(data['participant_id']), new_title=data['nickname'],
+                            thread_id=thread_id, thread_type=thread_type, ts=ts, metadata=metadata)
+
+
+def _onMessage(client, m):
+    delta = m['delta']
+    mid, author_id, ts, metadata = _metadata(delta)
+    thread_id, thread_type = getThreadIdAndThreadType(metadata)
+    client.onMessage(mid=mid, author_id=author_id, message=delta.get('body', ''),
+                     thread_id=thread_id, thread_type=thread_type, ts=ts, metadata=m)
+
+
+def _onInbox(client, m):
+    client.onInbox(unseen=m['unseen'], unread=m['unread'], recent_unread=m['recent_unread'])
+
+
+def _ignore(client, m):
+    pass
+
+
+def onUnknownMessage(client, m):
+    """The handler of the messages no other handler is registered for"""
+    client.onUnknownMesssageType(msg=m)
+
+
+#: The default handlers of the messages received while listening, called with the client and the message.
+#: Deltas are keyed by ('delta', the `type` of the delta), and then by ('delta', the `class` of the delta),
+#: other messages by (their `type`, `None`).
+#: See `Client.registerDeltaHandler` to add handlers to a client.
+DELTA_HANDLERS = {
+    ('delta', 'ParticipantsAddedToGroupThread'): _onPeopleAdded,
+    ('delta', 'ParticipantLeftGroupThread'): _onPersonRemoved,
+    ('delta', 'change_thread_theme'): _onColorChange,
+    ('delta', 'change_thread_icon'): _onEmojiChange,
+    ('delta', 'ThreadName'): _onTitleChange,
+    ('delta', 'change_thread_nickname'): _onNicknameChange,
+    ('delta', 'NewMessage'): _onMessage,
+    # TODO: ReadReceipt, DeliveryReceipt, 'typ', 'm_read_receipt' and 'jewel_requests_add' differ on different scenarios
+    ('inbox', None): _onInbox,
+    # Happens on every login
+    ('qprimer', None): _ignore,
+    # Is sent before any other message
+    ('deltaflow', None): _ignore,
+}
+
+
+def findHandler(handlers, m):
+    """Returns the key of the message `m` and its handler in `handlers`, or `onUnknownMessage` if there's none"""
+    mtype = m.get('type')
+    if mtype != 'delta':
+        key = (mtype, None)
+        handler = handlers.get(key)
+    else:
+        delta = m.get('delta') or {}
+        key = ('delta', delta.get('type'))
+        handler = handlers.get(key) if key[1] is not None else None
+        if handler is None:
+            key = ('delta', delta.get('class'))
+            handler = handlers.get(key)
+    return key, handler or onUnknownMessage
@@ -1,4 +1,4 @@
-import inspect
+from time import perf_counter
 
 
 class EventHook(object):
@@ -10,6 +10,13 @@ class EventHook(object):
     Callables with a fitting signature can be added with += or removed with -=.
     All listeners can be notified by calling the EventHook class with fitting
     arguments.
+
+    Handlers can also be subscribed to the events of a single thread or author
+    only, see `subscribe`. Those are found with a dict lookup, so they don't
+    slow down the other events.
+
+    The handlers are checked when they're added. Calls are checked too, unless
+    `check_calls` is `False`, for callers which always use the right arguments.
     
     Thanks http://stackoverflow.com/a/35957226/5556222
     """
@@ -17,12 +24,21 @@ class EventHook(object):
     def __init__(self, **signature):
         self._signature = signature
         self._argnames = set(signature.keys())
-        self._handlers = []
+        # Replaced instead of modified, so calling doesn't need to copy it
+        self._handlers = ()
+        self.check_calls = True
+        # Maps the subscription fields to dicts mapping their values to tuples of (handler, other filters)
+        self._indexes = {}
+        #: An `EventExecutor` to run the handlers in, instead of the calling thread. See `Client.setEventExecutor`
+        self.executor = None
+        #: A `ListenProfiler` to record the duration of the handlers in. See `Client.setProfiler`
+        self.profiler = None
 
     def _kwargs_str(self):
         return ", ".join(k+"="+v.__name__ for k, v in self._signature.items())
 
-    def __iadd__(self, handler):
+    def _check(self, handler):
+        import inspect
         params = inspect.signature(handler).parameters
         valid = True
         argnames = set(n for n in params.keys())
@@ -38,19 +54,88 @@ class EventHook(object):
         if not valid:
             raise ValueError("Listener must have these arguments: (%s)"
                              % self._kwargs_str())
-        self._handlers.append(handler)
+
+    def __iadd__(self, handler):
+        self._check(handler)
+        self._handlers = self._handlers + (handler,)
         return self
 
     def __isub__(self, handler):
-        self._handlers.remove(handler)
+        handlers = list(self._handlers)
+        handlers.remove(handler)
+        self._handlers = tuple(handlers)
         return self
 
+    def subscribe(self, handler, thread_id=None, thread_type=None, author_id=None):
+        """Adds a handler called only for the events matching all the given filters.
+        Unlike a handler filtering the events itself, it doesn't cost anything to the other events.
+
+        :param handler: the handler, with the same arguments as a handler added with +=
+        :param thread_id: only call the handler for events of this thread
+        :param thread_type: only call the handler for events of threads of this `ThreadType`
+        :param author_id: only call the handler for events by this user
+        :raises: ValueError if no filter was given, or if the events of the hook don't have one of the filtered arguments
+        """
+        filters = [(k, v) for k, v in [('thread_id', thread_id), ('author_id', author_id), ('thread_type', thread_type)] if v is not None]
+        if not filters:
+            raise ValueError("At least one of thread_id, thread_type or author_id must be given, or use +=")
+        for k, v in filters:
+            if k not in self._argnames:
+                raise ValueError("This EventHook doesn't have a %s argument" % k)
+        self._check(handler)
+        # Ids are strings in the events
+        filters = [(k, str(v) if k != 'thread_type' else v) for k, v in filters]
+
+        # Index the handler by its most selective filter, and check the others when an event matches it
+        (field, value), others = filters[0], tuple(filters[1:])
+        indexes = dict((f, dict(index)) for f, index in self._indexes.items())
+        index = indexes.setdefault(field, {})
+        index[value] = index.get(value, ()) + ((handler, others),)
+        self._indexes = indexes
+
+    def unsubscribe(self, handler):
+        """Removes all the subscriptions of `handler`"""
+        indexes = {}
+        for field, index in self._indexes.items():
+            index = dict((value, tuple(s for s in subscriptions if s[0] != handler)) for value, subscriptions in index.items())
+            index = dict((value, subscriptions) for value, subscriptions in index.items() if subscriptions)
+            if index:
+                indexes[field] = index
+        self._indexes = indexes
+
+    def _subscribed(self, kwargs):
+        """Returns the subscribed handlers matching the event"""
+        handlers = ()
+        for field, index in self._indexes.items():
+            subscriptions = index.get(kwargs.get(field))
+            if subscriptions:
+                handlers += tuple(handler for handler, others in subscriptions if all(kwargs.get(k) == v for k, v in others))
+        return handlers
+
     def __call__(self, *args, **kwargs):
-        if args or set(kwargs.keys()) != self._argnames:
+        if self.check_calls and (args or kwargs.keys() != self._argnames):
             raise ValueError("This EventHook must be called with these " +
                              "keyword arguments: (%s)" % self._kwargs_str() +
                              ", but was called with: (%s)" %self._signature)
-        for handler in self._handlers[:]:
+        handlers = self._handlers
+        if self._indexes:
+            handlers = handlers + self._subscribed(kwargs)
+        if self.executor is not None:
+            # Events of the same thread go to the same queue, so they're handled in order
+            key = kwargs.get('thread_id')
+            for handler in handlers:
+                self.executor.submit(key, handler, kwargs)
+            return
+        profiler = self.profiler
+        if profiler is not None:
+            for handler in handlers:
+                start = perf_counter()
+                try:
+                    handler(**kwargs)
+                finally:
+                    profiler.observeHandler(handler, perf_counter() - start)
+            return
+        for handler in handlers:
             handler(**kwargs)
 
     def __repr__(self):
@@ -0,0 +1,293 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.executor
+    ~~~~~~~~~~~~~~~
+
+    Running event handlers outside of the listener, so slow handlers don't delay the next events
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+import threading
+from collections import deque
+from enum import Enum
+from time import perf_counter
+
+log = logging.getLogger("client")
+
+
+class Overflow(Enum):
+    """What an executor does with an event when the queue it goes to is full"""
+    #: Wait until there's room in the queue, which holds the listener back
+    BLOCK = 'block'
+    #: Drop the new event
+    DROP_NEW = 'drop_new'
+    #: Drop the oldest event of the queue to make room for the new one
+    DROP_OLDEST = 'drop_oldest'
+
+
+class _Shard(object):
+    def __init__(self):
+        self.jobs = deque()
+        self.max_depth = 0
+
+
+class _BaseExecutor(object):
+    def __init__(self, workers, max_queue, overflow):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overflow = Overflow(overflow)
+        self._shards = [_Shard() for i in range(workers)]
+        self.submitted = 0
+        self.executed = 0
+        self.dropped = 0
+        self.errors = 0
+        #: A `ListenProfiler` to record the duration of the handlers in, set by `Client.setProfiler`
+        self.profiler = None
+
+    def _shard(self, key):
+        return self._shards[hash(key) % self.workers]
+
+    def _enqueue(self, shard, job):
+        """Adds `job` to `shard`, unless it's full. Must be called with the lock held, if there's one
+
+        :return: whether the job was added
+        """
+        self.submitted += 1
+        if len(shard.jobs) >= self.max_queue:
+            if self.overflow is Overflow.DROP_NEW:
+                self.dropped += 1
+                return False
+            if self.overflow is Overflow.DROP_OLDEST:
+                shard.jobs.popleft()
+                self.dropped += 1
+        shard.jobs.append(job)
+        shard.max_depth = max(shard.max_depth, len(shard.jobs))
+        return True
+
+    def _run(self, job):
+        fn, kwargs = job
+        try:
+            return fn(**kwargs)
+        except Exception:
+            self.errors += 1
+            log.exception("Event handler %s failed", fn)
+
+    def stats(self):
+        """Returns the queue depths and the counters of the executor
+
+        :return: a dict with the keys
+                 `queued`: the number of events waiting to be handled,
+                 `shards`: the number of events waiting in each queue,
+                 `max_queued`: the maximum number of events that have waited in a single queue,
+                 `submitted`, `executed`, `dropped` and `errors`: the number of events submitted, handled,
+                 dropped because of the overflow policy, and whose handler raised an exception
+        """
+        depths = [len(shard.jobs) for shard in self._shards]
+        return {
+            'queued': sum(depths),
+            'shards': depths,
+            'max_queued': max(shard.max_depth for shard in self._shards),
+            'submitted': self.submitted,
+            'executed': self.executed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
+
+
+class EventExecutor(_BaseExecutor):
+    """Runs event handlers in a pool of threads, instead of in the thread listening.
+
+    Events are spread over `workers` queues by their key (the `thread_id` of the event, for `Client`),
+    each handled by a single thread, so events of the same thread are handled in the order they were received.
+    Each queue holds at most `max_queue` events, beyond which `overflow` (see `Overflow`) applies.
+
+    Use it with `Client(event_executor=EventExecutor())`.
+    """
+
+    def __init__(self, workers=4, max_queue=1000, overflow=Overflow.BLOCK):
+        """
+        :param workers: Number of threads running the handlers
+        :param max_queue: Maximum number of events waiting in the queue of each thread
+        :param overflow: What to do when a queue is full, an `Overflow` or its value
+        """
+        super(EventExecutor, self).__init__(workers, max_queue, overflow)
+        self._cond = threading.Condition()
+        self._threads = []
+        self._closed = False
+
+    def _start(self):
+        for i, shard in enumerate(self._shards):
+            thread = threading.Thread(target=self._work, args=(shard,), name='fbchat-events-{}'.format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self, shard):
+        while True:
+            with self._cond:
+                while not shard.jobs:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                job = shard.jobs.popleft()
+                # Wake up the threads blocked on a full queue
+                self._cond.notify_all()
+            profiler = self.profiler
+            if profiler is None:
+                self._run(job)
+            else:
+                start = perf_counter()
+                self._run(job)
+                profiler.observeHandler(job[0], perf_counter() - start)
+            with self._cond:
+                self.executed += 1
+
+    def submit(self, key, fn, kwargs):
+        """Calls `fn(**kwargs)` in the thread handling `key`
+
+        :return: whether the event was queued, `False` if it was dropped
+        """
+        shard = self._shard(key)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The executor is shut down")
+            if not self._threads:
+                self._start()
+            if self.overflow is Overflow.BLOCK:
+                while len(shard.jobs) >= self.max_queue:
+                    self._cond.wait()
+            queued = self._enqueue(shard, (fn, kwargs))
+            self._cond.notify_all()
+        return queued
+
+    def shutdown(self, wait=True):
+        """Stops the threads, once they've handled the events already queued"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+def _runningLoop():
+    """Returns the event loop running in the current thread, or `None`"""
+    import asyncio
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        # Python < 3.7
+        return asyncio._get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class AsyncEventExecutor(_BaseExecutor):
+    """The same as `EventExecutor`, running the handlers in tasks of the event loop, for `AsyncClient`.
+    Handlers can be coroutine functions, which are awaited before the next event of the same queue is handled.
+
+    With `Overflow.BLOCK`, events are always queued, and `AsyncClient` waits for the queues to have room again
+    (see `drain`) before sending the next long-poll.
+
+    The tasks are started in the event loop the executor is first used from, and again if it's then used
+    from another one. Events submitted before that (e.g. `onLoggedIn`, while the client is created) wait for them.
+    """
+
+    def __init__(self, workers=4, max_queue=1000, overflow=Overflow.BLOCK):
+        """See `EventExecutor` for the parameters. `workers` is the number of tasks"""
+        super(AsyncEventExecutor, self).__init__(workers, max_queue, overflow)
+        self._loop = None
+        self._tasks = []
+        self._wakeups = None
+        self._room = None
+
+    def _ensureStarted(self, loop):
+        """Starts the tasks in `loop`, the running one, if they aren't running in it already"""
+        if self._loop is loop:
+            return
+        import asyncio
+        for task in self._tasks:
+            try:
+                task.cancel()
+            except RuntimeError:
+                # Their loop is closed
+                pass
+        self._loop = loop
+        self._wakeups = [asyncio.Event() for shard in self._shards]
+        self._room = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._work(shard, wakeup)) for shard, wakeup in zip(self._shards, self._wakeups)]
+        # Handles the events submitted before
+        for shard, wakeup in zip(self._shards, self._wakeups):
+            if shard.jobs:
+                wakeup.set()
+
+    async def _work(self, shard, wakeup):
+        import inspect
+        while True:
+            while not shard.jobs:
+                wakeup.clear()
+                await wakeup.wait()
+            job = shard.jobs.popleft()
+            if len(shard.jobs) < self.max_queue:
+                self._room.set()
+            profiler = self.profiler
+            start = perf_counter() if profiler is not None else None
+            result = self._run(job)
+            if inspect.isawaitable(result):
+                try:
+                    await result
+                except Exception:
+                    self.errors += 1
+                    log.exception("Event handler %s failed", job[0])
+            if profiler is not None:
+                profiler.observeHandler(job[0], perf_counter() - start)
+            self.executed += 1
+
+    def submit(self, key, fn, kwargs):
+        """Calls `fn(**kwargs)` in the task handling `key`. When called from another thread than the one of
+        the event loop (e.g. by the session refresher), the event is handed over to the event loop
+
+        :return: whether the event was queued, `False` if it was dropped. Always `True` from another thread
+        """
+        loop = _runningLoop()
+        if loop is None:
+            if self._loop is not None and self._loop.is_running():
+                self._loop.call_soon_threadsafe(self.submit, key, fn, kwargs)
+                return True
+            # No event loop yet: queued until the tasks are started
+            return self._queue(key, fn, kwargs)
+        self._ensureStarted(loop)
+        queued = self._queue(key, fn, kwargs)
+        self._wakeups[hash(key) % self.workers].set()
+        return queued
+
+    def _queue(self, key, fn, kwargs):
+        shard = self._shard(key)
+        if self.overflow is Overflow.BLOCK:
+            # Queued anyway, `drain` holds the listener back
+            self.submitted += 1
+            shard.jobs.append((fn, kwargs))
+            shard.max_depth = max(shard.max_depth, len(shard.jobs))
+            return True
+        return self._enqueue(shard, (fn, kwargs))
+
+    async def drain(self):
+        """Waits until all the queues have room for new events"""
+        self._ensureStarted(_runningLoop())
+        while any(len(shard.jobs) >= self.max_queue for shard in self._shards):
+            self._room.clear()
+            await self._room.wait()
+
+    async def shutdown(self, wait=True):
+        """Stops the tasks, after they've handled the events already queued if `wait`"""
+        import asyncio
+        if wait:
+            self._ensureStarted(_runningLoop())
+            while self.executed + self.dropped < self.submitted:
+                await asyncio.sleep(0.01)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._loop = None
@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.journal
+    ~~~~~~~~~~~~~~
+
+    Recording of the raw responses of the pull api, to replay them later
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import gzip
+import json
+import os
+import threading
+from time import time
+
+_PREFIX = 'pull-'
+_SUFFIX = '.jsonl.gz'
+
+
+class PullJournal(object):
+    """An append-only journal of the responses of the pull api, with the time they were received.
+
+    It's written in gzip compressed segments of JSON lines in `directory`. A new segment is started when
+    the current one is bigger than `max_segment_size` bytes (compressed), and the oldest ones are deleted
+    beyond `max_segments`. Each record is flushed as it's written, so a crash loses at most the last one.
+
+    Use it with `Client(journal=PullJournal(directory))`, and replay it with `Client.replay`.
+    """
+
+    def __init__(self, directory, max_segment_size=64 * 1024 * 1024, max_segments=None):
+        """
+        :param directory: The directory to write the segments in. It's created if needed
+        :param max_segment_size: The size at which a new segment is started, in bytes
+        :param max_segments: Maximum number of segments to keep, or `None` to keep all of them
+        """
+        self.directory = directory
+        self.max_segment_size = max_segment_size
+        self.max_segments = max_segments
+        self._file = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self):
+        """Returns the paths of the segments of the journal, oldest first"""
+        return readSegments(self.directory)
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        # Named by the time they're started, so sorting them by name sorts them by age
+        path = os.path.join(self.directory, '{}{:017d}{}'.format(_PREFIX, int(time() * 1e6), _SUFFIX))
+        self._file = gzip.open(path, 'ab')
+        if self.max_segments is not None:
+            for old in self.segments()[:-self.max_segments]:
+                os.remove(old)
+
+    def write(self, content, timestamp=None):
+        """Appends a response to the journal
+
+        :param content: the body of the response, as bytes
+        :param timestamp: the time the response was received at, in seconds since the epoch. Defaults to now
+        """
+        record = json.dumps({
+            'ts': time() if timestamp is None else timestamp,
+            # Facebook always sends UTF-8, but nothing that was received must be lost
+            'body': content.decode('utf-8', 'surrogateescape'),
+        }).encode('ascii') + b'\n'
+        with self._lock:
+            if self._file is None or self._file.fileobj.tell() >= self.max_segment_size:
+                self._rotate()
+            self._file.write(record)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def readSegments(directory):
+    """Returns the paths of the segments of the journal in `directory`, oldest first"""
+    names = sorted(name for name in os.listdir(directory) if name.startswith(_PREFIX) and name.endswith(_SUFFIX))
+    return [os.path.join(directory, name) for name in names]
+
+
+def readJournal(path):
+    """Yields the records of a journal, as tuples of the time they were received at and the body of the response
+
+    :param path: the directory of a `PullJournal`, or one of its segments
+    """
+    paths = readSegments(path) if os.path.isdir(path) else [path]
+    for path in paths:
+        with gzip.open(path, 'rb') as f:
+            while True:
+                # A segment that was being written when the process crashed ends with a partial record
+                try:
+                    line = f.readline()
+                    record = json.loads(line.decode('ascii')) if line else None
+                except (EOFError, ValueError):
+                    record = None
+                if record is None:
+                    break
+                yield record['ts'], record['body'].encode('utf-8', 'surrogateescape')
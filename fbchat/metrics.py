@@ -0,0 +1,232 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.metrics
+    ~~~~~~~~~~~~~~
+
+    Counters and latency histograms of the requests of the clients, and of their listeners
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import threading
+from bisect import bisect_left
+
+#: The upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+#: The upper bounds of the buckets of the response size histograms, in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram(object):
+    """Counts observed values in buckets, like a Prometheus histogram"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # The last one counts the values above all the buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Returns an estimate of the `p`th percentile: the upper bound of its bucket, or the largest value if it's above them"""
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            # Cumulative, as in Prometheus: the number of values less than or equal to each bound
+            'buckets': buckets,
+        }
+
+
+class _Endpoint(object):
+    def __init__(self):
+        self.statuses = {}
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.sizes = Histogram(SIZE_BUCKETS)
+
+
+def _eventName(key):
+    """Returns the name of a kind of message from its key in `DELTA_HANDLERS`, e.g. 'delta.NewMessage' or 'inbox'"""
+    return '.'.join(str(k) for k in key if k is not None)
+
+
+class Metrics(object):
+    """Records the requests of clients by endpoint (their URL without the query): their count by status,
+    the bytes sent and received, and histograms of their latency and of the size of the responses.
+    Requests failing without a response are counted by the name of the exception instead of a status.
+    It also counts the cycles of the listeners, the messages they received by kind, the ones which
+    couldn't be handled, and the duplicates skipped.
+
+    Use it with `Client(metrics=Metrics())`. A `Metrics` can be shared by many clients, e.g. of a `ClientPool`.
+    Without one, clients don't measure anything.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.pulls = 0
+        self.events = {}
+        self.parse_failures = {}
+        self.duplicates = 0
+
+    def observeRequest(self, url, status, seconds, sent=0, received=0):
+        """Records a request
+
+        :param url: the URL of the request. Its query is ignored
+        :param status: the status of the response, or the name of the exception raised instead
+        :param seconds: the time taken by the request, including reading the response
+        :param sent: the size of the body of the request, in bytes
+        :param received: the size of the body of the response, in bytes
+        """
+        endpoint = url.split('?', 1)[0]
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = _Endpoint()
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.sent_bytes += sent
+            stats.received_bytes += received
+            stats.latency.observe(seconds)
+            if received:
+                stats.sizes.observe(received)
+
+    def observePull(self):
+        """Records a cycle of a listener"""
+        with self._lock:
+            self.pulls += 1
+
+    def observeEvents(self, events, failures, duplicates):
+        """Records the messages of a pull response
+
+        :param events: a dict mapping the keys of the kinds of messages (see `fbchat.deltas.DELTA_HANDLERS`) to their number
+        :param failures: the same, for the messages whose handler raised an exception
+        :param duplicates: the number of messages skipped as duplicates
+        """
+        with self._lock:
+            for key, count in events.items():
+                name = _eventName(key)
+                self.events[name] = self.events.get(name, 0) + count
+            for key, count in failures.items():
+                name = _eventName(key)
+                self.parse_failures[name] = self.parse_failures.get(name, 0) + count
+            self.duplicates += duplicates
+
+    def stats(self):
+        """Returns a snapshot of the metrics
+
+        :return: a dict with the keys
+                 `requests`: a dict mapping the endpoints to dicts with the keys `count`, `statuses` (the number of
+                 requests by status), `sent_bytes`, `received_bytes`, `latency` and `sizes` (see `Histogram.stats`),
+                 `pulls`: the number of cycles of the listeners,
+                 `events`, `parse_failures`: the number of messages received, and that couldn't be handled, by kind,
+                 `duplicates`: the number of messages skipped as duplicates
+        """
+        with self._lock:
+            return {
+                'requests': dict((endpoint, {
+                    'count': stats.latency.count,
+                    'statuses': dict(stats.statuses),
+                    'sent_bytes': stats.sent_bytes,
+                    'received_bytes': stats.received_bytes,
+                    'latency': stats.latency.stats(),
+                    'sizes': stats.sizes.stats(),
+                }) for endpoint, stats in self._endpoints.items()),
+                'pulls': self.pulls,
+                'events': dict(self.events),
+                'parse_failures': dict(self.parse_failures),
+                'duplicates': self.duplicates,
+            }
+
+    def export(self, exporter=None):
+        """Returns the metrics, formatted by `exporter`
+
+        :param exporter: a function called with the dict returned by `stats`. Defaults to `toPrometheus`
+        """
+        return (exporter or toPrometheus)(self.stats())
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram(lines, name, labels, histogram):
+    for bound, count in histogram['buckets']:
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, count))
+    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, histogram['count']))
+    lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram['sum']))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, histogram['count']))
+
+
+def toPrometheus(stats, prefix='fbchat'):
+    """Formats the dict returned by `Metrics.stats` in the text format of Prometheus, e.g. to serve it to its scraper"""
+    requests = sorted(stats['requests'].items())
+    lines = [
+        '# HELP {}_requests_total Requests sent, by endpoint and status'.format(prefix),
+        '# TYPE {}_requests_total counter'.format(prefix),
+    ]
+    for endpoint, r in requests:
+        for status, count in sorted(r['statuses'].items(), key=lambda item: str(item[0])):
+            lines.append('{}_requests_total{{endpoint="{}",status="{}"}} {}'.format(prefix, _label(endpoint), _label(status), count))
+    for name, key, help in [
+        ('request_sent_bytes_total', 'sent_bytes', 'Bytes sent in the body of the requests'),
+        ('request_received_bytes_total', 'received_bytes', 'Bytes received in the body of the responses'),
+    ]:
+        lines.append('# HELP {}_{} {}, by endpoint'.format(prefix, name, help))
+        lines.append('# TYPE {}_{} counter'.format(prefix, name))
+        for endpoint, r in requests:
+            lines.append('{}_{}{{endpoint="{}"}} {}'.format(prefix, name, _label(endpoint), r[key]))
+    for name, key, help in [
+        ('request_duration_seconds', 'latency', 'Time taken by the requests'),
+        ('response_size_bytes', 'sizes', 'Size of the body of the responses'),
+    ]:
+        lines.append('# HELP {}_{} {}, by endpoint'.format(prefix, name, help))
+        lines.append('# TYPE {}_{} histogram'.format(prefix, name))
+        for endpoint, r in requests:
+            _histogram(lines, '{}_{}'.format(prefix, name), 'endpoint="{}"'.format(_label(endpoint)), r[key])
+
+    lines += [
+        '# HELP {}_pulls_total Cycles of the listeners'.format(prefix),
+        '# TYPE {}_pulls_total counter'.format(prefix),
+        '{}_pulls_total {}'.format(prefix, stats['pulls']),
+        '# HELP {}_duplicates_total Messages received again, and skipped'.format(prefix),
+        '# TYPE {}_duplicates_total counter'.format(prefix),
+        '{}_duplicates_total {}'.format(prefix, stats['duplicates']),
+    ]
+    for name, key, help in [
+        ('events_total', 'events', 'Messages received by the listeners'),
+        ('parse_failures_total', 'parse_failures', 'Messages whose handler failed'),
+    ]:
+        lines.append('# HELP {}_{} {}, by kind'.format(prefix, name, help))
+        lines.append('# TYPE {}_{} counter'.format(prefix, name))
+        for kind, count in sorted(stats[key].items()):
+            lines.append('{}_{}{{type="{}"}} {}'.format(prefix, name, _label(kind), count))
+    return '\n'.join(lines) + '\n'
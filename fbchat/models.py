@@ -3,6 +3,10 @@ from enum import Enum
 import sys
 
 
+class FBchatException(Exception):
+    """Custom exception thrown by fbchat. All exceptions in the fbchat module inherits this"""
+
+
 class Base():
     def __repr__(self):
         uni = self.__unicode__()
@@ -0,0 +1,118 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.multipart
+    ~~~~~~~~~~~~~~~~
+
+    Streaming multipart/form-data encoding, for uploading files without loading them in memory
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import stat
+from uuid import uuid4
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _fileSize(f):
+    """Returns the number of bytes left to read in the file object `f`, or `None` if it can't be known"""
+    try:
+        st = os.fstat(f.fileno())
+        # e.g. the socket of a response being downloaded has a file descriptor, but no size
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return st.st_size - f.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class MultipartStream(object):
+    """A multipart/form-data request body, which reads the files it contains only as it's being sent.
+
+    `requests` sends it with a `Content-Length` when the sizes of all files are known,
+    and with chunked transfer encoding otherwise.
+    """
+
+    def __init__(self, fields, files):
+        """
+        :param fields: a dict of the form fields
+        :param files: a dict mapping field names to (file name, content, mime type) or (file name, content, mime type, size) tuples.
+                      The content can be bytes, or a file-like object with a `read` method.
+                      If the size isn't given, it's found from the file, if possible.
+        """
+        self.boundary = uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+        self._parts = []
+        self._files = []
+
+        for name, value in fields.items():
+            self._parts.append(self._header(name) + str(value).encode('utf-8') + b'\r\n')
+
+        length = sum(len(part) for part in self._parts)
+        for name, f in files.items():
+            filename, content, mimetype = f[:3]
+            size = f[3] if len(f) > 3 else None
+            self._parts.append(self._header(name, filename, mimetype))
+            length += len(self._parts[-1])
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            if isinstance(content, (bytes, bytearray, memoryview)):
+                size = len(content)
+            else:
+                self._files.append((content, content.tell() if hasattr(content, 'seek') else None))
+                if size is None:
+                    size = _fileSize(content)
+            self._parts.append(content)
+            self._parts.append(b'\r\n')
+            length = None if length is None or size is None else length + size + 2
+        self._parts.append(('--%s--\r\n' % self.boundary).encode('ascii'))
+
+        if length is not None:
+            # Read by `requests` to set the `Content-Length` header
+            self.len = length + len(self._parts[-1])
+        self._iter = None
+        self._buffer = b''
+
+    def _header(self, name, filename=None, mimetype=None):
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (self.boundary, name)
+        if filename is not None:
+            header += '; filename="%s"' % os.path.basename(filename).replace('"', '%22')
+            header += '\r\nContent-Type: %s' % (mimetype or 'application/octet-stream')
+        return (header + '\r\n\r\n').encode('utf-8')
+
+    @property
+    def rewindable(self):
+        """Whether the body can be sent again, i.e. if all its files are seekable"""
+        return all(start is not None and getattr(f, 'seekable', lambda: False)() for f, start in self._files)
+
+    def rewind(self):
+        """Goes back to the start of the body, so it can be sent again. See `rewindable`"""
+        for f, start in self._files:
+            f.seek(start)
+        self._iter = None
+        self._buffer = b''
+
+    def __iter__(self):
+        for part in self._parts:
+            if isinstance(part, (bytes, bytearray, memoryview)):
+                yield part
+                continue
+            while True:
+                chunk = part.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def read(self, size=-1):
+        if self._iter is None:
+            self._iter = iter(self)
+        if size < 0:
+            data, self._buffer = self._buffer + b''.join(self._iter), b''
+            return data
+        # Short reads are allowed, so at most one chunk is buffered
+        if not self._buffer:
+            self._buffer = next(self._iter, b'')
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
@@ -0,0 +1,198 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.pool
+    ~~~~~~~~~~~
+
+    Running many accounts in one process, sharing their connections and their event loop
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import asyncio
+import logging
+import requests
+from .async_client import AsyncClient, aiohttp
+from .event_hook import EventHook
+
+log = logging.getLogger("client")
+
+
+class ClientPool(object):
+    """A set of `AsyncClient`, one per account, sharing a single connection pool.
+
+    The long-polls of all the accounts run concurrently on one event loop, with `listen`,
+    instead of needing a thread (or a process) per account.
+    Every event of every account is also sent to `onEvent`, along with the id of the account it happened to:
+
+        pool = ClientPool()
+        pool.addClient(email, password)
+        pool.addClient(snapshot=snapshot)
+        pool.onEvent += lambda account_id, event, kwargs: print(account_id, event, kwargs)
+        asyncio.get_event_loop().run_until_complete(pool.listen())
+
+    The event handlers of the clients, and those of `onEvent`, run on the event loop, so they must not block.
+    """
+
+    def __init__(self, max_connections=100, limit_per_host=0, client_class=AsyncClient):
+        """
+        :param max_connections: Maximum number of connections kept open per host, shared by all the accounts
+        :param limit_per_host: Maximum number of simultaneous `aiohttp` connections per host, or 0 for no limit.
+                               Note that each account listening keeps a connection busy with its long-poll
+        :param client_class: The class of the clients created by `addClient`, `AsyncClient` or a subclass of it
+        """
+        if aiohttp is None:
+            raise Exception("ClientPool requires aiohttp. Install it with `pip install fbchat[async]`")
+
+        self.max_connections = max_connections
+        self.limit_per_host = limit_per_host
+        self.client_class = client_class
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=max_connections)
+        self._connector = None
+        self.clients = {}
+        self._listening = {}
+        self._stop = None
+
+        self._events = {}
+        self._account_events = {}
+
+        self.onEvent = EventHook(account_id=str, event=str, kwargs=dict)
+
+    def _getConnector(self):
+        """Returns the `aiohttp` connector shared by all the clients. It's created on first use, in the running event loop"""
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.limit_per_host)
+        return self._connector
+
+    def _route(self, account_id, event):
+        """Returns a handler sending `event` of the account `account_id` to `onEvent`"""
+        def handler(**kwargs):
+            self._events[event] = self._events.get(event, 0) + 1
+            self._account_events[account_id] = self._account_events.get(account_id, 0) + 1
+            self.onEvent(account_id=account_id, event=event, kwargs=kwargs)
+        return handler
+
+    def addClient(self, email=None, password=None, account_id=None, **kwargs):
+        """Creates a client sharing the connections of the pool, logging in if needed.
+        This blocks, like creating an `AsyncClient` does.
+
+        :param email: Facebook `email` or `id` or `phone number`, if not restoring a snapshot or session cookies
+        :param password: Facebook account password
+        :param account_id: The id the account is known as in the pool. Defaults to its user id
+        :param kwargs: Other parameters of `AsyncClient`, e.g. `snapshot` or `scheduler`
+        :return: the client
+        """
+        client = self.client_class(email, password, adapter=self.adapter, connector=self._getConnector, **kwargs)
+        return self.add(client, account_id)
+
+    def add(self, client, account_id=None):
+        """Adds an existing client to the pool. Its events are sent to `onEvent`, but it keeps its own connections
+
+        :param client: an `AsyncClient`
+        :param account_id: The id the account is known as in the pool. Defaults to its user id
+        :return: the client
+        """
+        account_id = str(account_id if account_id is not None else client.uid)
+        if account_id in self.clients:
+            raise ValueError("Account {} is already in the pool".format(account_id))
+
+        for name, hook in list(vars(client).items()):
+            if isinstance(hook, EventHook) and name.startswith('on'):
+                hook += self._route(account_id, name)
+        self.clients[account_id] = client
+        return client
+
+    async def remove(self, account_id):
+        """Stops listening with the account `account_id`, removes it from the pool, and closes its session
+
+        :return: the client
+        """
+        client = self.clients.pop(str(account_id))
+        client.listening = False
+        task = self._listening.pop(str(account_id), None)
+        if task is not None:
+            task.cancel()
+        await client.close()
+        return client
+
+    def __getitem__(self, account_id):
+        return self.clients[str(account_id)]
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    async def _listen(self, account_id, client, markAlive):
+        while True:
+            try:
+                await client.listen(markAlive)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A single account failing must not stop the others, so it's restarted after a while
+                log.exception("Account %s stopped listening", account_id)
+                if self._stop is None or self._stop.is_set():
+                    return
+                await asyncio.sleep(client._getListenBackoff(e))
+
+    async def listen(self, markAlive=True):
+        """Listens with all the accounts of the pool, until `stopListening` is called.
+        Accounts added while listening start listening as well. An account stopping by itself
+        (e.g. by setting `client.listening = False`) isn't restarted.
+        """
+        self._stop = asyncio.Event()
+        self._listening = {}
+        while not self._stop.is_set():
+            for account_id, client in self.clients.items():
+                if account_id not in self._listening:
+                    self._listening[account_id] = asyncio.ensure_future(self._listen(account_id, client, markAlive))
+            try:
+                # Check for new accounts every second
+                await asyncio.wait_for(self._stop.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+        tasks = [task for task in self._listening.values() if not task.done()]
+        if tasks:
+            await asyncio.wait(tasks)
+        self._listening = {}
+        self._stop = None
+
+    def stopListening(self):
+        """Stops `listen`, once the long-polls in progress are done"""
+        for client in self.clients.values():
+            client.listening = False
+        if self._stop is not None:
+            self._stop.set()
+
+    async def close(self):
+        """Closes the sessions of all the clients, and the connections of the pool"""
+        for client in self.clients.values():
+            await client.close()
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+        self.adapter.close()
+
+    def stats(self):
+        """Returns statistics about the whole pool
+
+        :return: a dict with the keys:
+                 `accounts`: the number of accounts in the pool,
+                 `listening`: the number of accounts listening,
+                 `listen_failures`: the number of consecutive failures of the long-polls, summed over all accounts,
+                 `events`: a dict mapping the names of the events to the number of times they happened,
+                 `account_events`: a dict mapping the account ids to their number of events,
+                 `http_pools`: the number of hosts the shared `requests` connection pool has connections to
+        """
+        return {
+            'accounts': len(self.clients),
+            'listening': sum(1 for task in self._listening.values() if not task.done()),
+            'listen_failures': sum(client._listen_failures for client in self.clients.values()),
+            'events': dict(self._events),
+            'account_events': dict(self._account_events),
+            'http_pools': len(self.adapter.poolmanager.pools),
+        }
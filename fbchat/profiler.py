@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.profiler
+    ~~~~~~~~~~~~~~~
+
+    Finding where the listener spends its time, and how far behind it is
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import threading
+from collections import deque
+from time import time
+from .metrics import Histogram, LATENCY_BUCKETS
+
+#: The upper bounds of the buckets of the event lag histogram, in seconds
+LAG_BUCKETS = LATENCY_BUCKETS + (300, 900, 3600)
+
+
+def handlerName(handler):
+    """Returns the name of an event handler, e.g. 'mybot.Bot.onMessage'"""
+    name = getattr(handler, '__qualname__', None) or getattr(handler, '__name__', None)
+    if name is None:
+        return repr(handler)
+    module = getattr(handler, '__module__', None)
+    return '{}.{}'.format(module, name) if module else name
+
+
+def _handlerLabels(handlers):
+    """Returns a dict mapping each of `handlers` to its name, followed by its id if other handlers have the same name
+    (e.g. lambdas, or the methods of different instances), so they're reported separately
+    """
+    names = dict((handler, handlerName(handler)) for handler in handlers)
+    counts = {}
+    for name in names.values():
+        counts[name] = counts.get(name, 0) + 1
+    return dict((handler, name if counts[name] == 1 else '{} at 0x{:x}'.format(name, id(handler))) for handler, name in names.items())
+
+
+class _HandlerStats(object):
+    def __init__(self):
+        self.durations = Histogram(LATENCY_BUCKETS)
+        self.slow = 0
+
+
+class ListenProfiler(object):
+    """Records how long each phase of the cycles of a listener takes, how long the event handlers take,
+    and the lag of the events: the time they're dispatched at, minus the time Facebook says they happened at.
+
+    The phases of a cycle are `pull` (waiting for the response of the long-poll), `decode` (of its JSON),
+    `parse` (dispatching the messages, including the handlers run by the listener), `drain` (waiting for the
+    queues of an `AsyncEventExecutor` to have room) and `cycle` (all of it). The presence pings are sent in
+    the background, and are recorded as a separate `ping` phase.
+
+    Calls of handlers taking more than `slow_threshold` seconds are counted, see `slowHandlers`.
+
+    Use it with `Client(profiler=ListenProfiler())`, or `client.setProfiler`. Without one, nothing is measured.
+    """
+
+    def __init__(self, slow_threshold=0.1, history=1000):
+        """
+        :param slow_threshold: Duration above which a call of a handler is slow, in seconds
+        :param history: Number of cycles kept in `cycles`
+        """
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self.phases = {}
+        self.handlers = {}
+        self.lag = Histogram(LAG_BUCKETS)
+        #: The durations of the phases of the last cycles, as dicts mapping the phases to seconds, oldest first
+        self.cycles = deque(maxlen=history)
+
+    def observePhase(self, phase, seconds):
+        """Records the duration of a phase outside of a cycle, e.g. a ping"""
+        with self._lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def observeCycle(self, phases):
+        """Records a cycle of the listener
+
+        :param phases: a dict mapping the phases of the cycle to their duration, in seconds
+        """
+        with self._lock:
+            for phase, seconds in phases.items():
+                histogram = self.phases.get(phase)
+                if histogram is None:
+                    histogram = self.phases[phase] = Histogram(LATENCY_BUCKETS)
+                histogram.observe(seconds)
+            self.cycles.append(phases)
+
+    def observeHandler(self, handler, seconds):
+        """Records a call of an event handler"""
+        with self._lock:
+            stats = self.handlers.get(handler)
+            if stats is None:
+                stats = self.handlers[handler] = _HandlerStats()
+            stats.durations.observe(seconds)
+            if seconds > self.slow_threshold:
+                stats.slow += 1
+
+    def observeLag(self, m):
+        """Records the lag of a message received while listening, if it has a timestamp"""
+        if m.get('type') != 'delta':
+            return
+        metadata = (m.get('delta') or {}).get('messageMetadata')
+        if not metadata or 'timestamp' not in metadata:
+            return
+        lag = time() - int(metadata['timestamp']) / 1000.0
+        with self._lock:
+            self.lag.observe(lag)
+
+    def slowHandlers(self):
+        """Returns the handlers which were slow at least once, the ones taking the most time in total first
+
+        :return: a list of dicts with the keys `handler` (its name, see `handlerName`, followed by its id if other
+                 handlers have the same name), `calls`, `slow_calls`, `total`, `max` and `p99` (in seconds)
+        """
+        with self._lock:
+            labels = _handlerLabels(self.handlers)
+            slow = [{
+                'handler': labels[handler],
+                'calls': stats.durations.count,
+                'slow_calls': stats.slow,
+                'total': stats.durations.sum,
+                'max': stats.durations.max,
+                'p99': stats.durations.percentile(99),
+            } for handler, stats in self.handlers.items() if stats.slow]
+        return sorted(slow, key=lambda s: s['total'], reverse=True)
+
+    def stats(self):
+        """Returns a snapshot of the profile
+
+        :return: a dict with the keys `phases` (mapping the phases to `Histogram.stats`), `handlers` (mapping the names
+                 of the handlers, as in `slowHandlers`, to `Histogram.stats` of their duration), `lag` (`Histogram.stats`
+                 of the event lag) and `slow_handlers` (see `slowHandlers`)
+        """
+        with self._lock:
+            labels = _handlerLabels(self.handlers)
+            stats = {
+                'phases': dict((phase, histogram.stats()) for phase, histogram in self.phases.items()),
+                'handlers': dict((labels[handler], stats.durations.stats()) for handler, stats in self.handlers.items()),
+                'lag': self.lag.stats(),
+            }
+        stats['slow_handlers'] = self.slowHandlers()
+        return stats
+
+    def report(self):
+        """Returns a human readable summary of the profile"""
+        def ms(seconds):
+            return '-' if seconds is None else '{:.1f} ms'.format(seconds * 1e3)
+
+        stats = self.stats()
+        lines = ['{:<40} {:>8} {:>12} {:>12} {:>12}'.format('phase', 'count', 'p50', 'p99', 'max')]
+        for phase, h in sorted(stats['phases'].items()):
+            lines.append('{:<40} {:>8} {:>12} {:>12} {:>12}'.format(phase, h['count'], ms(h['p50']), ms(h['p99']), ms(h['max'])))
+        h = stats['lag']
+        lines.append('{:<40} {:>8} {:>12} {:>12} {:>12}'.format('event lag', h['count'], ms(h['p50']), ms(h['p99']), ms(h['max'])))
+        if stats['slow_handlers']:
+            lines.append('')
+            lines.append('Handlers slower than {}:'.format(ms(self.slow_threshold)))
+            for s in stats['slow_handlers']:
+                lines.append('  {} : {} of {} calls slow, {} in total, max {}'.format(
+                    s['handler'], s['slow_calls'], s['calls'], ms(s['total']), ms(s['max'])))
+        return '\n'.join(lines)
@@ -0,0 +1,152 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.retry
+    ~~~~~~~~~~~~
+
+    Retrying of failed requests, with exponential backoff and a circuit breaker
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import threading
+import time
+from random import random
+from .models import FBchatException
+
+
+class CircuitOpenError(FBchatException):
+    """Raised instead of sending a request to an endpoint that keeps failing"""
+
+    def __init__(self, endpoint, retry_after):
+        super(CircuitOpenError, self).__init__("Too many failures of %s, retry in %.1f seconds" % (endpoint, retry_after))
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Stops requests to an endpoint after `failure_threshold` consecutive failures.
+    After `recovery_timeout` seconds, a single request is let through again: if it succeeds the endpoint
+    is used normally again, otherwise it stays blocked for another `recovery_timeout` seconds.
+    """
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._failures = {}
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    def retryAfter(self, endpoint):
+        """Returns the number of seconds until requests to `endpoint` are allowed again, 0 if they are allowed now"""
+        with self._lock:
+            opened = self._opened.get(endpoint)
+            if opened is None:
+                return 0
+            return max(0, opened + self.recovery_timeout - time.monotonic())
+
+    def before(self, endpoint):
+        """Raises `CircuitOpenError` if requests to `endpoint` aren't allowed"""
+        with self._lock:
+            opened = self._opened.get(endpoint)
+            if opened is None:
+                return
+            now = time.monotonic()
+            if now < opened + self.recovery_timeout:
+                raise CircuitOpenError(endpoint, opened + self.recovery_timeout - now)
+            # Half-open: let this request through, and hold back the others until we know how it went
+            self._opened[endpoint] = now
+
+    def success(self, endpoint):
+        with self._lock:
+            self._failures.pop(endpoint, None)
+            self._opened.pop(endpoint, None)
+
+    def failure(self, endpoint):
+        with self._lock:
+            failures = self._failures[endpoint] = self._failures.get(endpoint, 0) + 1
+            if failures >= self.failure_threshold:
+                self._opened[endpoint] = time.monotonic()
+
+
+def _status(r):
+    # `requests` responses have `status_code`, `aiohttp` responses have `status`
+    return getattr(r, 'status_code', None) or getattr(r, 'status', None)
+
+
+class RetryPolicy(object):
+    """Retries requests failing with a connection error or a status in `retry_statuses`,
+    waiting a random time of up to `backoff_factor * 2 ** attempt` seconds (capped to `max_backoff`) in between.
+    The clients also retry the GETs which timed out, except the long-poll of the listener, which times out when idle.
+    POSTs which timed out aren't retried: they may have been received, and unlike sends, most aren't deduplicated.
+
+    A request is retried with exactly the same data. This makes retrying sends safe, since Facebook
+    deduplicates messages with the same `offline_threading_id`.
+    """
+
+    def __init__(self, max_retries=3, backoff_factor=0.5, max_backoff=30, retry_statuses=(429, 500, 502, 503, 504), breaker=None):
+        """
+        :param max_retries: Maximum number of times to retry a request
+        :param backoff_factor: Base of the exponential backoff, in seconds
+        :param max_backoff: Maximum time to wait between two attempts, in seconds
+        :param retry_statuses: HTTP statuses that should be retried
+        :param breaker: The `CircuitBreaker` to use. If `None`, a default one is created
+        """
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retry_statuses = frozenset(retry_statuses)
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+    def backoff(self, attempt):
+        """Returns the time to wait before retrying after the `attempt`th failure (starting at 0), with full jitter"""
+        return random() * min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+
+    def call(self, endpoint, request, exceptions):
+        """Calls `request` until it succeeds, or until it has failed too many times
+
+        :param endpoint: the endpoint the circuit breaker keeps track of
+        :param request: a function sending the request, and returning the response
+        :param exceptions: a tuple of the exceptions that should be retried
+        :return: the response
+        """
+        attempt = 0
+        while True:
+            self.breaker.before(endpoint)
+            try:
+                r = request()
+            except exceptions:
+                self.breaker.failure(endpoint)
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if _status(r) not in self.retry_statuses:
+                    self.breaker.success(endpoint)
+                    return r
+                self.breaker.failure(endpoint)
+                if attempt >= self.max_retries:
+                    return r
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def acall(self, endpoint, request, exceptions):
+        """Same as `call`, where `request` returns an awaitable"""
+        import asyncio
+        attempt = 0
+        while True:
+            self.breaker.before(endpoint)
+            try:
+                r = await request()
+            except exceptions:
+                self.breaker.failure(endpoint)
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if _status(r) not in self.retry_statuses:
+                    self.breaker.success(endpoint)
+                    return r
+                self.breaker.failure(endpoint)
+                if attempt >= self.max_retries:
+                    return r
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
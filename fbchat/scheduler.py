@@ -0,0 +1,216 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.scheduler
+    ~~~~~~~~~~~~~~~~
+
+    Rate limiting and prioritization of outgoing requests
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import bisect
+import threading
+from enum import Enum
+from itertools import count
+from time import monotonic
+
+
+class Priority(Enum):
+    """Lanes of the scheduler. Requests in a lower lane are let through first"""
+    INTERACTIVE = 0
+    BULK = 1
+
+
+class TokenBucket(object):
+    """A token bucket, refilled with `rate` tokens per second, holding at most `burst` tokens.
+    It isn't thread-safe by itself, the scheduler owning it takes care of that.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now):
+        self._refill(now)
+        return self.tokens >= 1
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def delay(self, now):
+        """Returns the number of seconds until a token will be available"""
+        self._refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _Waiter(object):
+    def __init__(self, priority, order, thread_id):
+        self.key = (priority.value, order)
+        self.priority = priority
+        self.thread_id = thread_id
+        self.queued = monotonic()
+        self.granted = False
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class OutboundScheduler(object):
+    """Smooths outgoing requests, to avoid getting throttled by Facebook.
+
+    Requests are let through when there's a token in both the account-wide bucket (`rate` requests per second,
+    with bursts of `burst` requests) and the bucket of the thread they're sent to (`thread_rate` and `thread_burst`).
+    Waiting requests are let through by order of priority (see `Priority`), and then in the order they arrived,
+    but a request waiting for its thread's bucket doesn't hold up the requests to other threads.
+
+    Any object with an `acquire(thread_id, priority)` method can be used as a scheduler by `Client`.
+    `AsyncClient` uses its `aacquire(thread_id, priority)` coroutine if it has one.
+    """
+
+    #: Number of per-thread buckets to keep before forgetting the ones that are full
+    max_thread_buckets = 1024
+
+    def __init__(self, rate=None, burst=None, thread_rate=None, thread_burst=None):
+        """
+        :param rate: Maximum sustained number of requests per second for the account. `None` means no limit
+        :param burst: Maximum number of requests let through at once for the account. Defaults to `rate`
+        :param thread_rate: Maximum sustained number of requests per second to a single thread. `None` means no limit
+        :param thread_burst: Maximum number of requests let through at once to a single thread. Defaults to `thread_rate`
+        """
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self.thread_rate = thread_rate
+        self.thread_burst = thread_burst
+        self._thread_buckets = {}
+        self._waiters = []
+        self._order = count()
+        self._cond = threading.Condition()
+
+        self._acquired = dict((p, 0) for p in Priority)
+        self._total_wait = dict((p, 0.0) for p in Priority)
+        self._max_wait = dict((p, 0.0) for p in Priority)
+
+    def _threadBucket(self, thread_id, now):
+        if self.thread_rate is None or thread_id is None:
+            return None
+        bucket = self._thread_buckets.get(thread_id)
+        if bucket is None:
+            if len(self._thread_buckets) >= self.max_thread_buckets:
+                # A full bucket behaves exactly like a new one, so it can safely be forgotten
+                self._thread_buckets = dict((k, b) for k, b in self._thread_buckets.items() if not b.full(now))
+            bucket = self._thread_buckets[thread_id] = TokenBucket(self.thread_rate, self.thread_burst)
+        return bucket
+
+    def _dispatch(self):
+        """Lets through as many waiting requests as the buckets allow.
+        Must be called with `self._cond` held.
+
+        :return: the number of seconds until a waiting request might be let through, or `None` if none are waiting
+        """
+        now = monotonic()
+        delay = None
+        remaining = []
+        for i, waiter in enumerate(self._waiters):
+            if self._bucket is not None and not self._bucket.available(now):
+                remaining.extend(self._waiters[i:])
+                delay = self._bucket.delay(now) if delay is None else min(delay, self._bucket.delay(now))
+                break
+            thread_bucket = self._threadBucket(waiter.thread_id, now)
+            if thread_bucket is not None and not thread_bucket.available(now):
+                remaining.append(waiter)
+                delay = thread_bucket.delay(now) if delay is None else min(delay, thread_bucket.delay(now))
+                continue
+            if self._bucket is not None:
+                self._bucket.consume(now)
+            if thread_bucket is not None:
+                thread_bucket.consume(now)
+            waiter.granted = True
+
+        if len(remaining) != len(self._waiters):
+            self._waiters = remaining
+            self._cond.notify_all()
+        return delay
+
+    def acquire(self, thread_id=None, priority=Priority.INTERACTIVE):
+        """Blocks until a request to `thread_id` may be sent
+
+        :param thread_id: the thread the request is sent to, or `None` if it isn't sent to a thread
+        :param priority: the lane of the request, see `Priority`
+        :return: the number of seconds spent waiting
+        """
+        waiter = _Waiter(priority, next(self._order), thread_id)
+        with self._cond:
+            bisect.insort(self._waiters, waiter)
+            while True:
+                delay = self._dispatch()
+                if waiter.granted:
+                    break
+                self._cond.wait(delay)
+
+            waited = self._granted(waiter)
+        return waited
+
+    async def aacquire(self, thread_id=None, priority=Priority.INTERACTIVE):
+        """Waits until a request to `thread_id` may be sent, like `acquire`, but sleeping on the event loop
+        instead of blocking a thread. Requests waiting in `acquire` and in `aacquire` share the same lanes
+
+        :return: the number of seconds spent waiting
+        """
+        import asyncio
+
+        waiter = _Waiter(priority, next(self._order), thread_id)
+        with self._cond:
+            bisect.insort(self._waiters, waiter)
+        try:
+            while True:
+                with self._cond:
+                    # It may have been let through by another request while sleeping
+                    if not waiter.granted:
+                        delay = self._dispatch()
+                    if waiter.granted:
+                        return self._granted(waiter)
+                await asyncio.sleep(delay)
+        except BaseException:
+            # Cancelled while waiting, so it mustn't take a token later
+            with self._cond:
+                if not waiter.granted:
+                    self._waiters.remove(waiter)
+            raise
+
+    def _granted(self, waiter):
+        """Records the wait of a request which was let through, and returns it.
+        Must be called with `self._cond` held.
+        """
+        waited = monotonic() - waiter.queued
+        self._acquired[waiter.priority] += 1
+        self._total_wait[waiter.priority] += waited
+        self._max_wait[waiter.priority] = max(self._max_wait[waiter.priority], waited)
+        return waited
+
+    def stats(self):
+        """Returns the current queue depth and the waiting times, in seconds, of each lane
+
+        :return: a dict mapping each `Priority` name to a dict with the keys
+                 `queued`, `acquired`, `average_wait` and `max_wait`
+        """
+        with self._cond:
+            queued = dict((p, 0) for p in Priority)
+            for waiter in self._waiters:
+                queued[waiter.priority] += 1
+            return dict((p.name, {
+                'queued': queued[p],
+                'acquired': self._acquired[p],
+                'average_wait': self._total_wait[p] / self._acquired[p] if self._acquired[p] else 0.0,
+                'max_wait': self._max_wait[p],
+            }) for p in Priority)
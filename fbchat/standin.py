@@ -0,0 +1,428 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.standin
+    ~~~~~~~~~~~~~~
+
+    A local server standing in for Facebook, to benchmark and test the clients offline
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import json
+import threading
+from collections import deque
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from random import Random
+from socketserver import ThreadingMixIn
+from time import monotonic, sleep, time
+from urllib.parse import parse_qsl, urlsplit
+from zlib import crc32
+
+#: The paths of the endpoints the stand-in answers, besides the login pages
+_SEND = '/messaging/send/'
+_UPLOAD = '/ajax/mercury/upload.php'
+_THREADS = '/ajax/mercury/threadlist_info.php'
+_MESSAGES = '/ajax/mercury/thread_info.php'
+_USER_INFO = '/chat/user_info/'
+_PULL = '/pull'
+_PING = '/active_ping'
+_LOGIN = '/login.php'
+_LOGOUT = '/logout.php'
+_HOME = '/home.php'
+#: Images of the users, which can be sent with `sendRemoteImage`
+_PHOTO = '/photo/'
+
+_PAGE = (
+    '<!DOCTYPE html><html><head><title>Facebook</title>'
+    '<script>{{"revision":{revision},"tier":"","push_phase":"C3"}}</script></head><body>'
+    '<form action="/logout.php" method="post">'
+    '<input type="hidden" name="fb_dtsg" value="{fb_dtsg}" autocomplete="off" />'
+    '<input type="hidden" autocomplete="off" name="h" value="{fb_h}"/></form>'
+    '</body></html>'
+)
+
+_LOGIN_PAGE = (
+    '<!DOCTYPE html><html><head><title>Log in to Facebook</title></head><body>'
+    '<form method="post" action="/login.php?login_attempt=1">'
+    '<input type="hidden" name="lsd" value="AVq3Xb8F" autocomplete="off" />'
+    '<input type="hidden" name="m_ts" value="1490000000" />'
+    '<input type="hidden" name="li" value="HSnRWJ2aJ9Tq" />'
+    '<input type="text" name="email" /><input type="password" name="pass" />'
+    '<input type="submit" name="login" value="Log In" /></form>'
+    '</body></html>'
+)
+
+
+class _Listener(object):
+    """The state of the pull api of a user"""
+
+    def __init__(self, now):
+        self.inbox = deque(maxlen=10000)
+        self.seq = 0
+        # When the next generated message is due
+        self.next_message = now
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Many clients connect at once in the benchmarks
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keeps the connections alive, like Facebook does
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, which Nagle's algorithm would delay
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle(dict(parse_qsl(urlsplit(self.path).query)))
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = self._readChunked()
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            data = dict(parse_qsl(body.decode('utf-8')))
+        else:
+            data = {'__body_size': len(body)}
+        data.update(parse_qsl(urlsplit(self.path).query))
+        self._handle(data)
+
+    def _readChunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _handle(self, data):
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        uid = cookie['c_user'].value if 'c_user' in cookie else None
+        path = urlsplit(self.path).path
+        if path.startswith(_PHOTO):
+            status, headers, body = self.server.standin._respondPhoto(path, self.headers.get('If-None-Match'))
+        else:
+            status, headers, body = self.server.standin._respond(self.command, path, data, uid)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(object):
+    """A local HTTP server emulating the endpoints of Facebook used by the clients: logging in, the home page,
+    sending messages, uploading images, the thread list, the messages of a thread, user info, and the pull api.
+    It also serves the images of the users, at the URLs of their info (`thumbSrc`), with an ETag.
+
+    Any email and password log in, as a user whose id is the email if it's a number, or derived from it otherwise.
+    Messages sent to a user listening are delivered to them by the pull api, along with `message_rate` messages
+    per second generated for each listener. Requests to the api (not the login pages) are answered after `latency`
+    seconds, and fail with a 500 status with a probability of `error_rate`.
+
+    Use it as a context manager, which starts it and points the clients to it::
+
+        with StandInServer(latency=0.05) as server:
+            client = Client('user@example.com', 'password')
+            client.sendMessage('Hi', '100000000000002', ThreadType.USER)
+    """
+
+    def __init__(self, latency=0, error_rate=0, message_rate=0, poll_timeout=1, host='127.0.0.1', port=0, seed=None):
+        """
+        :param latency: Seconds taken to answer a request to the api
+        :param error_rate: Probability of a request to the api failing, between 0 and 1
+        :param message_rate: Messages per second generated for each user listening
+        :param poll_timeout: Seconds a long-poll of the pull api is held without any message, before a heartbeat is sent
+        :param host: The address to listen on
+        :param port: The port to listen on, 0 to use a free one
+        :param seed: The seed of the random errors, to make them reproducible
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.message_rate = message_rate
+        self.poll_timeout = poll_timeout
+        self.fb_dtsg = 'AQH3u6Y_a-Ng:AQHsD9BtR0Fm'
+        self.fb_h = 'AfdC8EwWbMXi2e7M'
+        self.revision = 3000001
+        self._random = Random(seed)
+        self._cond = threading.Condition()
+        self._listeners = {}
+        self._message_ids = 0
+        self._image_ids = 0
+        self._requests = {}
+        self._errors = {}
+        self._server = _Server((host, port), _Handler)
+        self._server.standin = self
+        self._thread = None
+        self._running = False
+        self._originals = None
+
+    @property
+    def url(self):
+        """The base URL of the server"""
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        """Serves the requests in a background thread"""
+        self._running = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fbchat-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving, and closes the server"""
+        with self._cond:
+            # Returns the long-polls in progress
+            self._running = False
+            self._cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread = None
+
+    def urls(self):
+        """Returns a dict mapping the names of the URLs in `fbchat.client` (e.g. `SendURL`) to the ones of the server"""
+        from . import client
+        urls = {}
+        for name, value in vars(client).items():
+            if name.endswith('URL') and isinstance(value, str):
+                parts = urlsplit(value)
+                urls[name] = self.url + parts.path + ('?' + parts.query if parts.query else '')
+        return urls
+
+    def install(self):
+        """Points the clients to the server, until `uninstall`. `AsyncClient` reads its URLs from `fbchat.client` too,
+        so it doesn't matter whether it's imported before or after
+        """
+        from . import client
+        urls = self.urls()
+        if self._originals is None:
+            self._originals = dict((name, getattr(client, name)) for name in urls)
+        for name, url in urls.items():
+            setattr(client, name, url)
+
+    def uninstall(self):
+        """Points the clients back to Facebook"""
+        if self._originals is None:
+            return
+        from . import client
+        for name, url in self._originals.items():
+            setattr(client, name, url)
+        self._originals = None
+
+    def __enter__(self):
+        self.start()
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+        self.stop()
+
+    def expireTokens(self):
+        """Changes the session tokens, so requests with the old ones fail like with an outdated fb_dtsg (error 1357004)"""
+        self.fb_dtsg = 'AQ{:08x}:AQ{:08x}'.format(self._random.getrandbits(32), self._random.getrandbits(32))
+
+    def stats(self):
+        """Returns the number of requests received, and of the ones failed on purpose, by path"""
+        with self._cond:
+            return {'requests': dict(self._requests), 'errors': dict(self._errors)}
+
+    def _respond(self, method, path, data, uid):
+        """Returns the status, the headers and the body answering a request"""
+        with self._cond:
+            self._requests[path] = self._requests.get(path, 0) + 1
+        # The login pages are neither delayed nor failed, so clients always manage to log in
+        if path in ('/', '/m/', _HOME, _LOGIN, _LOGOUT) or path.startswith('/login/'):
+            return self._respondPage(method, path, data, uid)
+
+        if self.latency and path != _PULL:
+            sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            with self._cond:
+                self._errors[path] = self._errors.get(path, 0) + 1
+            return 500, [], b'Internal Server Error'
+
+        uid = data.get('__user') or uid
+        if method == 'POST' and path != _UPLOAD and data.get('fb_dtsg') != self.fb_dtsg:
+            return self._json({'error': 1357004, 'errorDescription': 'Please try closing and re-opening your browser window.'})
+        if path == _SEND:
+            return self._json(self._send(uid, data))
+        if path == _UPLOAD:
+            return self._json(self._upload(data))
+        if path == _THREADS:
+            return self._json(self._threads(data))
+        if path == _MESSAGES:
+            return self._json(self._messages(data))
+        if path == _USER_INFO:
+            return self._json(self._userInfo(data))
+        if path == _PULL:
+            return self._json(self._pull(data))
+        if path == _PING:
+            return self._json({'t': 'pong'})
+        return self._json({'payload': {}})
+
+    def _respondPhoto(self, path, etag):
+        """Returns the status, the headers and the body answering a request for an image, which may be conditional"""
+        with self._cond:
+            self._requests[_PHOTO] = self._requests.get(_PHOTO, 0) + 1
+        # Not a real image, but the same bytes for the same path
+        body = b'\x89PNG\r\n\x1a\n' + path.encode('utf-8') * 64
+        current = '"{:08x}"'.format(crc32(body))
+        if etag == current:
+            return 304, [('ETag', current)], b''
+        return 200, [('Content-Type', 'image/png'), ('ETag', current)], body
+
+    def _json(self, j):
+        return 200, [('Content-Type', 'application/javascript')], ('for (;;);' + json.dumps(j)).encode('utf-8')
+
+    def _respondPage(self, method, path, data, uid):
+        if path == _LOGIN and method == 'POST':
+            if not data.get('email') or not data.get('pass'):
+                return 200, [], _LOGIN_PAGE.encode('utf-8')
+            email = data['email']
+            uid = email if email.isdigit() else str(100000000000000 + crc32(email.encode('utf-8')))
+            cookies = [('Set-Cookie', 'c_user={}; Path=/'.format(uid)), ('Set-Cookie', 'xs=1%3Astandin; Path=/')]
+            return 302, [('Location', _HOME)] + cookies, b''
+        if path == _LOGOUT:
+            return 302, [('Location', '/'), ('Set-Cookie', 'c_user=deleted; Path=/; Max-Age=0')], b''
+        if uid is None:
+            return 200, [], _LOGIN_PAGE.encode('utf-8')
+        if path == _LOGIN or path.startswith('/login/'):
+            return 302, [('Location', _HOME)], b''
+        return 200, [], _PAGE.format(revision=self.revision, fb_dtsg=self.fb_dtsg, fb_h=self.fb_h).encode('utf-8')
+
+    def _newMessage(self, mid, author_id, thread_id, body):
+        return {
+            'type': 'delta',
+            'delta': {
+                'class': 'NewMessage',
+                'body': body,
+                'messageMetadata': {
+                    'messageId': mid,
+                    'actorFbId': author_id,
+                    'timestamp': str(int(time() * 1000)),
+                    'threadKey': {'otherUserFbId': thread_id},
+                },
+            },
+        }
+
+    def _nextMessageId(self):
+        # Called with the lock held
+        self._message_ids += 1
+        return 'mid.$standin{:012d}'.format(self._message_ids)
+
+    def _send(self, uid, data):
+        thread_id = data.get('other_user_fbid') or data.get('thread_fbid')
+        with self._cond:
+            mid = self._nextMessageId()
+            # Delivered to the recipient if they listen, for a user thread
+            listener = self._listeners.get(data.get('other_user_fbid'))
+            if listener is not None:
+                listener.inbox.append(self._newMessage(mid, uid, uid, data.get('body', '')))
+                self._cond.notify_all()
+        return {'payload': {'actions': [{
+            'message_id': mid,
+            'thread_fbid': thread_id,
+            'timestamp': int(time() * 1000),
+            'offline_threading_id': data.get('offline_threading_id'),
+        }]}}
+
+    def _upload(self, data):
+        with self._cond:
+            self._image_ids += 1
+            image_id = self._image_ids
+        return {'payload': {'metadata': [{'image_id': image_id, 'filetype': 'image/png', 'size': data.get('__body_size', 0)}]}}
+
+    def _threads(self, data):
+        limit = int(data.get('inbox[limit]', 20))
+        offset = int(data.get('inbox[offset]', 0))
+        ids = [100000000000100 + offset + i for i in range(limit)]
+        return {'payload': {
+            'participants': [{'fbid': fbid, 'name': 'User {}'.format(fbid)} for fbid in ids],
+            'threads': [{
+                'thread_id': str(fbid),
+                'thread_fbid': str(fbid),
+                'other_user_fbid': fbid,
+                'snippet': 'Hi',
+                'unread_count': 0,
+                'timestamp': int(time() * 1000),
+            } for fbid in ids],
+        }}
+
+    def _messages(self, data):
+        actions = []
+        for key, value in data.items():
+            # e.g. messages[user_ids][100000000000002][limit]
+            if key.startswith('messages[') and key.endswith('[limit]'):
+                thread_id = key.split('][')[1]
+                now = int(time() * 1000)
+                actions += [{
+                    'message_id': 'mid.$standinhistory{}'.format(i),
+                    'author': 'fbid:{}'.format(thread_id),
+                    'body': 'Message {}'.format(i),
+                    'thread_fbid': thread_id,
+                    'timestamp': now - i * 1000,
+                } for i in range(int(value) + 1)]
+        return {'payload': {'actions': actions} if actions else None}
+
+    def _userInfo(self, data):
+        ids = [value for key, value in data.items() if key.startswith('ids[')]
+        return {'payload': {'profiles': dict((uid, {
+            'id': uid,
+            'name': 'User {}'.format(uid),
+            'firstName': 'User',
+            'vanity': '',
+            'uri': '{}/profile.php?id={}'.format(self.url, uid),
+            'thumbSrc': '{}/photo/{}.jpg'.format(self.url, uid),
+            'gender': 2,
+            'type': 'friend',
+            'is_friend': True,
+        }) for uid in ids)}}
+
+    def _pull(self, data):
+        if 'sticky_token' not in data:
+            # The first call of the pull api only gets the parameters of the next ones. The user is the sticky token
+            uid = data.get('channel', '')[2:] or data.get('__user')
+            with self._cond:
+                if uid not in self._listeners:
+                    self._listeners[uid] = _Listener(monotonic())
+            return {'t': 'lb', 'lb_info': {'sticky': uid, 'pool': 'standin'}}
+
+        with self._cond:
+            listener = self._listeners.get(data['sticky_token'])
+            if listener is None:
+                listener = self._listeners[data['sticky_token']] = _Listener(monotonic())
+            deadline = monotonic() + self.poll_timeout
+            while self._running:
+                now = monotonic()
+                if self.message_rate:
+                    # Catching up for at most a second, after a pause of the listener
+                    listener.next_message = max(listener.next_message, now - 1)
+                    while listener.next_message <= now:
+                        author_id = str(100000000000100 + self._random.randrange(20))
+                        listener.inbox.append(self._newMessage(self._nextMessageId(), author_id, author_id, 'Message {}'.format(self._message_ids)))
+                        listener.next_message += 1.0 / self.message_rate
+                if listener.inbox or now >= deadline:
+                    break
+                wakeup = min(deadline, listener.next_message) if self.message_rate else deadline
+                self._cond.wait(wakeup - now)
+            ms = list(listener.inbox)
+            listener.inbox.clear()
+            listener.seq += len(ms)
+            seq = listener.seq
+
+        if not ms:
+            return {'t': 'heartbeat', 'seq': seq}
+        return {'t': 'msg', 'seq': seq, 'ms': ms}
@@ -0,0 +1,73 @@
+# -*- coding: UTF-8 -*-
+
+"""
+    fbchat.tokens
+    ~~~~~~~~~~~~~
+
+    Extraction of the tokens and form inputs of Facebook's pages, without building a DOM of the whole page
+
+    :license: BSD, see LICENSE for more details.
+"""
+
+import re
+from html import unescape
+
+_input_re = re.compile(r'<input\b([^>]*)>', re.IGNORECASE)
+_attr_re = re.compile(r'''([^\s"'<>/=]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+))''')
+_revision_re = re.compile(r'"revision":\s*(\d+)')
+
+
+def _attrs(tag):
+    attrs = {}
+    for m in _attr_re.finditer(tag):
+        name = m.group(1).lower()
+        # Like in a browser, the first occurence of an attribute wins
+        if name not in attrs:
+            value = m.group(2)
+            if value is None:
+                value = m.group(3) if m.group(3) is not None else m.group(4)
+            attrs[name] = unescape(value)
+    return attrs
+
+
+def _soup(html):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, "lxml")
+
+
+def findInputs(html):
+    """Returns a dict mapping the names of the `<input>` elements of `html` which have a value to their values.
+    If several inputs have the same name, the last one wins
+    """
+    inputs = {}
+    for m in _input_re.finditer(html):
+        attrs = _attrs(m.group(1))
+        if 'name' in attrs and 'value' in attrs:
+            inputs[attrs['name']] = attrs['value']
+    if not inputs and '<input' in html.lower():
+        # Markup we don't understand, let BeautifulSoup make sense of it
+        soup = _soup(html)
+        inputs = dict((elem['name'], elem['value']) for elem in soup.findAll("input") if elem.has_attr('value') and elem.has_attr('name'))
+    return inputs
+
+
+def findInput(html, name):
+    """Returns the value of the first `<input>` element of `html` named `name`, or `None` if there is none"""
+    if name not in html:
+        return None
+    # Most inputs of a page aren't the one we're looking for, so avoid parsing their attributes
+    for m in _input_re.finditer(html):
+        tag = m.group(1)
+        if name not in tag:
+            continue
+        attrs = _attrs(tag)
+        if attrs.get('name') == name:
+            return attrs.get('value')
+    elem = _soup(html).find("input", {'name': name})
+    return elem.get('value') if elem is not None else None
+
+
+def findRevision(html):
+    """Returns the revision of Facebook's code the page was built with, or `None` if it can't be found"""
+    m = _revision_re.search(html)
+    return int(m.group(1)) if m else None
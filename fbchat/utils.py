@@ -3,6 +3,19 @@ import json
 from time import time
 from random import random
 
+# Use the fastest available JSON decoder. Only orjson can decode a memoryview without copying it
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_loads_view = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        _json_loads = ujson.loads
+    except ImportError:
+        _json_loads = json.loads
+    _json_loads_view = lambda view: _json_loads(view.tobytes())
+
 USER_AGENTS = [
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/42.0.2311.90 Safari/537.36",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_3) AppleWebKit/601.1.10 (KHTML, like Gecko) Version/8.0.5 Safari/601.1.10",
@@ -30,10 +43,28 @@ def now():
     return int(time()*1000)
 
 def strip_to_json(text):
-    return text[text.index('{'):]
+    return text[text.index('{' if isinstance(text, str) else b'{'):]
+
+def get_json(content):
+    """Parses a response from Facebook, stripping the `for (;;);` guard in front of the JSON
 
-def get_json(text):
-    return json.loads(strip_to_json(text))
+    :param content: the response body, either as bytes (preferred, avoids decoding it to a str first) or as a str
+    """
+    try:
+        if isinstance(content, str):
+            return _json_loads(strip_to_json(content))
+        return _json_loads_view(memoryview(content)[content.index(b'{'):])
+    except ValueError:
+        if _json_loads is json.loads:
+            raise
+        # The faster decoders are stricter, e.g. orjson refuses lone surrogates
+        return json.loads(strip_to_json(content))
+
+def guess_mimetype(path):
+    """Returns the MIME type of the file at `path` (or URL), guessed from its extension, or `None`"""
+    # `mimetypes` reads the system's MIME databases when it's imported, so only do it when it's needed
+    from mimetypes import guess_type
+    return guess_type(path)[0]
 
 def digit_to_char(digit):
     if digit < 10:
@@ -59,6 +90,37 @@ def getSignatureID():
 def generateOfflineThreadingID():
     ret = now()
     value = int(random() * 4294967295)
-    string = ("0000000000000000000000" + bin(value))[-22:]
+    # The last 22 bits of `value`. `bin` starts with '0b', which mustn't end up in them
+    string = format(value & 0x3fffff, '022b')
     msgs = bin(ret) + string
     return str(int(msgs, 2))
+
+#: Maximum number of characters of a payload (e.g. a page or a response) written in the logs
+LOG_LIMIT = 1000
+
+class Truncated(object):
+    """Wraps a payload logged as an argument of a log message, e.g. `log.debug("Received %s", Truncated(content))`,
+    so at most `limit` characters of it are written. Like the other arguments, it's only formatted if the message is emitted,
+    and containers are formatted with `reprlib`, so a large one doesn't cost more than a small one
+    """
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = LOG_LIMIT if limit is None else limit
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, (str, bytes)):
+            text = value[:self.limit + 1]
+            text = text.decode('utf-8', 'replace') if isinstance(text, bytes) else text
+        else:
+            import reprlib
+            r = reprlib.Repr()
+            r.maxlevel, r.maxlist, r.maxdict, r.maxstring, r.maxother = 4, 20, 20, 200, 200
+            text = r.repr(value)
+        if len(text) <= self.limit:
+            return text
+        if isinstance(value, (str, bytes)):
+            return '{}... ({} {} in total)'.format(text[:self.limit], len(value), 'bytes' if isinstance(value, bytes) else 'characters')
+        return text[:self.limit] + '...'
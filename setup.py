@@ -72,6 +72,10 @@ setup(
         'lxml',
         'beautifulsoup4'
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'speedups': ['orjson'],
+    },
     url=source,
     version=version,
     zip_safe=True,
@@ -0,0 +1,625 @@
+#!/usr/bin/env python
+
+import asyncio
+import logging
+import fbchat
+import os
+import tempfile
+import threading
+import time
+import unittest
+from fbchat import StandInServer, RetryPolicy, CircuitBreaker, PullJournal, UploadCache, Metrics, ListenProfiler
+from fbchat.event_hook import EventHook
+from fbchat.journal import readJournal
+from fbchat.models import ThreadType, FBchatException
+from fbchat.scheduler import OutboundScheduler, Priority
+from fbchat.utils import get_json
+
+# Disable logging
+logging.basicConfig(level=100)
+fbchat.log.setLevel(100)
+
+"""
+
+Offline tests for fbchat
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+These tests run the clients against a `StandInServer` on localhost, so they need neither an account nor a network:
+
+    $ python -m unittest tests_offline
+
+"""
+
+RECIPIENT = '100000000000002'
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def login(email='sender@example.com', **kwargs):
+    client = fbchat.Client(email, 'password', debug=False, info_log=False, **kwargs)
+    fbchat.log.setLevel(100)
+    return client
+
+
+def alogin(email='sender@example.com', **kwargs):
+    client = fbchat.AsyncClient(email, 'password', debug=False, info_log=False, **kwargs)
+    fbchat.log.setLevel(100)
+    return client
+
+
+class StandInTestCase(unittest.TestCase):
+    server_options = {}
+
+    def setUp(self):
+        self.server = StandInServer(**self.server_options).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+
+class TestSend(StandInTestCase):
+    def test_send(self):
+        client = login()
+        self.assertEqual(len(client.sendMessage('Hi', RECIPIENT, ThreadType.USER)), 1)
+        self.assertEqual(self.server.stats()['requests']['/messaging/send/'], 1)
+
+    def test_send_error(self):
+        client = login()
+        self.server._send = lambda uid, data: {'error': 1545012, 'errorDescription': 'Not sent'}
+        self.assertFalse(client.sendMessage('Hi', RECIPIENT, ThreadType.USER))
+
+    def test_send_unexpected_response(self):
+        client = login()
+        self.server._send = lambda uid, data: {'payload': {}}
+        self.assertFalse(client.sendMessage('Hi', RECIPIENT, ThreadType.USER))
+        with self.assertRaises(FBchatException):
+            client._parseSendResponse(b'for (;;);{"payload": {}}')
+
+    def test_sendMessages_bad_item(self):
+        client = login()
+        results = client.sendMessages([
+            ('Hi', RECIPIENT, ThreadType.USER),
+            # No default thread is set
+            ('Hi', None, ThreadType.USER),
+            ('Hi', RECIPIENT, ThreadType.USER),
+        ])
+        self.assertEqual(len(results[0]), 1)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(len(results[2]), 1)
+
+
+class TestUploadCache(StandInTestCase):
+    def setUp(self):
+        super(TestUploadCache, self).setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'uploads.json')
+
+    def uploads(self):
+        return self.server.stats()['requests'].get('/ajax/mercury/upload.php', 0)
+
+    def test_local_image(self):
+        image = os.path.join(self.directory.name, 'image.png')
+        with open(image, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + os.urandom(4096))
+
+        client = login(upload_cache=UploadCache(path=self.path))
+        self.assertTrue(client.sendLocalImage(image, 'Hi', RECIPIENT, ThreadType.USER))
+        self.assertTrue(client.sendLocalImage(image, 'Again', RECIPIENT, ThreadType.USER))
+        self.assertEqual(self.uploads(), 1)
+
+        # After a restart
+        client = login(upload_cache=UploadCache(path=self.path))
+        self.assertTrue(client.sendLocalImage(image, 'Hi', RECIPIENT, ThreadType.USER))
+        self.assertEqual(self.uploads(), 1)
+
+    def test_remote_image(self):
+        image_url = self.server.url + '/photo/' + RECIPIENT + '.png'
+
+        client = login(upload_cache=UploadCache(path=self.path))
+        self.assertTrue(client.sendRemoteImage(image_url, 'Hi', RECIPIENT, ThreadType.USER))
+        self.assertTrue(client.sendRemoteImage(image_url, 'Again', RECIPIENT, ThreadType.USER))
+        self.assertEqual(self.uploads(), 1)
+
+        # After a restart
+        client = login(upload_cache=UploadCache(path=self.path))
+        self.assertTrue(client.sendRemoteImage(image_url, 'Hi', RECIPIENT, ThreadType.USER))
+        self.assertEqual(self.uploads(), 1)
+        # The image was only checked again, and not downloaded
+        self.assertEqual(self.server.stats()['requests']['/photo/'], 3)
+
+
+class TestRetry(StandInTestCase):
+    server_options = {'error_rate': 1}
+
+    def test_retried(self):
+        client = login()
+        client.retry_policy = RetryPolicy(max_retries=2, backoff_factor=0, breaker=CircuitBreaker(failure_threshold=100))
+        self.assertFalse(client.sendMessage('Hi', RECIPIENT, ThreadType.USER))
+        self.assertEqual(self.server.stats()['errors']['/messaging/send/'], 3)
+
+    def test_transient_errors(self):
+        self.server.error_rate = 0.5
+        client = login()
+        client.retry_policy = RetryPolicy(max_retries=20, backoff_factor=0, breaker=CircuitBreaker(failure_threshold=100))
+        for i in range(5):
+            self.assertTrue(client.sendMessage('Hi', RECIPIENT, ThreadType.USER))
+
+    def test_circuit_breaker(self):
+        client = login()
+        client.retry_policy = RetryPolicy(max_retries=0, breaker=CircuitBreaker(failure_threshold=2, recovery_timeout=60))
+        for i in range(4):
+            self.assertFalse(client.sendMessage('Hi', RECIPIENT, ThreadType.USER))
+        # The last ones weren't sent, the circuit being open
+        self.assertEqual(self.server.stats()['requests']['/messaging/send/'], 2)
+
+
+class TestSession(StandInTestCase):
+    def test_revalidate(self):
+        client = login()
+        generation = client._session_generation
+        self.server.expireTokens()
+        self.assertTrue(client.sendMessage('Hi', RECIPIENT, ThreadType.USER))
+        self.assertGreater(client._session_generation, generation)
+        self.assertEqual(client.payloadDefault['fb_dtsg'], self.server.fb_dtsg)
+
+    def test_refresh_doesnt_hold_lock(self):
+        client = login()
+        respond = self.server._respondPage
+
+        def slow(method, path, data, uid):
+            if path == '/':
+                time.sleep(1)
+            return respond(method, path, data, uid)
+
+        self.server._respondPage = slow
+        refresh = threading.Thread(target=client._postLogin, kwargs={'keep_client_id': True})
+        refresh.start()
+        time.sleep(0.2)
+        start = time.perf_counter()
+        with client._lock:
+            waited = time.perf_counter() - start
+        refresh.join()
+        self.assertLess(waited, 0.5)
+
+
+class TestListen(StandInTestCase):
+    server_options = {'poll_timeout': 0.2}
+
+    def setUp(self):
+        super(TestListen, self).setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.journal = PullJournal(self.directory.name)
+        self.addCleanup(self.journal.close)
+        self.listener = login(RECIPIENT, journal=self.journal)
+        self.received = []
+        self.listener.onMessage += lambda **kwargs: self.received.append(kwargs['mid'])
+        self.listener.startListening()
+        self.addCleanup(self.listener.stopListening)
+
+    def receive(self, count):
+        sender = login()
+        for i in range(count):
+            sender.sendMessage('Message {}'.format(i), RECIPIENT, ThreadType.USER)
+        deadline = time.time() + 5
+        while len(self.received) < count and time.time() < deadline:
+            self.listener.doOneListen(markAlive=False)
+
+    def test_acknowledge(self):
+        self.receive(3)
+        self.assertEqual(len(self.received), 3)
+        self.assertEqual(self.listener.seq, 3)
+
+    def test_outage(self):
+        self.listener.retry_policy = RetryPolicy(max_retries=1, backoff_factor=0, breaker=CircuitBreaker(failure_threshold=100))
+        self.server.error_rate = 1
+        for i in range(3):
+            self.listener.doOneListen(markAlive=False)
+        # Backing off, instead of stopping
+        self.assertEqual(self.listener._listen_failures, 3)
+        self.server.error_rate = 0
+        self.receive(1)
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual(self.listener._listen_failures, 0)
+
+    def test_duplicates(self):
+        self.receive(2)
+        self.journal.close()
+        # The same responses received again, e.g. after reconnecting
+        for timestamp, response in readJournal(self.directory.name):
+            self.listener._parseMessage(get_json(response))
+        self.assertEqual(len(self.received), 2)
+        self.assertEqual(self.listener.duplicates, 2)
+
+    def test_replay(self):
+        self.receive(2)
+        self.journal.close()
+        state = (self.listener.sticky, self.listener.pool, self.listener.seq)
+
+        # While listening, with the messages already received
+        self.assertGreater(self.listener.replay(self.directory.name), 0)
+        self.assertEqual((self.listener.sticky, self.listener.pool, self.listener.seq), state)
+        self.assertEqual(len(self.received), 2)
+
+        # By another client, which isn't listening
+        client = login(RECIPIENT)
+        replayed = []
+        client.onMessage += lambda **kwargs: replayed.append(kwargs['mid'])
+        client.replay(self.directory.name)
+        self.assertEqual(replayed, self.received)
+        self.assertEqual((client.sticky, client.pool, client.seq), (None, None, '0'))
+
+
+class TestMetrics(StandInTestCase):
+    server_options = {'poll_timeout': 0.2}
+
+    def test_requests(self):
+        metrics = Metrics()
+        client = login(metrics=metrics)
+        client.retry_policy = RetryPolicy(max_retries=0, breaker=CircuitBreaker(failure_threshold=100))
+        for i in range(2):
+            client.sendMessage('Hi', RECIPIENT, ThreadType.USER)
+        self.server.error_rate = 1
+        client.sendMessage('Hi', RECIPIENT, ThreadType.USER)
+
+        endpoint = self.server.url + '/messaging/send/'
+        send = metrics.stats()['requests'][endpoint]
+        self.assertEqual(send['count'], 3)
+        self.assertEqual(send['statuses'], {200: 2, 500: 1})
+        self.assertGreater(send['sent_bytes'], 0)
+        self.assertGreater(send['received_bytes'], 0)
+        self.assertEqual(send['latency']['count'], 3)
+        self.assertIn('fbchat_requests_total{{endpoint="{}",status="500"}} 1'.format(endpoint), metrics.export())
+
+    def test_listener(self):
+        metrics = Metrics()
+        listener = login(RECIPIENT, metrics=metrics)
+        listener.startListening()
+        self.addCleanup(listener.stopListening)
+        login().sendMessage('Hi', RECIPIENT, ThreadType.USER)
+        listener.doOneListen(markAlive=False)
+
+        def failing(client, m):
+            raise KeyError('messageMetadata')
+
+        message = self.server._newMessage('mid.$failing', '2', '2', 'Hi')
+        listener.registerDeltaHandler('delta', 'NewMessage', failing)
+        # Received twice
+        listener._parseMessage({'ms': [message, message]})
+
+        stats = metrics.stats()
+        self.assertEqual(stats['pulls'], 1)
+        self.assertEqual(stats['events'], {'delta.NewMessage': 2})
+        self.assertEqual(stats['parse_failures'], {'delta.NewMessage': 1})
+        self.assertEqual(stats['duplicates'], 1)
+
+
+class TestProfiler(StandInTestCase):
+    server_options = {'poll_timeout': 0.2}
+
+    def test_listener(self):
+        profiler = ListenProfiler(slow_threshold=0.05)
+        listener = login(RECIPIENT, profiler=profiler)
+        # Two handlers with the same name
+        listener.onMessage += lambda **kwargs: None
+        listener.onMessage += lambda **kwargs: time.sleep(0.1)
+        listener.startListening()
+        self.addCleanup(listener.stopListening)
+        login().sendMessage('Hi', RECIPIENT, ThreadType.USER)
+        listener.doOneListen(markAlive=False)
+
+        stats = profiler.stats()
+        for phase in ['pull', 'decode', 'parse', 'cycle']:
+            self.assertEqual(stats['phases'][phase]['count'], 1)
+        self.assertGreaterEqual(stats['phases']['parse']['max'], 0.1)
+        self.assertEqual(stats['lag']['count'], 1)
+        on_message = [name for name in stats['handlers'] if 'test_listener.<locals>.<lambda>' in name]
+        self.assertEqual(len(on_message), 2)
+        slow = stats['slow_handlers']
+        self.assertEqual(len(slow), 1)
+        self.assertIn(slow[0]['handler'], on_message)
+        self.assertEqual((slow[0]['calls'], slow[0]['slow_calls']), (1, 1))
+        self.assertIn(slow[0]['handler'], profiler.report())
+
+
+class TestSubscriptions(unittest.TestCase):
+    def setUp(self):
+        self.hook = EventHook(message=str, author_id=str, thread_id=str, thread_type=ThreadType)
+        self.calls = []
+
+    def handler(self, name):
+        return lambda message, author_id, thread_id, thread_type: self.calls.append((name, message))
+
+    def fire(self, message, author_id, thread_id, thread_type=ThreadType.USER):
+        self.hook(message=message, author_id=author_id, thread_id=thread_id, thread_type=thread_type)
+
+    def test_filters(self):
+        self.hook += self.handler('all')
+        # Numbers match the ids of the events, which are strings
+        self.hook.subscribe(self.handler('thread'), thread_id=1)
+        self.hook.subscribe(self.handler('author in group'), author_id='2', thread_type=ThreadType.GROUP)
+
+        self.fire('a', '2', '1')
+        self.fire('b', '2', '3', ThreadType.GROUP)
+        self.fire('c', '4', '3', ThreadType.GROUP)
+        self.assertEqual(self.calls, [
+            ('all', 'a'), ('thread', 'a'),
+            ('all', 'b'), ('author in group', 'b'),
+            ('all', 'c'),
+        ])
+
+    def test_unsubscribe(self):
+        handler = self.handler('thread')
+        self.hook.subscribe(handler, thread_id='1')
+        self.hook.subscribe(handler, author_id='2')
+        self.hook.unsubscribe(handler)
+        self.fire('a', '2', '1')
+        self.assertEqual(self.calls, [])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self.hook.subscribe(self.handler('none'))
+        with self.assertRaises(ValueError):
+            EventHook(message=str).subscribe(lambda message: None, thread_id='1')
+        with self.assertRaises(ValueError):
+            self.hook.subscribe(lambda message: None, thread_id='1')
+
+
+class TestScheduler(unittest.TestCase):
+    def test_priority(self):
+        scheduler = OutboundScheduler(rate=50, burst=1)
+        order = []
+
+        async def acquire(i, priority):
+            await scheduler.aacquire(None, priority)
+            order.append(priority)
+
+        async def run():
+            # The first one takes the only token, the others wait for the next ones
+            await asyncio.gather(*[acquire(i, Priority.BULK if i % 2 else Priority.INTERACTIVE) for i in range(9)])
+
+        asyncio.run(run())
+        self.assertEqual(order, [Priority.INTERACTIVE] * 5 + [Priority.BULK] * 4)
+        stats = scheduler.stats()
+        self.assertEqual(stats['INTERACTIVE']['acquired'], 5)
+        self.assertEqual(stats['BULK']['acquired'], 4)
+        self.assertGreater(stats['BULK']['average_wait'], stats['INTERACTIVE']['average_wait'])
+
+    def test_thread_rate(self):
+        scheduler = OutboundScheduler(thread_rate=10, thread_burst=1)
+        start = time.perf_counter()
+        for i in range(3):
+            scheduler.acquire('a')
+        self.assertGreaterEqual(time.perf_counter() - start, 0.18)
+        # Another thread isn't held up
+        self.assertLess(scheduler.acquire('b'), 0.05)
+
+    def test_rate(self):
+        scheduler = OutboundScheduler(rate=20, burst=2)
+        start = time.perf_counter()
+        threads = [threading.Thread(target=scheduler.acquire) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Two at once, then one every 50 ms
+        self.assertGreaterEqual(time.perf_counter() - start, 0.18)
+
+    def test_async(self):
+        scheduler = OutboundScheduler(rate=20, burst=1)
+
+        async def run():
+            # Waiting requests don't use threads
+            count = threading.active_count()
+            waiting = asyncio.gather(*[scheduler.aacquire() for i in range(5)])
+            await asyncio.sleep(0.01)
+            self.assertEqual(threading.active_count(), count)
+            # Sync requests share the lanes
+            thread = threading.Thread(target=scheduler.acquire)
+            thread.start()
+            await waiting
+            await asyncio.get_event_loop().run_in_executor(None, thread.join)
+
+            # Cancelled requests leave their lane
+            cancelled = asyncio.ensure_future(asyncio.gather(*[scheduler.aacquire() for i in range(5)]))
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await cancelled
+            self.assertEqual(scheduler.stats()['INTERACTIVE']['queued'], 0)
+
+        start = time.perf_counter()
+        asyncio.run(run())
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+        self.assertEqual(scheduler.stats()['INTERACTIVE']['acquired'], 6)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncClient(StandInTestCase):
+    server_options = {'poll_timeout': 0.2}
+
+    def run_client(self, coroutine_function, email='sender@example.com'):
+        """Runs `coroutine_function(client)` with a new `AsyncClient`, and returns its result"""
+        async def run():
+            client = alogin(email)
+            try:
+                return await coroutine_function(client)
+            finally:
+                await client.close()
+        return asyncio.run(run())
+
+    def test_send(self):
+        async def send(client):
+            return await asyncio.gather(
+                client.sendMessage('Hi', RECIPIENT, ThreadType.USER),
+                client.sendMessages([('Hi', RECIPIENT, ThreadType.USER), ('Hi', None, ThreadType.USER)]),
+            )
+
+        sent, batch = self.run_client(send)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(batch[0]), 1)
+        self.assertIsInstance(batch[1], ValueError)
+        self.assertEqual(self.server.stats()['requests']['/messaging/send/'], 2)
+
+    def test_threads(self):
+        async def get(client):
+            return await client.getThreadList(0, 5), await client.getThreadInfo(RECIPIENT, last_n=3)
+
+        threads, messages = self.run_client(get)
+        self.assertEqual(len(threads), 5)
+        self.assertTrue(messages)
+
+    def test_getUserInfo(self):
+        async def get(client):
+            # As strings, like in the events, and as numbers
+            return await client.getUserInfo(RECIPIENT), await client.getUserInfo('fbid:' + RECIPIENT, 100000000000003)
+
+        one, two = self.run_client(get)
+        self.assertEqual(one['id'], RECIPIENT)
+        self.assertEqual(sorted(user['id'] for user in two), [RECIPIENT, '100000000000003'])
+
+    def test_listen(self):
+        received = []
+
+        async def listen(listener):
+            def onMessage(**kwargs):
+                received.append(kwargs['message'])
+                listener.listening = False
+
+            listener.onMessage += onMessage
+            sender = alogin()
+            task = asyncio.ensure_future(listener.listen(markAlive=False))
+            await asyncio.sleep(0.1)
+            await sender.sendMessage('Hi', RECIPIENT, ThreadType.USER)
+            await asyncio.wait_for(task, 5)
+            await sender.close()
+
+        self.run_client(listen, RECIPIENT)
+        self.assertEqual(received, ['Hi'])
+
+    def test_upload_retried(self):
+        respond = self.server._respond
+        sizes = []
+
+        def failing(method, path, data, uid):
+            if path == '/ajax/mercury/upload.php':
+                sizes.append(data['__body_size'])
+                if len(sizes) == 1:
+                    return 500, [], b'Internal Server Error'
+            return respond(method, path, data, uid)
+
+        self.server._respond = failing
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        image = os.path.join(directory.name, 'image.png')
+        with open(image, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + os.urandom(256 * 1024))
+
+        async def send(client):
+            client.retry_policy = RetryPolicy(backoff_factor=0, breaker=CircuitBreaker(failure_threshold=100))
+            client.upload_cache = UploadCache()
+            return await client.sendLocalImage(image, 'Hi', RECIPIENT, ThreadType.USER)
+
+        self.assertTrue(self.run_client(send))
+        # Sent again from the start of the file
+        self.assertEqual(len(sizes), 2)
+        self.assertEqual(sizes[0], sizes[1])
+
+    def test_outage(self):
+        async def listen(listener):
+            listener.retry_policy = RetryPolicy(max_retries=1, backoff_factor=0, breaker=CircuitBreaker(failure_threshold=100))
+            await listener.startListening()
+            self.server.error_rate = 1
+            for i in range(3):
+                await listener.doOneListen(markAlive=False)
+            return listener._listen_failures
+
+        self.assertEqual(self.run_client(listen, RECIPIENT), 3)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestClientPool(StandInTestCase):
+    server_options = {'poll_timeout': 0.2}
+
+    def test_routing(self):
+        accounts = ['100000000000011', '100000000000012']
+        pool = fbchat.ClientPool()
+        for account in accounts:
+            pool.addClient(account, 'password', debug=False, info_log=False)
+        fbchat.log.setLevel(100)
+        received = []
+
+        def onEvent(account_id, event, kwargs):
+            if event == 'onMessage':
+                received.append((account_id, kwargs['message']))
+                if len(received) == len(accounts):
+                    pool.stopListening()
+
+        pool.onEvent += onEvent
+
+        async def run():
+            sender = alogin()
+            listening = asyncio.ensure_future(pool.listen(markAlive=False))
+            await asyncio.sleep(0.2)
+            for account in accounts:
+                await sender.sendMessage('Hi ' + account, account, ThreadType.USER)
+            await asyncio.wait_for(listening, 5)
+            await sender.close()
+            await pool.close()
+
+        asyncio.run(run())
+        self.assertEqual(sorted(received), [(account, 'Hi ' + account) for account in accounts])
+        stats = pool.stats()
+        self.assertEqual(stats['accounts'], 2)
+        self.assertEqual(stats['events']['onMessage'], 2)
+        self.assertEqual(sorted(stats['account_events']), accounts)
+        # The accounts share one connection pool
+        self.assertIs(pool[accounts[0]]._session.get_adapter('http://'), pool[accounts[1]]._session.get_adapter('http://'))
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncEventExecutor(StandInTestCase):
+    server_options = {'poll_timeout': 0.2}
+
+    def test_created_before_loop(self):
+        executor = fbchat.AsyncEventExecutor()
+        # Logging in fires events, without an event loop
+        listener = alogin(RECIPIENT, event_executor=executor)
+        received = []
+        listener.onMessage += lambda **kwargs: received.append(kwargs['mid'])
+
+        async def run():
+            sender = alogin()
+            await listener.startListening()
+            await sender.sendMessage('Hi', RECIPIENT, ThreadType.USER)
+            for i in range(20):
+                await listener.doOneListen(markAlive=False)
+                if received:
+                    break
+            await executor.shutdown()
+            await sender.close()
+            await listener.close()
+
+        asyncio.run(run())
+        self.assertEqual(len(received), 1)
+        stats = executor.stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['executed'], stats['submitted'])
+
+    def test_submit_from_thread(self):
+        executor = fbchat.AsyncEventExecutor()
+        threads = []
+
+        async def run():
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, executor.submit, None, lambda: threads.append(threading.current_thread()), {})
+            await executor.shutdown()
+
+        asyncio.run(run())
+        self.assertEqual(threads, [threading.main_thread()])
+
+
+if __name__ == '__main__':
+    unittest.main()